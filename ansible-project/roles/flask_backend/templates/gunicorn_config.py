@@ -1,4 +1,263 @@
 # ansible-project/roles/flask_backend/templates/gunicorn_config.py
+"""
+Gunicorn settings for the todolist service, plus optional request stats.
+
+With request stats on (the default; GUNICORN_STATS=0 turns them off), the hooks
+below give every worker a slot in a block of shared memory that the master maps
+before forking. pre_request/post_request count each request in the worker's
+slot: requests, 4xx and 5xx responses, requests in flight, total and max time,
+and a latency histogram with four buckets per power of two (within 19%). A
+request costs a clock read, an uncontended lock and a few integer updates, so
+the stats can stay on in production. The master keeps the totals of exited
+workers, and reads the accept queue of the bound ports from /proc/net/tcp.
+
+The master serves the stats as JSON on GUNICORN_STATS_BIND (default
+127.0.0.1:9102, empty for none): `curl http://127.0.0.1:9102/stats`. It can also
+rewrite them every GUNICORN_STATS_INTERVAL seconds (default 5) to
+GUNICORN_STATS_FILE. stress-monkey's `simulate_traffic.py --server-stats`
+scrapes either and prints the server's view of every stage.
+"""
+import json
+import math
+import mmap
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
 bind = "0.0.0.0:80"
 workers = 4
-preload_app = True
\ No newline at end of file
+preload_app = True
+
+request_stats = os.environ.get('GUNICORN_STATS', '1') != '0'
+stats_bind = os.environ.get('GUNICORN_STATS_BIND', '127.0.0.1:9102')
+stats_file = os.environ.get('GUNICORN_STATS_FILE', '')
+stats_interval = float(os.environ.get('GUNICORN_STATS_INTERVAL', '5'))
+
+# Layout of a worker's slot in the shared memory, in unsigned 64-bit counters
+PID, BOOTED, REQUESTS, CLIENT_ERRORS, SERVER_ERRORS, ACTIVE, TOTAL_US, MAX_US = range(8)
+HISTOGRAM = 8  # Bucket b counts requests of up to 2 ** ((b + 1) / 4) microseconds
+BUCKETS = 128
+SLOT_SIZE = HISTOGRAM + BUCKETS
+MIN_SLOTS = 16  # Room for replacement workers starting while old ones finish
+
+
+def _bucket(us):
+    return min(int(4 * math.log2(us)), BUCKETS - 1) if us > 1 else 0
+
+
+def _summary(counters):
+    # The JSON form of one slot's counters, without the PID and boot time
+    histogram = counters[HISTOGRAM:]
+    requests = counters[REQUESTS]
+    summary = {'requests': requests, 'client_errors': counters[CLIENT_ERRORS],
+               'server_errors': counters[SERVER_ERRORS], 'active': counters[ACTIVE],
+               'mean_ms': counters[TOTAL_US] / requests / 1000 if requests else None,
+               'max_ms': counters[MAX_US] / 1000 if requests else None,
+               'histogram': [[round(2 ** ((bucket + 1) / 4) / 1000, 4), count]
+                             for bucket, count in enumerate(histogram) if count]}
+    for label, pct in (('p50_ms', 50), ('p90_ms', 90), ('p99_ms', 99)):
+        summary[label] = None
+        wanted, seen = math.ceil(requests * pct / 100), 0
+        for upper_ms, count in summary['histogram']:
+            seen += count
+            if seen >= wanted:
+                summary[label] = upper_ms
+                break
+    return summary
+
+
+def listen_queue(ports):
+    """
+    Returns the connections waiting in the accept queues of the listening ports, from
+    /proc/net/tcp (None where that is not available).
+    """
+    queued = 0
+    found = False
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if fields[3] == '0A' and int(fields[1].rsplit(':', 1)[1], 16) in ports:  # LISTEN
+                queued += int(fields[4].split(':')[1], 16)  # rx_queue of a listening socket
+                found = True
+    return queued if found else None
+
+
+class RequestStats:
+    """
+    Per-worker request counters in shared memory, created by the master before any fork.
+
+    Args:
+        slots (int): The most workers alive at once.
+        ports (set): The TCP ports gunicorn listens on, for the accept queue.
+        backlog (int): The accept queue's limit, gunicorn's `backlog` setting.
+    """
+
+    def __init__(self, slots, ports, backlog):
+        self.slots = slots
+        self.ports = ports
+        self.backlog = backlog
+        self.memory = mmap.mmap(-1, slots * SLOT_SIZE * 8)
+        self.counters = memoryview(self.memory).cast('Q')
+        self.free = list(range(slots - 1, -1, -1))
+        self.retired = [0] * SLOT_SIZE  # Totals of exited workers, kept by the master
+        self.retired_workers = 0
+        self.lock = threading.Lock()  # Guards a worker's slot against its own threads
+        self.http = None
+
+    def claim(self):
+        # Master, before a fork: a cleared slot offset for the new worker, None if all are taken
+        if not self.free:
+            return None
+        offset = self.free.pop() * SLOT_SIZE
+        self.counters[offset:offset + SLOT_SIZE] = memoryview(bytes(SLOT_SIZE * 8)).cast('Q')
+        return offset
+
+    def release(self, offset):
+        # Master, after a worker exited: keep its totals and free its slot
+        counters = self.counters
+        retired = self.retired
+        for field in range(SLOT_SIZE):
+            if field == MAX_US:
+                retired[field] = max(retired[field], counters[offset + field])
+            elif field not in (PID, BOOTED, ACTIVE):
+                retired[field] += counters[offset + field]
+        counters[offset + PID] = 0
+        self.retired_workers += 1
+        self.free.append(offset // SLOT_SIZE)
+
+    def begin(self, offset):
+        with self.lock:
+            self.counters[offset + ACTIVE] += 1
+
+    def end(self, offset, seconds, status_code):
+        us = int(seconds * 1000000)
+        counters = self.counters
+        with self.lock:
+            counters[offset + ACTIVE] -= 1
+            counters[offset + REQUESTS] += 1
+            if status_code is None or status_code >= 500:
+                counters[offset + SERVER_ERRORS] += 1
+            elif status_code >= 400:
+                counters[offset + CLIENT_ERRORS] += 1
+            counters[offset + TOTAL_US] += us
+            if us > counters[offset + MAX_US]:
+                counters[offset + MAX_US] = us
+            counters[offset + HISTOGRAM + _bucket(us)] += 1
+
+    def snapshot(self):
+        """
+        Returns the stats of every live worker, the exited workers and the accept queue as a dict.
+        """
+        workers = []
+        totals = list(self.retired)
+        for offset in range(0, self.slots * SLOT_SIZE, SLOT_SIZE):
+            counters = self.counters[offset:offset + SLOT_SIZE].tolist()
+            if not counters[PID]:
+                continue
+            workers.append(dict(_summary(counters), pid=counters[PID], booted=counters[BOOTED]))
+            for field in range(REQUESTS, SLOT_SIZE):
+                if field == MAX_US:
+                    totals[field] = max(totals[field], counters[field])
+                else:
+                    totals[field] += counters[field]
+        return {'time': time.time(), 'master_pid': os.getpid(), 'workers': workers,
+                'retired': dict(_summary(self.retired), workers=self.retired_workers),
+                'total': _summary(totals), 'listen_queue': listen_queue(self.ports), 'backlog': self.backlog}
+
+    def serve(self, address, log):
+        host, _, port = address.rpartition(':')
+        try:
+            self.http = HTTPServer((host or '127.0.0.1', int(port)), _StatsHandler)
+        except OSError as e:
+            log.warning("Request stats endpoint not started on %s: %s", address, e)
+            return
+        self.http.request_stats = self
+        threading.Thread(target=self.http.serve_forever, name='request-stats', daemon=True).start()
+        log.info("Request stats on http://%s/stats", address)
+
+    def dump(self, path):
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+
+    def dump_every(self, path, interval, log):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    log.warning("Request stats not written to %s: %s", path, e)
+
+        threading.Thread(target=run, name='request-stats-dump', daemon=True).start()
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/stats'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.request_stats.snapshot()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes stay out of the gunicorn logs
+
+
+if request_stats:
+    def on_starting(server):
+        ports = {address[1] for address in server.cfg.address if isinstance(address, tuple)}
+        server.request_stats = RequestStats(max(2 * server.cfg.workers, MIN_SLOTS), ports, server.cfg.backlog)
+
+    def when_ready(server):
+        stats = server.request_stats
+        if stats_bind:
+            stats.serve(stats_bind, server.log)
+        if stats_file:
+            stats.dump_every(stats_file, stats_interval, server.log)
+
+    def pre_fork(server, worker):
+        stats = getattr(server, 'request_stats', None)  # Not there if stats were turned on by a reload
+        worker.request_stats = stats
+        worker.stats_slot = stats.claim() if stats is not None else None
+
+    def post_fork(server, worker):
+        stats = worker.request_stats
+        if stats is None:
+            return
+        if stats.http is not None:
+            stats.http.socket.close()  # The master's endpoint; this process never serves it
+        if worker.stats_slot is not None:
+            stats.counters[worker.stats_slot + BOOTED] = int(time.time())
+            stats.counters[worker.stats_slot + PID] = os.getpid()
+
+    def child_exit(server, worker):
+        if getattr(worker, 'stats_slot', None) is not None:
+            worker.request_stats.release(worker.stats_slot)
+
+    def on_exit(server):
+        stats = getattr(server, 'request_stats', None)
+        if stats is not None and stats_file:
+            stats.dump(stats_file)
+
+    def pre_request(worker, req):
+        worker.log.debug("%s %s", req.method, req.path)  # What the default hook does
+        req.stats_started = time.perf_counter()
+        if worker.stats_slot is not None:
+            worker.request_stats.begin(worker.stats_slot)
+
+    def post_request(worker, req, environ, resp):
+        started = getattr(req, 'stats_started', None)
+        if worker.stats_slot is not None and started is not None:
+            worker.request_stats.end(worker.stats_slot, time.perf_counter() - started,
+                                     resp.status_code if resp is not None else None)
@@ -0,0 +1,229 @@
+"""
+Offline analysis of the binary results files written by simulate_traffic.py --results-file.
+
+Prints per-endpoint totals and latency percentiles, throughput and latency per
+time window, and the bursts of errors in the run. Files are memory-mapped and
+processed in fixed-size chunks with NumPy, so memory stays flat and a
+100M-request file takes seconds. Latencies are bucketed the same way as
+latency_histogram.LatencyHistogram, so the percentiles match the live reports
+within the same 1/64 relative error.
+
+    python analyze_results.py results.bin --window 10s --burst-window 1s
+"""
+import argparse
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("analyze_results.py needs NumPy: pip install numpy")
+
+from latency_histogram import BUCKET_COUNT, SUB_BUCKET_BITS, SUB_BUCKET_COUNT, _bucket_upper_value
+from load_stats import REPORT_PERCENTILES, STATUS_CLASSES
+from results_log import UNTIMED, load_records
+from stages import parse_duration
+
+CHUNK_RECORDS = 4000000  # Records processed per NumPy pass
+BUCKET_UPPER_MS = np.array([_bucket_upper_value(index) for index in range(BUCKET_COUNT)]) / 1000.0
+
+
+def bucket_indexes(latency_us):
+    """
+    Vectorized latency_histogram._bucket_index for an array of microsecond latencies.
+    """
+    values = latency_us.astype(np.int64)
+    # frexp's exponent is the bit length of a positive integer
+    shift = np.maximum(np.frexp(values.astype(np.float64))[1] - SUB_BUCKET_BITS, 0)
+    indexes = (shift << (SUB_BUCKET_BITS - 1)) + (values >> shift)
+    return np.where(values < SUB_BUCKET_COUNT, values, indexes)
+
+
+def percentiles_ms(counts, pcts):
+    """
+    Returns the latency in ms at each percentile of a bucket count vector (None if empty).
+    """
+    total = counts.sum()
+    if not total:
+        return [None] * len(pcts)
+    cumulative = np.cumsum(counts)
+    wanted = [max(int(pct / 100.0 * total + 0.999999), 1) for pct in pcts]
+    return [BUCKET_UPPER_MS[np.searchsorted(cumulative, rank)] for rank in wanted]
+
+
+class Analysis:
+    """
+    Counters accumulated over every chunk of every results file.
+
+    Args:
+        start_us (int): The time of the first request, in microseconds since the epoch.
+        windows (int): The number of throughput windows.
+        window_us (int): The width of a throughput window in microseconds.
+        burst_windows (int): The number of error-burst windows.
+        burst_us (int): The width of an error-burst window in microseconds.
+    """
+
+    def __init__(self, start_us, windows, window_us, burst_windows, burst_us):
+        self.start_us = start_us
+        self.window_us = window_us
+        self.burst_us = burst_us
+        self.keys = {}  # (method, endpoint) -> dense key
+        self.key_requests = np.zeros(0, dtype=np.int64)
+        self.key_errors = np.zeros(0, dtype=np.int64)
+        self.key_bytes = np.zeros(0, dtype=np.int64)
+        self.key_latency = np.zeros((0, BUCKET_COUNT), dtype=np.int64)
+        self.window_requests = np.zeros(windows, dtype=np.int64)
+        self.window_errors = np.zeros(windows, dtype=np.int64)
+        self.window_latency = np.zeros((windows, BUCKET_COUNT), dtype=np.int32)
+        self.burst_requests = np.zeros(burst_windows, dtype=np.int64)
+        self.burst_classes = np.zeros((burst_windows, len(STATUS_CLASSES)), dtype=np.int64)
+
+    def _key_table(self, header):
+        # Maps endpoint id * 256 + method id in one file to a dense key shared by all files
+        table = np.zeros(len(header['endpoints']) * 256, dtype=np.int64)
+        for endpoint_id, endpoint in enumerate(header['endpoints']):
+            for method_id, method in enumerate(header['methods']):
+                key = self.keys.setdefault((method, endpoint), len(self.keys))
+                table[endpoint_id * 256 + method_id] = key
+        grow = len(self.keys) - len(self.key_requests)
+        if grow > 0:
+            self.key_requests = np.concatenate([self.key_requests, np.zeros(grow, dtype=np.int64)])
+            self.key_errors = np.concatenate([self.key_errors, np.zeros(grow, dtype=np.int64)])
+            self.key_bytes = np.concatenate([self.key_bytes, np.zeros(grow, dtype=np.int64)])
+            self.key_latency = np.concatenate([self.key_latency, np.zeros((grow, BUCKET_COUNT), dtype=np.int64)])
+        return table
+
+    def add_file(self, header, records):
+        """
+        Adds every record of one results file.
+
+        Args:
+            header (dict): The file's header.
+            records (numpy.ndarray): The file's records, see results_log.RECORD_DTYPE.
+
+        Returns:
+            None
+        """
+        table = self._key_table(header)
+        keys = len(self.keys)
+        windows = len(self.window_requests)
+        bursts = len(self.burst_requests)
+        for first in range(0, len(records), CHUNK_RECORDS):
+            chunk = records[first:first + CHUNK_RECORDS]
+            key = table[chunk['endpoint'].astype(np.int64) * 256 + chunk['method']]
+            offset = chunk['time_us'] - self.start_us
+            window = np.minimum(offset // self.window_us, windows - 1)
+            burst = np.minimum(offset // self.burst_us, bursts - 1)
+            status = chunk['status']
+            errors = (status == 0) | (status >= 400)
+            status_class = np.minimum(status // 100, 5)  # 0 (no response) is already 'failed'
+            latency = chunk['latency_us']
+            timed = latency != UNTIMED
+            bucket = bucket_indexes(latency[timed])
+
+            self.key_requests += np.bincount(key, minlength=keys)
+            self.key_errors += np.bincount(key[errors], minlength=keys)
+            self.key_bytes += np.bincount(key, weights=chunk['bytes'], minlength=keys).astype(np.int64)
+            self.key_latency += np.bincount(key[timed] * BUCKET_COUNT + bucket,
+                                            minlength=keys * BUCKET_COUNT).reshape(keys, BUCKET_COUNT)
+            self.window_requests += np.bincount(window, minlength=windows)
+            self.window_errors += np.bincount(window[errors], minlength=windows)
+            self.window_latency += np.bincount(window[timed] * BUCKET_COUNT + bucket,
+                                               minlength=windows * BUCKET_COUNT).reshape(windows, BUCKET_COUNT)
+            self.burst_requests += np.bincount(burst, minlength=bursts)
+            self.burst_classes += np.bincount(burst * len(STATUS_CLASSES) + status_class,
+                                              minlength=bursts * len(STATUS_CLASSES)).reshape(bursts, -1)
+
+    def error_bursts(self, threshold):
+        """
+        Returns the runs of consecutive burst windows whose error rate is at least `threshold`.
+
+        Returns:
+            list: (first window, last window) tuples.
+        """
+        errors = self.burst_classes[:, 0] + self.burst_classes[:, 4] + self.burst_classes[:, 5]
+        rate = errors / np.maximum(self.burst_requests, 1)
+        hot = (errors > 0) & (rate >= threshold)
+        runs = []
+        start = None
+        for index, flag in enumerate(hot):
+            if flag and start is None:
+                start = index
+            elif not flag and start is not None:
+                runs.append((start, index - 1))
+                start = None
+        if start is not None:
+            runs.append((start, len(hot) - 1))
+        return runs
+
+
+def _ms(value):
+    return '-' if value is None else f"{value:.1f}"
+
+
+def print_report(analysis, duration, threshold):
+    pcts = [pct for _, pct in REPORT_PERCENTILES]
+    total = int(analysis.key_requests.sum())
+    print(f"\nRequests ({duration:.1f}s, latencies in ms)")
+    print(f"{'method':<8}{'endpoint':<24}{'requests':>10}{'errors':>10}{'req/s':>10}{'MB':>9}"
+          + ''.join(f"{label:>9}" for label, _ in REPORT_PERCENTILES))
+    for (method, endpoint), key in sorted(analysis.keys.items()):
+        requests = int(analysis.key_requests[key])
+        if not requests:
+            continue
+        print(f"{method:<8}{endpoint:<24}{requests:>10}{int(analysis.key_errors[key]):>10}"
+              f"{requests / duration:>10.1f}{analysis.key_bytes[key] / 1e6:>9.1f}"
+              + ''.join(f"{_ms(value):>9}" for value in percentiles_ms(analysis.key_latency[key], pcts)))
+    print(f"{'total':<32}{total:>10}{int(analysis.key_errors.sum()):>10}{total / duration:>10.1f}")
+
+    window_s = analysis.window_us / 1e6
+    print(f"\nThroughput per {window_s:g}s window")
+    print(f"{'from s':>9}{'requests':>10}{'req/s':>10}{'errors':>10}{'err %':>8}{'p50':>9}{'p99':>9}{'max':>9}")
+    for index, requests in enumerate(analysis.window_requests):
+        errors = int(analysis.window_errors[index])
+        p50, p99, top = percentiles_ms(analysis.window_latency[index], [50, 99, 100])
+        print(f"{index * window_s:>9.0f}{int(requests):>10}{requests / window_s:>10.1f}{errors:>10}"
+              f"{100.0 * errors / requests if requests else 0.0:>8.1f}{_ms(p50):>9}{_ms(p99):>9}{_ms(top):>9}")
+
+    burst_s = analysis.burst_us / 1e6
+    bursts = analysis.error_bursts(threshold)
+    print(f"\nError bursts ({burst_s:g}s windows with at least {100 * threshold:g}% errors): {len(bursts)}")
+    if bursts:
+        print(f"{'from s':>9}{'to s':>9}{'requests':>10}{'errors':>10}{'err %':>8}  by class")
+    for first, last in bursts:
+        classes = analysis.burst_classes[first:last + 1].sum(axis=0)
+        requests = int(analysis.burst_requests[first:last + 1].sum())
+        errors = int(classes[0] + classes[4] + classes[5])
+        by_class = ', '.join(f"{STATUS_CLASSES[index]} {int(classes[index])}" for index in (0, 4, 5)
+                             if classes[index])
+        print(f"{first * burst_s:>9.0f}{(last + 1) * burst_s:>9.0f}{requests:>10}{errors:>10}"
+              f"{100.0 * errors / max(requests, 1):>8.1f}  {by_class}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse binary results files from simulate_traffic.py.")
+    parser.add_argument('files', nargs='+', help="results files (e.g. every PATH.N of a --processes run)")
+    parser.add_argument('--window', type=parse_duration, default=10.0,
+                        help="throughput and latency window, e.g. 1s or 1m (default: %(default)ss)")
+    parser.add_argument('--burst-window', type=parse_duration, default=1.0,
+                        help="resolution of error-burst detection (default: %(default)ss)")
+    parser.add_argument('--burst-threshold', type=float, default=0.05,
+                        help="error rate that makes a window part of a burst (default: %(default)s)")
+    args = parser.parse_args()
+
+    loaded = [load_records(path) for path in args.files]
+    loaded = [(header, records) for header, records in loaded if len(records)]
+    if not loaded:
+        sys.exit("No requests recorded.")
+    start_us = min(int(records['time_us'].min()) for _, records in loaded)
+    end_us = max(int(records['time_us'].max()) for _, records in loaded)
+    span_us = max(end_us - start_us, 1)
+    window_us = max(int(args.window * 1e6), 1)
+    burst_us = max(int(args.burst_window * 1e6), 1)
+    analysis = Analysis(start_us, span_us // window_us + 1, window_us, span_us // burst_us + 1, burst_us)
+    for header, records in loaded:
+        analysis.add_file(header, records)
+    print_report(analysis, span_us / 1e6, args.burst_threshold)
+
+
+if __name__ == '__main__':
+    main()
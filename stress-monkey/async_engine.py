@@ -0,0 +1,483 @@
+"""
+asyncio load engine for simulate_traffic.py.
+
+Every virtual user is a coroutine on a single event loop instead of an OS
+thread, so one process can hold thousands of concurrent users without fighting
+over the GIL. Only the standard library is used: the HTTP/1.1 client below
+understands just enough of the protocol to drive the todo API.
+"""
+import asyncio
+import json
+import math
+import time
+from urllib.parse import urlsplit
+
+from payloads import PUT_DONE_BODY, compile_body
+from resilience import CircuitBreaker, FailureGuard
+from scenario import ID_PLACEHOLDER, collection_endpoint, created_task_id
+from stages import CONTROL_INTERVAL, SHUTDOWN_GRACE, next_arrival, with_start_levels
+
+
+# Errors that mean "this request failed", as opposed to a bug in the engine
+REQUEST_ERRORS = (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError)
+
+EMPTY_POOL_BACKOFF = 0.1  # Seconds an ID-tracking user waits when there is no task to work on
+
+
+class AsyncHTTPConnection:
+    """
+    A single HTTP/1.1 connection to the backend.
+
+    Args:
+        host (str): The host name or IP of the backend.
+        port (int): The TCP port of the backend.
+        keep_alive (bool, optional): Reuse the connection between requests
+            instead of opening a new one each time (default is False, which
+            matches what `requests.get/post/...` do in the thread engine).
+        timeout (float, optional): Seconds to wait for connect and response.
+        stats (RunStats, optional): Where to count new vs. reused connections, and
+            to leave the phase times of each request if its `time_phases` is set.
+        max_keepalive (int, optional): Reconnect after this many requests on
+            one connection (default is 0, no limit).
+    """
+
+    def __init__(self, host, port, keep_alive=False, timeout=30.0, stats=None, max_keepalive=0):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.stats = stats
+        self.max_keepalive = max_keepalive
+        self.served = 0
+        self.reader = None
+        self.writer = None
+        self.phase_times = None
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        self.served = 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None):
+        """
+        Sends one request and reads the whole response.
+
+        Args:
+            method (str): The HTTP method to use.
+            path (str): The request target, e.g. '/todos/1'.
+            body (bytes, optional): A JSON request body.
+
+        Returns:
+            tuple: (status code, response body bytes)
+
+        Raises:
+            OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError:
+                If the connection or response is broken.
+        """
+        try:
+            result = await asyncio.wait_for(self._request(method, path, body), self.timeout)
+        except BaseException:
+            self.close()
+            raise
+        if self.phase_times is not None:
+            # Handed over only now, with no await left before the caller records the request:
+            # other coroutines may share the stats shard (see sessions.py)
+            self.stats.phase_times = self.phase_times
+            self.phase_times = None
+        return result
+
+    async def _request(self, method, path, body):
+        if self.max_keepalive and self.served >= self.max_keepalive:
+            self.close()
+        reused = self.writer is not None
+        timed = self.stats is not None and self.stats.time_phases
+        if timed:
+            begun = time.perf_counter()
+        if self.stats is not None:
+            self.stats.record_connection(reused)
+        if not reused:
+            await self._connect()
+        if timed:
+            connected = time.perf_counter()
+        self.served += 1
+        head = (f"{method} {path} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                f"Connection: {'keep-alive' if self.keep_alive else 'close'}\r\n")
+        if body is not None:
+            head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        self.writer.write(head.encode('latin-1') + b"\r\n" + (body or b""))
+        await self.writer.drain()
+        if timed:
+            sent = time.perf_counter()
+
+        status_line = await self.reader.readline()
+        if timed:
+            first = time.perf_counter()
+        if not status_line:
+            raise ConnectionResetError("connection closed before response")
+        status = int(status_line.split(None, 2)[1])
+
+        content_length = None
+        chunked = False
+        server_closes = not self.keep_alive
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                content_length = int(value)
+            elif name == b"transfer-encoding" and b"chunked" in value.lower():
+                chunked = True
+            elif name == b"connection" and value.strip().lower() == b"close":
+                server_closes = True
+
+        if chunked:
+            payload = bytearray()
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                payload += await self.reader.readexactly(size)
+                await self.reader.readline()
+            payload = bytes(payload)
+        elif content_length is not None:
+            payload = await self.reader.readexactly(content_length)
+        else:
+            payload = await self.reader.read()
+            server_closes = True
+
+        if server_closes:
+            self.close()
+        if timed:
+            self.phase_times = (None if reused else connected - begun, sent - connected, first - sent,
+                                time.perf_counter() - first)
+        return status, payload
+
+
+async def send_once_async(conn, path, endpoint, method, body, stats, log=None, intended=None):
+    """
+    Sends one iteration of the workload for an endpoint (POST also looks up and completes the new task).
+
+    Args:
+        conn (AsyncHTTPConnection): The connection to send on.
+        path (str): The full request path, including any base URL prefix.
+        endpoint (str): The endpoint label used in stats and output.
+        method (str): The HTTP method to use.
+        body (RequestBody): The pre-encoded request body, see `compile_body`.
+        stats (RunStats): Where to record each request.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        intended (float, optional): The `time.perf_counter()` time this request was scheduled
+            for; latency is measured from here instead of the actual send time (default is None).
+
+    Returns:
+        bool: True if a request failed without a response.
+    """
+    say = log is not None and log.sampled()
+    try:
+        started = time.perf_counter() if intended is None else intended
+        status, payload = await conn.request(method, path, body.render())
+        stats.record(method, endpoint, status, time.perf_counter() - started, len(payload))
+        if method == 'POST' and status == 201:
+            # Make a GET request to retrieve the 'task_id'
+            started = time.perf_counter()
+            get_status, get_body = await conn.request('GET', path)
+            stats.record('GET', endpoint, get_status, time.perf_counter() - started, len(get_body))
+            if get_status == 200:
+                tasks = json.loads(get_body).get('tasks', [])
+                if tasks:
+                    task_id = tasks[-1].get('task_id')
+                    if say:
+                        log.write(f"Created task with ID: {task_id}. The Force is strong with this one.")
+                    started = time.perf_counter()
+                    put_status, put_body = await conn.request('PUT', f"{path}/{task_id}", PUT_DONE_BODY)
+                    stats.record('PUT', f"{endpoint}/<id>", put_status, time.perf_counter() - started,
+                                 len(put_body))
+                    if say:
+                        if put_status == 200:
+                            log.write(f"Updated task with ID: {task_id} to complete. The task has been completed, young Jedi.")
+                        else:
+                            log.write(f"PUT request failed with status code: {put_status}. The Dark Side I sense in you.")
+                elif say:
+                    log.write("No tasks found. These are not the tasks you're looking for.")
+            elif say:
+                log.write(f"GET request failed with status code: {get_status}. The disturbance in the Force I feel.")
+        if say:
+            log.write(f"Response from {method} {endpoint}: {status}. May the Force be with you.")
+    except REQUEST_ERRORS as e:
+        stats.record(method, endpoint, None)
+        if say:
+            log.write(f"Request to {method} {endpoint} failed: {e!r}. I've got a bad feeling about this.")
+        return True
+    return False
+
+
+async def _lookup_ids_async(conn, path, endpoint, stats, ids):
+    started = time.perf_counter()
+    status, payload = await conn.request('GET', path)
+    stats.record('GET', endpoint, status, time.perf_counter() - started, len(payload))
+    if status == 200:
+        return ids.add_from_listing(json.loads(payload))
+    return 0
+
+
+async def send_tracked_once_async(conn, path, endpoint, method, body, stats, ids, log=None, intended=None):
+    """
+    Async counterpart of `send_tracked_once`: one iteration of the ID-tracking scenario.
+
+    Args:
+        conn (AsyncHTTPConnection): The connection to send on.
+        path (str): The full request path, possibly containing '<id>'.
+        endpoint (str): The endpoint label used in stats and output.
+        method (str): The HTTP method to use.
+        body (RequestBody): The pre-encoded request body, see `compile_body`.
+        stats (RunStats): Where to record each request.
+        ids (TaskIdPool): The pool of created task IDs.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        intended (float, optional): The scheduled send time for open-loop latency (default is None).
+
+    Returns:
+        bool: True if a request failed without a response.
+    """
+    say = log is not None and log.sampled()
+    try:
+        started = time.perf_counter() if intended is None else intended
+        target = path
+        if ID_PLACEHOLDER in endpoint:
+            task_id = ids.take(remove=method == 'DELETE')
+            if task_id is None:
+                collection = collection_endpoint(endpoint)
+                prefix = path[:len(path) - len(endpoint)]
+                if not await _lookup_ids_async(conn, prefix + collection, collection, stats, ids):
+                    await asyncio.sleep(EMPTY_POOL_BACKOFF)
+                return False
+            target = path.replace(ID_PLACEHOLDER, str(task_id))
+        status, payload = await conn.request(method, target, body.render())
+        stats.record(method, endpoint, status, time.perf_counter() - started, len(payload))
+        if method == 'POST' and status == 201:
+            task_id = created_task_id(json.loads(payload)) if payload else None
+            if task_id is not None:
+                ids.add(task_id)
+                if say:
+                    log.write(f"Created task with ID: {task_id}. The Force is strong with this one.")
+            elif ids.should_lookup():
+                await _lookup_ids_async(conn, path, endpoint, stats, ids)
+        if say:
+            log.write(f"Response from {method} {target[len(path) - len(endpoint):]}: {status}. May the Force be with you.")
+    except REQUEST_ERRORS as e:
+        stats.record(method, endpoint, None)
+        if say:
+            log.write(f"Request to {method} {endpoint} failed: {e!r}. I've got a bad feeling about this.")
+        return True
+    return False
+
+
+def _target(base_url, endpoint, data):
+    parts = urlsplit(base_url)
+    if parts.scheme != 'http':
+        raise ValueError(f"The async engine only supports http:// URLs, got {base_url}")
+    path = f"{parts.path.rstrip('/')}{endpoint}"
+    return parts.hostname, parts.port or 80, path, compile_body(data)
+
+
+class _AsyncWorker:
+    """
+    One virtual user coroutine that can be stopped, or pointed at a new stats shard, between stages.
+
+    Closed-loop users send back to back, waiting out the `guard`'s backoff after a failure.
+    Open-loop users (given `jobs`) send once for every scheduled send time they take from the
+    queue. A request the guard's circuit breaker short-circuits is counted, not sent.
+    """
+
+    def __init__(self, target, endpoint, method, stats, log, keep_alive, max_keepalive, jobs=None, ids=None,
+                 guard=None):
+        host, port, self.path, self.body = target
+        self.endpoint = endpoint
+        self.method = method
+        self.stats = stats
+        self.log = log
+        self.jobs = jobs
+        self.ids = ids
+        self.guard = guard
+        self.conn = AsyncHTTPConnection(host, port, keep_alive=keep_alive, stats=stats, max_keepalive=max_keepalive)
+        self.stopped = False
+        self.idle = False
+        self.task = asyncio.ensure_future(self._run())
+
+    def retarget(self, stats):
+        self.stats = stats
+        self.conn.stats = stats
+
+    def stop(self):
+        self.stopped = True
+        if self.idle:
+            self.task.cancel()  # Waiting for a job or backing off; nothing in flight to finish
+
+    async def _send(self, stats, intended):
+        # True if a request failed; the shard is shared, so its counters are no use for that
+        if self.ids is not None:
+            return await send_tracked_once_async(self.conn, self.path, self.endpoint, self.method, self.body,
+                                                 stats, self.ids, self.log, intended)
+        return await send_once_async(self.conn, self.path, self.endpoint, self.method, self.body, stats,
+                                     self.log, intended)
+
+    async def _run(self):
+        guard = self.guard
+        try:
+            while not self.stopped:
+                intended = None
+                if self.jobs is not None:
+                    self.idle = True
+                    intended = await self.jobs.get()
+                    self.idle = False
+                stats = self.stats
+                if guard is None:
+                    await self._send(stats, intended)
+                    continue
+                if not guard.allow():
+                    stats.record_short_circuit(self.method, self.endpoint)
+                    pause = guard.short_circuited()
+                else:
+                    pause = guard.done(await self._send(stats, intended))
+                if pause and self.jobs is None and not self.stopped:
+                    self.idle = True
+                    await asyncio.sleep(pause)
+                    self.idle = False
+        finally:
+            self.conn.close()
+
+
+class _AsyncEndpointWorkers:
+    """
+    The virtual users sending to one endpoint, resized by `run_stages_async`.
+    """
+
+    def __init__(self, base_url, endpoint, method, data, log, keep_alive, max_keepalive, ids=None, backoff=None,
+                 breaker=None):
+        self.target = _target(base_url, endpoint, data)
+        self.endpoint = endpoint
+        self.method = method
+        self.log = log
+        self.keep_alive = keep_alive
+        self.max_keepalive = max_keepalive
+        self.ids = ids
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(breaker) if breaker is not None else None
+        self.closed_loop = []
+        self.open_loop = []
+        self.jobs = asyncio.Queue()
+        self.next_due = math.inf
+        self.stats = None
+
+    def retarget(self, stats):
+        # Every user of the group records into one shard per stage: they share an event loop, and a
+        # shard per user would cost a full set of histograms each and slow every merge
+        self.stats = stats.shard()
+        for worker in self.closed_loop + self.open_loop:
+            worker.retarget(self.stats)
+
+    def _resize(self, workers, count, jobs):
+        while len(workers) < count:
+            guard = None
+            if self.backoff is not None or self.breaker is not None:
+                guard = FailureGuard(self.backoff, self.breaker)
+            workers.append(_AsyncWorker(self.target, self.endpoint, self.method, self.stats, self.log,
+                                        self.keep_alive, self.max_keepalive, jobs, self.ids, guard))
+        while len(workers) > count:
+            workers.pop().stop()
+
+    def resize(self, closed_loop, open_loop):
+        self._resize(self.closed_loop, closed_loop, None)
+        self._resize(self.open_loop, open_loop, self.jobs)
+
+    def schedule(self, now, rate_at, until):
+        while self.next_due <= now:
+            self.jobs.put_nowait(self.next_due)
+            self.next_due = next_arrival(self.next_due, rate_at, until)
+        return self.next_due
+
+    def stop(self):
+        for worker in self.closed_loop + self.open_loop:
+            worker.stop()
+        # Requests that were due but never sent are failures, not missing data
+        while not self.jobs.empty():
+            self.jobs.get_nowait()
+            self.stats.record(self.method, self.endpoint, None)
+        return [worker.task for worker in self.closed_loop + self.open_loop]
+
+
+async def run_stages_async(base_url, endpoints, stages, stage_stats, log=None, keep_alive=False, max_keepalive=0,
+                           stage_done=None, ids=None, backoff=None, breaker=None):
+    """
+    Async counterpart of `run_stages_threads`: runs a staged load profile with virtual users.
+
+    Closed-loop stages add or remove virtual users live to follow the stage's ramp. Rate
+    stages queue requests at their due times for a pool of users, measuring latency from
+    the due time so a slow backend cannot hide its tail (coordinated omission). Every user
+    is stopped when the last stage ends.
+
+    Args:
+        base_url (str): The base URL of the API.
+        endpoints (list): A list of tuples containing the endpoint, HTTP method, and data for each request.
+        stages (list): The Stage list of the profile.
+        stage_stats (list): One RunStats per stage to record into.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        keep_alive (bool, optional): Reuse TCP connections between requests.
+        max_keepalive (int, optional): Reconnect after this many requests on one connection (0 for no limit).
+        stage_done (callable, optional): Called with the stage index as each stage ends.
+        ids (TaskIdPool, optional): Run the ID-tracking scenario with this pool (default is None).
+        backoff (Backoff, optional): How long closed-loop users wait after a failed request
+            (default is None, not at all).
+        breaker (BreakerPolicy, optional): Give every endpoint a circuit breaker with this
+            policy (default is None, no breakers).
+
+    Returns:
+        None
+    """
+    groups = [_AsyncEndpointWorkers(base_url, endpoint, method, data, log, keep_alive, max_keepalive, ids,
+                                    backoff, breaker)
+              for endpoint, method, data in endpoints]
+    try:
+        for index, (stage, start_level) in enumerate(with_start_levels(stages)):
+            started = time.perf_counter()
+            ends = started + stage.duration
+
+            def rate_at(t, stage=stage, start_level=start_level, started=started):
+                return stage.level(start_level, t - started)
+
+            for group in groups:
+                group.retarget(stage_stats[index])
+                if stage.open_loop:
+                    group.resize(0, stage.max_in_flight)
+                    if group.next_due == math.inf:
+                        group.next_due = next_arrival(started, rate_at, ends)
+                else:
+                    group.next_due = math.inf
+
+            now = started
+            while now < ends:
+                wake = min(now + CONTROL_INTERVAL, ends)
+                for group in groups:
+                    if stage.open_loop:
+                        wake = min(wake, group.schedule(now, rate_at, ends))
+                    else:
+                        group.resize(round(stage.level(start_level, now - started)), 0)
+                await asyncio.sleep(max(wake - time.perf_counter(), 0))
+                now = time.perf_counter()
+            if stage_done is not None:
+                stage_done(index)
+    finally:
+        tasks = []
+        for group in groups:
+            tasks.extend(group.stop())
+        if tasks:
+            _, unfinished = await asyncio.wait(tasks, timeout=SHUTDOWN_GRACE)
+            for task in unfinished:
+                task.cancel()
@@ -0,0 +1,279 @@
+"""
+Self-overhead benchmarks for simulate_traffic.py's load generator.
+
+Each case runs one engine/option combination closed-loop against a local
+todo_server.py stand-in with no injected latency, so the generator rather
+than the backend is the bottleneck. Every case gets a fresh stand-in in its own
+processes and runs in a fresh process of its own, so the numbers are the
+generator's alone:
+
+    req/s          requests per wall-clock second
+    req/CPU-s      requests per CPU-second of the generator, i.e. the most one core can drive
+    us/req         generator CPU time per request
+    KB/VU          peak memory added per virtual user (worker)
+
+A short unmeasured warm-up stage comes first. --save writes the results as
+JSON; --compare checks a run against such a baseline and exits with status 1
+if any case lost more than --tolerance of its req/CPU-s or grew more than
+--memory-tolerance in memory per user.
+
+    python bench_generator.py --save baseline.json
+    python bench_generator.py --compare baseline.json --case async-pooled
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+from load_stats import RunStats
+from payloads import Choice, Sequence
+from simulate_traffic import run_stages, scenario_endpoints
+from stages import SHUTDOWN_GRACE, Stage, parse_duration
+from todo_server import TodoServer
+
+BASELINE_VERSION = 1
+STAND_IN_CAPACITY = 50  # Tasks the stand-in keeps, so the listing after each POST stays small
+
+# Fixed IDs and bodies: every request is answered, none depends on an earlier one
+static_endpoints = [
+    ('/todos/1', 'GET', None),
+    ('/todos', 'POST', {'title': 'Send in the Storm Troopers', 'description': 'Resistance is futile'}),
+    ('/todos/1', 'PUT', {'is_done': True}),
+]
+
+# The same requests with a body slot filled in per request
+templated_endpoints = [
+    ('/todos/1', 'GET', None),
+    ('/todos', 'POST', {'title': Sequence('Send in the Storm Troopers #'), 'description': 'Resistance is futile'}),
+    ('/todos/1', 'PUT', {'is_done': Choice(True, False)}),
+]
+
+
+class Case(collections.namedtuple('Case', 'name endpoints options')):
+    """
+    One benchmark: a workload and the run_stages options it runs with.
+    """
+    __slots__ = ()
+
+
+def _cases(workdir):
+    return [
+        Case('threads-new', static_endpoints, {'engine': 'threads'}),
+        Case('threads-pooled', static_endpoints, {'engine': 'threads', 'pooled': True}),
+        Case('async-new', static_endpoints, {'engine': 'async'}),
+        Case('async-pooled', static_endpoints, {'engine': 'async', 'pooled': True}),
+        Case('raw-new', static_endpoints, {'engine': 'raw'}),
+        Case('raw-pooled', static_endpoints, {'engine': 'raw', 'pooled': True}),
+        Case('raw-pooled-pipeline8', static_endpoints, {'engine': 'raw', 'pooled': True, 'pipeline': 8}),
+        Case('raw-pooled-phases', static_endpoints, {'engine': 'raw', 'pooled': True, 'phases': True}),
+        Case('threads-pooled-templated', templated_endpoints, {'engine': 'threads', 'pooled': True}),
+        Case('async-pooled-templated', templated_endpoints, {'engine': 'async', 'pooled': True}),
+        # A small ID pool only holds tasks the stand-in has not evicted yet
+        Case('async-pooled-track-ids', scenario_endpoints,
+             {'engine': 'async', 'pooled': True, 'track_ids': True, 'id_pool_size': STAND_IN_CAPACITY // 2}),
+        Case('async-pooled-status', static_endpoints,
+             {'engine': 'async', 'pooled': True, 'status_interval': 1.0, 'verbose': 100}),
+        Case('async-pooled-metrics', static_endpoints,
+             {'engine': 'async', 'pooled': True, 'metrics_file': os.path.join(workdir, 'metrics.jsonl')}),
+        Case('async-pooled-results', static_endpoints,
+             {'engine': 'async', 'pooled': True, 'results_file': os.path.join(workdir, 'results.bin')}),
+    ]
+
+
+def _rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return _peak_rss_kb()  # No /proc: the peak so far is the closest there is
+
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # Bytes on macOS, KB elsewhere
+
+
+def _run_case(case, base_url, users, warmup, duration, results):
+    # Runs in a fresh process; status and request lines cost the same written to /dev/null
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    stages = [Stage(warmup, users=users), Stage(duration, users=users)]
+    stage_stats = [RunStats() for _ in stages]
+    options = dict({'status_interval': 0}, **case.options)
+    marks = {}
+    rss_before = _rss_kb()
+
+    def on_stage_end(index):
+        marks[index] = (time.monotonic(), time.process_time())
+
+    marks[-1] = (time.monotonic(), time.process_time())
+    run_stages(base_url, case.endpoints, stages, stage_stats, report=False, on_stage_end=on_stage_end, **options)
+    (started, cpu_started), (ended, cpu_ended) = marks[0], marks[1]
+    measured = stage_stats[1].merged()
+    requests = measured.total_requests()
+    cpu = max(cpu_ended - cpu_started, 1e-9)
+    virtual_users = users * len(case.endpoints)
+    results.put({
+        'requests': requests,
+        'errors': measured.total_errors(),
+        'rps': requests / max(ended - started, 1e-9),
+        'rps_per_core': requests / cpu,
+        'cpu_us_per_request': 1e6 * cpu / requests if requests else None,
+        'memory_kb_per_vu': max(_peak_rss_kb() - rss_before, 0) / virtual_users,
+        'virtual_users': virtual_users,
+    })
+
+
+def run_case(case, base_url, users, warmup, duration):
+    """
+    Runs one case in a new process.
+
+    Returns:
+        dict: The case's measurements (see the module docstring), or None if the process failed.
+    """
+    context = multiprocessing.get_context('fork')  # The case's endpoints need no pickling
+    results = context.Queue()
+    process = context.Process(target=_run_case, args=(case, base_url, users, warmup, duration, results))
+    process.start()
+    try:
+        return results.get(timeout=warmup + duration + SHUTDOWN_GRACE + 30)
+    except queue.Empty:
+        return None
+    finally:
+        process.join()
+
+
+def compare(results, baseline, tolerance, memory_tolerance):
+    """
+    Returns the regressions of `results` against a saved baseline.
+
+    Args:
+        results (dict): Case name -> measurements.
+        baseline (dict): A loaded --save file.
+        tolerance (float): Largest acceptable relative loss of req/CPU-s.
+        memory_tolerance (float): Largest acceptable relative growth of memory per virtual user.
+
+    Returns:
+        list: One message per regression.
+    """
+    regressions = []
+    for name, measured in sorted(results.items()):
+        before = baseline['cases'].get(name)
+        if before is None or measured is None:
+            continue
+        if measured['rps_per_core'] < before['rps_per_core'] * (1 - tolerance):
+            regressions.append(f"{name}: {measured['rps_per_core']:.0f} req/CPU-s, baseline "
+                               f"{before['rps_per_core']:.0f} ({_change(measured['rps_per_core'], before['rps_per_core'])})")
+        # A few KB of slack: tiny per-user numbers are mostly allocator noise
+        if measured['memory_kb_per_vu'] > before['memory_kb_per_vu'] * (1 + memory_tolerance) + 4:
+            regressions.append(f"{name}: {measured['memory_kb_per_vu']:.1f} KB/VU, baseline "
+                               f"{before['memory_kb_per_vu']:.1f}")
+    return regressions
+
+
+def _change(now, before):
+    return f"{100.0 * (now - before) / before:+.1f}%" if before else '-'
+
+
+def print_results(results, baseline=None):
+    print(f"\n{'case':<28}{'req/s':>10}{'req/CPU-s':>11}{'us/req':>9}{'KB/VU':>9}{'errors':>8}"
+          + (f"{'vs baseline':>13}" if baseline else ''))
+    for name, measured in results.items():
+        if measured is None:
+            print(f"{name:<28}  failed")
+            continue
+        line = (f"{name:<28}{measured['rps']:>10.0f}{measured['rps_per_core']:>11.0f}"
+                f"{measured['cpu_us_per_request'] or 0:>9.1f}{measured['memory_kb_per_vu']:>9.1f}"
+                f"{measured['errors']:>8}")
+        before = (baseline or {}).get('cases', {}).get(name)
+        if before is not None:
+            line += f"{_change(measured['rps_per_core'], before['rps_per_core']):>13}"
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure the load generator's own overhead per engine and option.")
+    parser.add_argument('--case', action='append', dest='cases', metavar='NAME',
+                        help="run only this case (repeatable, see --list)")
+    parser.add_argument('--list', action='store_true', help="list the cases and exit")
+    parser.add_argument('--users', type=int, default=20,
+                        help="closed-loop workers per endpoint (default: %(default)s)")
+    parser.add_argument('--duration', type=parse_duration, default=10.0, metavar='DURATION',
+                        help="measured time per case (default: %(default)ss)")
+    parser.add_argument('--warmup', type=parse_duration, default=2.0, metavar='DURATION',
+                        help="unmeasured time before each measurement (default: %(default)ss)")
+    parser.add_argument('--server-workers', type=int, default=max((os.cpu_count() or 2) // 2, 1),
+                        help="stand-in server processes (default: half the CPUs, %(default)s here)")
+    parser.add_argument('--save', metavar='PATH', help="write the results to this JSON baseline file")
+    parser.add_argument('--compare', metavar='PATH',
+                        help="compare against this baseline and exit with status 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="largest acceptable loss of req/CPU-s against the baseline (default: %(default)s)")
+    parser.add_argument('--memory-tolerance', type=float, default=0.25,
+                        help="largest acceptable growth of KB/VU against the baseline (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix='bench_generator_') as workdir:
+        cases = _cases(workdir)
+        if args.list:
+            for case in cases:
+                print(f"{case.name:<28}{case.options}")
+            return
+        if args.cases:
+            unknown = set(args.cases) - {case.name for case in cases}
+            if unknown:
+                sys.exit(f"Unknown case(s): {', '.join(sorted(unknown))}; see --list")
+            cases = [case for case in cases if case.name in args.cases]
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+
+        results = {}
+        print(f"Benchmarking {len(cases)} generator cases against a stand-in with {args.server_workers} "
+              f"worker processes ({args.users} workers per endpoint, {args.duration:g}s each)")
+        try:
+            for case in cases:
+                print(f"  {case.name}", flush=True)
+                # A fresh stand-in per case, so tasks one case deletes are there for the next
+                with TodoServer(workers=args.server_workers, capacity=STAND_IN_CAPACITY) as server:
+                    results[case.name] = run_case(case, server.base_url, args.users, args.warmup, args.duration)
+        except KeyboardInterrupt:
+            print("\nBenchmark stopped early. The Empire retreats.")
+    print_results(results, baseline)
+
+    if args.save:
+        report = {'version': BASELINE_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': platform.python_version(), 'platform': platform.platform(),
+                  'cpu_count': os.cpu_count(),
+                  'settings': {'users': args.users, 'duration': args.duration, 'warmup': args.warmup,
+                               'server_workers': args.server_workers},
+                  'cases': {name: measured for name, measured in results.items() if measured is not None}}
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline written to {args.save}")
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.compare}:")
+            for message in regressions:
+                print(f"  {message}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.compare}.")
+
+
+if __name__ == '__main__':
+    main()
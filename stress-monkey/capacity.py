@@ -0,0 +1,218 @@
+"""
+Capacity search for simulate_traffic.py: the highest open-loop rate the backend
+sustains while meeting an SLO.
+
+Each level offers a fixed rate per endpoint in consecutive measurement windows
+and is held until the last STEADY_WINDOWS windows agree (or the hold time runs
+out); only those windows are judged against the SLO. The rate doubles until a
+level fails, then a binary search between the last passing and first failing
+rate narrows it down to the requested precision. Latency is measured from the
+scheduled send time, so a backend that falls behind fails on p99 instead of
+quietly lowering the offered load.
+
+Only requests without a response and 5xx responses count against the error
+objective: a 4xx is the API answering (DELETE /todos/2 of stress_endpoints is
+a 404 after the first one), not the backend running out of capacity.
+"""
+import collections
+
+from load_stats import RunStats, format_ms
+from stages import Stage
+
+STEADY_WINDOWS = 3  # Consecutive windows that must agree before a level is judged
+THROUGHPUT_TOLERANCE = 0.1  # Most relative spread of throughput between steady windows
+P99_TOLERANCE = 0.25  # Most relative spread of p99 between steady windows, unless all pass or all fail
+
+
+class SLO(collections.namedtuple('SLO', 'p99 error_rate')):
+    """
+    A service level objective.
+
+    Args:
+        p99 (float): The highest acceptable p99 latency in seconds.
+        error_rate (float): The highest acceptable fraction of requests without a response or with a 5xx.
+    """
+    __slots__ = ()
+
+    def check(self, stats):
+        """
+        Returns the reasons `stats` misses the objective (an empty list if it meets it).
+        """
+        reasons = []
+        total = stats.total_requests()
+        if not total:
+            return ['no requests completed']
+        error_rate = stats.total_server_errors() / total
+        if error_rate > self.error_rate:
+            reasons.append(f"errors {100 * error_rate:.2f}% > {100 * self.error_rate:g}%")
+        p99 = worst_p99(stats)
+        if p99 is not None and p99 > self.p99:
+            reasons.append(f"p99 {p99 * 1000:.1f}ms > {self.p99 * 1000:g}ms")
+        return reasons
+
+    def describe(self):
+        return f"p99 < {self.p99 * 1000:g}ms, failed/5xx < {100 * self.error_rate:g}%"
+
+
+Level = collections.namedtuple('Level', 'rate stats elapsed windows steady failures')
+
+
+def worst_p99(stats):
+    """
+    Returns the p99 latency of the slowest endpoint in `stats`, None without requests.
+
+    The worst endpoint decides: one slow endpoint is enough to break the SLO.
+    """
+    values = [counters.percentile(99) for counters in stats.endpoints.values()]
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def _merge(stats_list):
+    merged = RunStats()
+    for stats in stats_list:
+        merged.merge(stats)
+    return merged
+
+
+def _steady(windows, window, slo):
+    throughputs = [stats.total_requests() / window for stats in windows]
+    if not min(throughputs) or max(throughputs) > min(throughputs) * (1 + THROUGHPUT_TOLERANCE):
+        return False
+    p99s = [worst_p99(stats) or 0.0 for stats in windows]
+    if all(p99 <= slo.p99 for p99 in p99s) or all(p99 > slo.p99 for p99 in p99s):
+        return True
+    return max(p99s) <= min(p99s) * (1 + P99_TOLERANCE)
+
+
+class _LevelSettled(Exception):
+    def __init__(self, index, measured):
+        super().__init__(index)
+        self.index = index
+        self.measured = measured
+
+
+def run_level(run, rate, slo, window, hold, in_flight):
+    """
+    Offers one rate until its results are steady, and judges it against the SLO.
+
+    Args:
+        run (callable): Runs a profile: run(stages, stage_stats, on_stage_end), e.g. a wrapper
+            around simulate_traffic.run_stages.
+        rate (float): Requests per second per endpoint.
+        slo (SLO): The objective to judge the level by.
+        window (float): Seconds per measurement window.
+        hold (float): The longest time to hold the level.
+        in_flight (int): The most requests in flight per endpoint.
+
+    Returns:
+        Level: The rate, the merged stats of the steady windows, and the verdict.
+    """
+    count = max(int(hold // window), STEADY_WINDOWS)
+    stages = [Stage(window, users=in_flight, rate=rate)] * count
+    stage_stats = [RunStats() for _ in stages]
+
+    def settle(index):
+        if index + 1 < STEADY_WINDOWS:
+            return
+        # Snapshot now: requests still queued when the level is cut short are counted afterwards
+        recent = [stats.merged() for stats in stage_stats[index + 1 - STEADY_WINDOWS:index + 1]]
+        if _steady(recent, window, slo):
+            raise _LevelSettled(index, recent)
+
+    try:
+        run(stages, stage_stats, settle)
+    except _LevelSettled as settled:
+        return Level(rate, _merge(settled.measured), (settled.index + 1) * window, settled.index + 1, True,
+                     slo.check(_merge(settled.measured)))
+    measured = _merge(stage_stats[-STEADY_WINDOWS:])
+    return Level(rate, measured, count * window, count, False, slo.check(measured))
+
+
+def search_capacity(run, slo, start_rate, max_rate, precision=0.05, window=5.0, hold=60.0, in_flight=100,
+                    level_done=None):
+    """
+    Finds the highest rate per endpoint that meets the SLO.
+
+    Args:
+        run (callable): Runs a profile, see `run_level`.
+        slo (SLO): The objective.
+        start_rate (float): The first rate to try, in requests per second per endpoint.
+        max_rate (float): Never offer more than this.
+        precision (float, optional): Stop once the failing rate is within this fraction of the
+            passing one (default is 0.05).
+        window (float, optional): Seconds per measurement window (default is 5).
+        hold (float, optional): The longest time to hold one level (default is 60).
+        in_flight (int, optional): The most requests in flight per endpoint (default is 100).
+        level_done (callable, optional): Called with each Level as it is judged.
+
+    Returns:
+        tuple: (the highest passing Level or None, list of every Level tried)
+    """
+    levels = []
+    best = None
+    failed = None
+
+    def attempt(rate):
+        level = run_level(run, rate, slo, window, hold, in_flight)
+        levels.append(level)
+        if level_done is not None:
+            level_done(level)
+        return level
+
+    rate = start_rate
+    while rate <= max_rate:
+        level = attempt(rate)
+        if level.failures:
+            failed = level
+            break
+        best = level
+        if rate == max_rate:
+            break
+        rate = min(rate * 2, max_rate)
+    if failed is None:
+        return best, levels
+
+    low = best.rate if best is not None else 0.0
+    high = failed.rate
+    while high - low > max(low, start_rate) * precision:
+        rate = (low + high) / 2
+        level = attempt(rate)
+        if level.failures:
+            high = rate
+        else:
+            low = rate
+            best = level
+    return best, levels
+
+
+def print_level(level, endpoints):
+    """
+    Prints one judged level as a row under `print_capacity_header`.
+
+    Args:
+        level (Level): The level.
+        endpoints (list): The scheduled (endpoint, method, data) tuples; only their requests count
+            as achieved, not the GET and PUT sent after each POST.
+    """
+    scheduled = {(method, endpoint) for endpoint, method, _ in endpoints}
+    achieved = sum(counters.requests for key, counters in level.stats.endpoints.items() if key in scheduled)
+    total = level.stats.total_requests()
+    seconds = STEADY_WINDOWS * level.elapsed / level.windows  # Only the steady windows are measured
+    errors = 100.0 * level.stats.total_server_errors() / total if total else 0.0
+    verdict = 'pass' if not level.failures else 'FAIL: ' + ', '.join(level.failures)
+    print(f"{level.rate:>10.1f}{level.rate * len(endpoints):>11.1f}{achieved / max(seconds, 1e-9):>11.1f}"
+          f"{format_ms(worst_p99(level.stats)):>9}{errors:>9.2f}{level.elapsed:>8.0f}s"
+          f"{'' if level.steady else '*':<2}{verdict}")
+
+
+def print_capacity_header(slo):
+    print(f"\nCapacity search ({slo.describe()}, latencies in ms, * = not steady within the hold time)")
+    print(f"{'req/s/ep':>10}{'offered':>11}{'achieved':>11}{'p99':>9}{'fail %':>9}{'held':>9}  verdict")
+
+
+def parse_slo(p99_ms, error_percent):
+    """
+    Builds an SLO from command-line units (milliseconds and percent).
+    """
+    return SLO(p99_ms / 1000.0, error_percent / 100.0)
@@ -0,0 +1,548 @@
+"""
+Distributed load generation: one coordinator, any number of agents.
+
+Start an agent on every load box (several per box to use more cores; each
+agent is one process):
+
+    STRESS_MONKEY_TOKEN=secret python distributed.py --serve 0.0.0.0:7700
+
+then run the coordinator with the usual simulate_traffic.py options and one
+--agent per agent, with the same token:
+
+    STRESS_MONKEY_TOKEN=secret python distributed.py --agent box1:7700 --agent box2:7700 --stage 5m:200:linear --engine async --pooled
+
+The coordinator connects to every agent, measures its clock offset, and
+pushes the workload: base URL, endpoint set (or session model), run options,
+and the agent's share of every stage, split the way --processes splits them.
+Every agent starts at the same wall-clock moment, corrected for its clock
+offset, and streams a snapshot of its stats for the running stage every
+second. Histograms are mergeable, so the coordinator prints live status lines
+and the stage and run summaries for all agents together as if one generator
+had sent every request. --metrics-file and --metrics-port on the coordinator
+get the combined time series; on an agent, --results-file and --metrics-*
+apply to that agent alone.
+
+Messages are JSON objects, each preceded by its length as a 4-byte big-endian
+integer. Agents run whatever a coordinator sends them, so an agent listens on
+127.0.0.1 unless told otherwise and needs a shared token (--token or
+STRESS_MONKEY_TOKEN): a coordinator's first message must be a hello carrying
+it, or the agent drops the connection. The token is sent in the clear; on an
+untrusted network, reach the agents through an SSH tunnel or a VPN.
+"""
+import _thread
+import copy
+import hmac
+import json
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+
+import payloads
+from load_stats import RunStats, RunTimer, print_phase_growth, print_summary
+from metrics import MetricsRecorder
+from reporter import StatusReporter
+from resilience import Backoff, BreakerPolicy
+from server_stats import ServerStatsScraper
+from sessions import SessionModel, ThinkTime, todo_session_model
+from simulate_traffic import (build_parser, options_from_args, parse_args, profile_from_args, run_stages,
+                              scenario_endpoints, start_stand_in, stress_endpoints)
+from stages import Stage, shard_stage
+
+DEFAULT_PORT = 7700
+PROTOCOL_VERSION = 5
+TOKEN_ENV = 'STRESS_MONKEY_TOKEN'  # Environment variable with the shared token, if --token is not given
+STREAM_INTERVAL = 1.0  # Seconds between stats snapshots from an agent
+START_DELAY = 2.0  # Seconds between the start message and the synchronized start
+CLOCK_PROBES = 5  # Clock round trips per agent; the fastest one is used
+CONNECT_TIMEOUT = 10.0
+HELLO_LIMIT = 4096  # Bytes in a hello, read before the peer has shown its token
+# Options an agent takes from the coordinator; output files and ports are the agent's own
+PUSHED_OPTIONS = ('engine', 'verbose', 'pooled', 'pool_size', 'max_keepalive', 'track_ids', 'id_pool_size',
+                  'backoff', 'breaker', 'pipeline', 'phases')
+
+_LENGTH = struct.Struct('!I')
+
+
+def send_message(sock, message):
+    """
+    Sends one length-prefixed JSON message.
+    """
+    data = json.dumps(message).encode()
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def recv_message(reader, limit=None):
+    """
+    Reads one message from a socket's binary file object.
+
+    Args:
+        reader: The socket's binary file object.
+        limit (int, optional): The largest message accepted, in bytes (default is no limit).
+
+    Returns:
+        dict: The message, or None if the peer closed the connection.
+
+    Raises:
+        ValueError: If the message is longer than `limit` or not JSON.
+    """
+    head = reader.read(_LENGTH.size)
+    if len(head) < _LENGTH.size:
+        return None
+    (length,) = _LENGTH.unpack(head)
+    if limit is not None and length > limit:
+        raise ValueError(f"Message of {length} bytes, more than {limit}")
+    data = reader.read(length)
+    if len(data) < length:
+        return None
+    return json.loads(data)
+
+
+def parse_address(text, default_host='127.0.0.1'):
+    """
+    Parses 'HOST:PORT', ':PORT' or 'PORT' into (host, port).
+    """
+    host, _, port = text.rpartition(':')
+    return host or default_host, int(port) if port else DEFAULT_PORT
+
+
+# Agent side
+
+
+class _AgentRun:
+    # One workload run for a coordinator: streams snapshots while run_stages works in the main thread
+    def __init__(self, sock, workload):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.stages = [Stage(*stage) for stage in workload['stages']]
+        self.stage_stats = [RunStats() for _ in self.stages]
+        self.current = 0
+        self.timer = RunTimer()
+        self.running = False
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()  # Guards `running`, so a stop never interrupts anything but the run
+
+    def send(self, message):
+        with self.send_lock:
+            send_message(self.sock, message)
+
+    def stage_done(self, index, interrupted=False):
+        self.send({'type': 'stage', 'stage': index, 'stats': self.stage_stats[index].to_dict(),
+                   'elapsed': self.timer.elapsed(), 'cpu': self.timer.cpu_seconds(), 'interrupted': interrupted})
+        self.timer = RunTimer()
+        self.current = index + 1
+
+    def stream(self):
+        while not self.stopped.wait(STREAM_INTERVAL):
+            index = self.current
+            if index < len(self.stages):
+                try:
+                    self.send({'type': 'stats', 'stage': index, 'stats': self.stage_stats[index].to_dict()})
+                except OSError:
+                    return
+
+    def listen(self, reader):
+        # A stop message or a lost coordinator ends the run early
+        while not self.stopped.is_set():
+            try:
+                message = recv_message(reader)
+            except (OSError, ValueError):
+                message = None
+            if message is None or message.get('type') == 'stop':
+                with self.lock:
+                    if self.running:
+                        self.running = False
+                        _thread.interrupt_main()
+                return
+
+
+def _agent_endpoints(workload):
+    sessions = workload.get('sessions')
+    if sessions is None:
+        return (scenario_endpoints if workload['endpoints'] == 'scenario' else stress_endpoints), None
+    model = sessions['model']
+    if model == 'todo':
+        model = copy.copy(todo_session_model)  # The think time below is this run's alone
+    else:
+        model = SessionModel.from_dict(model, name=sessions['name'])
+    if sessions.get('think') is not None:
+        model.think = ThinkTime(*sessions['think'])
+    return stress_endpoints, model
+
+
+def serve_agent(host, port, options, token):
+    """
+    Runs an agent: waits for coordinators and runs their workloads, one at a time, until Ctrl-C.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+        options (dict): Local run_stages options (output files and metrics port) added to every workload.
+        token (str): The shared token a coordinator must send in its hello.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    print(f"Agent listening on {host}:{server.getsockname()[1]}. Press Ctrl-C to stop.", flush=True)
+    try:
+        while True:
+            sock, peer = server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with sock, sock.makefile('rb') as reader:
+                try:
+                    _serve_coordinator(sock, reader, peer, options, token)
+                except (OSError, ValueError) as e:
+                    print(f"Coordinator {peer[0]}:{peer[1]} lost: {e!r}. Lost in hyperspace.", flush=True)
+                finally:
+                    _shutdown(sock)
+    except KeyboardInterrupt:
+        print("\nAgent stopped.")
+    finally:
+        server.close()
+
+
+def _shutdown(sock):
+    # Wakes any thread still blocked reading the socket, so its file object can be closed
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _authenticated(message, token):
+    sent = message.get('token') if isinstance(message, dict) and message.get('type') == 'hello' else None
+    return isinstance(sent, str) and hmac.compare_digest(sent.encode(), token.encode())
+
+
+def _serve_coordinator(sock, reader, peer, options, token):
+    sock.settimeout(CONNECT_TIMEOUT)  # A peer without a token does not get to hold the agent
+    message = recv_message(reader, limit=HELLO_LIMIT)
+    if message is None:
+        return
+    if not _authenticated(message, token):
+        print(f"Rejected {peer[0]}:{peer[1]}: no valid token in its hello. These aren't the droids you're "
+              "looking for.", flush=True)
+        send_message(sock, {'type': 'error', 'message': "Missing or wrong token"})
+        return
+    sock.settimeout(None)
+    while True:
+        kind = message.get('type')
+        if kind == 'hello':
+            send_message(sock, {'type': 'hello', 'version': PROTOCOL_VERSION, 'host': socket.gethostname()})
+        elif kind == 'clock':
+            send_message(sock, {'type': 'clock', 'time': time.time()})
+        elif kind == 'run':
+            _run_workload(sock, reader, peer, message, options)
+            return
+        else:
+            send_message(sock, {'type': 'error', 'message': f"Unknown message type {kind!r}"})
+        message = recv_message(reader)
+        if message is None:
+            return
+
+
+def _run_workload(sock, reader, peer, workload, options):
+    run = _AgentRun(sock, workload)
+    endpoints, sessions = _agent_endpoints(workload)
+    payloads.process_tag = f"a{workload['agent']}-"  # Unique slot values across agents
+    run_options = dict(options, status_interval=0, sessions=sessions,
+                       **{name: workload['options'][name] for name in PUSHED_OPTIONS})
+    # The policies arrive as JSON lists
+    for name, policy in (('backoff', Backoff), ('breaker', BreakerPolicy)):
+        if run_options[name] is not None:
+            run_options[name] = policy(*run_options[name])
+    print(f"Running agent {workload['agent']} share of {len(run.stages)} stage(s) for {peer[0]} "
+          f"against {workload['base_url']}", flush=True)
+    threading.Thread(target=run.listen, args=(reader,), daemon=True).start()
+    streamer = threading.Thread(target=run.stream, daemon=True)
+    interrupted = False
+    try:
+        with run.lock:
+            run.running = True
+        time.sleep(max(workload['start_at'] - time.time(), 0))
+        run.timer = RunTimer()
+        streamer.start()
+        run_stages(workload['base_url'], endpoints, run.stages, run.stage_stats, report=False,
+                   on_stage_end=run.stage_done, **run_options)
+        with run.lock:
+            run.running = False
+    except KeyboardInterrupt:
+        interrupted = True
+        with run.lock:
+            run.running = False
+    except Exception as e:
+        with run.lock:
+            run.running = False
+        print(f"Agent run failed: {e!r}", flush=True)
+        run.send({'type': 'error', 'message': repr(e)})
+    run.stopped.set()
+    if interrupted and run.current < len(run.stages):
+        run.stage_done(run.current, interrupted=True)
+    run.send({'type': 'done'})
+    print("Agent run finished." if not interrupted else "Agent run stopped early.", flush=True)
+
+
+# Coordinator side
+
+
+class _AgentLink:
+    """
+    The coordinator's connection to one agent.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.name = f"{address[0]}:{address[1]}"
+        self.sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        self.offset = 0.0  # Agent clock minus coordinator clock
+        self.rtt = 0.0
+        self.cpu_seconds = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def request(self, message):
+        send_message(self.sock, message)
+        reply = recv_message(self.reader)
+        if reply is None:
+            raise ConnectionError(f"Agent {self.name} closed the connection")
+        if reply.get('type') == 'error':
+            raise ConnectionError(f"Agent {self.name}: {reply['message']}")
+        return reply
+
+    def sync_clock(self):
+        best = None
+        for _ in range(CLOCK_PROBES):
+            sent = time.time()
+            reply = self.request({'type': 'clock'})
+            received = time.time()
+            if best is None or received - sent < best[0]:
+                best = (received - sent, reply['time'] - (sent + received) / 2)
+        self.rtt, self.offset = best
+
+    def read_into(self, messages):
+        # Feeds every message from the agent to the coordinator's queue, then None when it is gone
+        self.sock.settimeout(None)
+        try:
+            while True:
+                message = recv_message(self.reader)
+                if message is None:
+                    break
+                messages.put((self, message))
+        except (OSError, ValueError):
+            pass
+        messages.put((self, None))
+
+    def stop(self):
+        try:
+            send_message(self.sock, {'type': 'stop'})
+        except OSError:
+            pass
+
+    def close(self):
+        _shutdown(self.sock)
+        self.reader.close()
+        self.sock.close()
+
+
+class _LiveStats:
+    # The running stage's latest snapshot from every agent, merged on demand for the StatusReporter
+    def __init__(self):
+        self.snapshots = {}
+
+    def merged(self):
+        merged = RunStats()
+        for snapshot in list(self.snapshots.values()):
+            merged.merge(snapshot)
+        return merged
+
+
+def run_coordinated(addresses, base_url, endpoints_name, stages, options, token, report=True):
+    """
+    Runs a staged profile across agents, with every stage split between them, and prints combined results.
+
+    Args:
+        addresses (list): (host, port) of every agent.
+        base_url (str): The base URL of the API, as the agents reach it.
+        endpoints_name (str): 'stress' or 'scenario', the endpoint set the agents run.
+        stages (list): The Stage list of the profile, with totals across all agents.
+        options (dict): The run_stages options; the agents get the PUSHED_OPTIONS and the session
+            model, the coordinator uses status_interval and metrics_file/metrics_port for the combined stats.
+        token (str): The shared token the agents were started with.
+        report (bool, optional): Print a summary as each stage ends (default is True).
+
+    Returns:
+        tuple: (list of merged RunStats per stage, CPU seconds used by all agents, the _AgentLink list)
+    """
+    links = []
+    try:
+        for address in addresses:
+            link = _AgentLink(address)
+            links.append(link)
+            hello = link.request({'type': 'hello', 'token': token})
+            if hello.get('version') != PROTOCOL_VERSION:
+                raise ConnectionError(f"Agent {link.name} speaks protocol {hello.get('version')}, "
+                                      f"not {PROTOCOL_VERSION}")
+            link.sync_clock()
+    except (OSError, ValueError):
+        for link in links:
+            link.close()
+        raise
+    skew = max(link.rtt for link in links) / 2
+    print(f"{len(links)} agents connected; clocks synchronized within {skew * 1000:.1f}ms", flush=True)
+
+    sessions = options.get('sessions')
+    start_at = time.time() + START_DELAY
+    for index, link in enumerate(links):
+        workload = {'type': 'run', 'agent': index, 'base_url': base_url, 'endpoints': endpoints_name,
+                    'stages': [list(shard_stage(stage, len(links), index)) for stage in stages],
+                    'options': {name: options.get(name) for name in PUSHED_OPTIONS},
+                    'start_at': start_at + link.offset}
+        if sessions is not None:
+            workload['sessions'] = {'model': sessions.source or 'todo', 'name': sessions.name,
+                                    'think': list(sessions.think)}
+        send_message(link.sock, workload)
+
+    messages = queue.Queue()
+    for link in links:
+        threading.Thread(target=link.read_into, args=(messages,), daemon=True).start()
+    metrics = None
+    if options.get('metrics_file') or options.get('metrics_port') is not None:
+        metrics = MetricsRecorder(options.get('metrics_file'), options.get('metrics_port'))
+    reporter = StatusReporter(options.get('status_interval', 0), metrics=metrics)
+    stage_stats = [RunStats() for _ in stages]
+    live = [_LiveStats() for _ in stages]
+    finished = [{} for _ in stages]  # Stage index -> {link: (elapsed, cpu, interrupted)}
+    time.sleep(max(start_at - time.time(), 0))
+    reporter.watch(live[0])
+    reporter.start()
+    pending = set(links)
+    stopping = False
+    try:
+        while pending:
+            try:
+                link, message = messages.get(timeout=1)
+            except queue.Empty:
+                continue
+            except KeyboardInterrupt:
+                if stopping:
+                    raise
+                stopping = True
+                print("\nStopping agents. The Empire retreats.", flush=True)
+                for link in pending:
+                    link.stop()
+                continue
+            kind = message and message.get('type')
+            if kind is None or kind == 'done':
+                if kind is None and link in pending:
+                    print(f"Agent {link.name} disconnected. Lost in hyperspace.", flush=True)
+                pending.discard(link)
+            elif kind == 'error':
+                print(f"Agent {link.name} failed: {message['message']}", flush=True)
+            elif kind == 'stats':
+                live[message['stage']].snapshots[link] = RunStats.from_dict(message['stats'])
+            elif kind == 'stage':
+                index = message['stage']
+                stats = RunStats.from_dict(message['stats'])
+                live[index].snapshots[link] = stats
+                stage_stats[index].merge(stats)
+                link.requests += stats.total_requests()
+                link.errors += stats.total_errors()
+                link.cpu_seconds += message['cpu']
+                finished[index][link] = (message['elapsed'], message['cpu'], message['interrupted'])
+                if len(finished[index]) == len(links):
+                    _stage_complete(index, stages, stage_stats, live, finished, reporter, report, sessions)
+    finally:
+        reporter.stop()
+        for link in links:
+            link.close()
+    return stage_stats, sum(link.cpu_seconds for link in links), links
+
+
+def _stage_complete(index, stages, stage_stats, live, finished, reporter, report, sessions):
+    if index + 1 < len(stages):
+        reporter.watch(live[index + 1], index + 1)
+    if not report:
+        return
+    results = finished[index].values()
+    described = stages[index].describe() if sessions is None else f"{sessions.describe()}, {stages[index].describe()}"
+    interrupted = ", interrupted" if any(result[2] for result in results) else ''
+    print_summary(stage_stats[index], max(result[0] for result in results), sum(result[1] for result in results),
+                  title=f"Stage {index + 1} summary ({described}, {len(finished[index])} agents{interrupted})")
+
+
+def print_agents(links):
+    """
+    Prints one line per agent, to spot an agent that fell behind the others.
+    """
+    print(f"\n{'agent':<28}{'requests':>10}{'errors':>10}{'CPU s':>9}{'req/CPU-s':>11}")
+    for link in links:
+        print(f"{link.name:<28}{link.requests:>10}{link.errors:>10}{link.cpu_seconds:>9.1f}"
+              f"{link.requests / link.cpu_seconds if link.cpu_seconds else 0:>11.1f}")
+
+
+def main():
+    parser = build_parser()
+    parser.description = "Run a load profile across several agents, or serve as an agent."
+    parser.add_argument('--agent', action='append', dest='agents', type=parse_address, metavar='HOST:PORT',
+                        help=f"coordinate this agent (repeatable; default port {DEFAULT_PORT})")
+    parser.add_argument('--serve', nargs='?', const=f"127.0.0.1:{DEFAULT_PORT}", metavar='[HOST:]PORT',
+                        help=f"run as an agent listening here (default with no value: 127.0.0.1:{DEFAULT_PORT}; "
+                             "give 0.0.0.0:PORT to take coordinators from other hosts); --results-file and "
+                             "--metrics-* apply to this agent's share")
+    parser.add_argument('--token', default=os.environ.get(TOKEN_ENV),
+                        help=f"shared token the agents require from a coordinator (default is ${TOKEN_ENV})")
+    args = parse_args(parser)
+    if bool(args.agents) == bool(args.serve):
+        parser.error("give either --serve to run an agent or at least one --agent to coordinate")
+    if args.agents and (args.replay or args.capacity_search or args.processes or args.recovery):
+        parser.error("--replay, --capacity-search, --processes and --recovery run on one host; drop them with "
+                     "--agent")
+    if not args.token:
+        parser.error(f"give the agents' shared token with --token or {TOKEN_ENV}")
+
+    options = options_from_args(args)
+    if args.serve:
+        host, port = parse_address(args.serve)
+        serve_agent(host, port, {name: options[name] for name in ('metrics_file', 'metrics_port', 'results_file')},
+                    args.token)
+        return
+
+    stages = profile_from_args(args)
+    start_stand_in(args)
+    timer = RunTimer()
+    scraper = None
+    if args.server_stats:
+        scraper = ServerStatsScraper(args.server_stats)
+        scraper.start()
+    running = f"{args.session_model.describe()}, async engine" if args.sessions else f"{args.engine} engine"
+    print(f"Starting Stress Test (Crashing the Server) ({running}, {len(args.agents)} agents)")
+    try:
+        stage_stats, cpu_seconds, links = run_coordinated(args.agents, args.base_url,
+                                                          'scenario' if args.track_ids else 'stress', stages, options,
+                                                          args.token)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot run the agents: {e}. I've got a bad feeling about this.")
+    except KeyboardInterrupt:
+        sys.exit("\nCoordinator stopped before the agents reported.")
+    print_agents(links)
+    if scraper is not None:
+        scraper.stage_end("the run")
+        scraper.stop()
+    if len(stages) > 1:  # A single stage already printed its own summary
+        stats = RunStats()
+        for shard in stage_stats:
+            stats.merge(shard)
+        print_summary(stats, timer.elapsed(), cpu_seconds,
+                      title=f"Stress test summary ({running}, {len(links)} agents)")
+    if args.phases and len(stages) > 1:
+        print_phase_growth(stage_stats, [f"stage {index + 1}" for index in range(len(stages))])
+
+
+if __name__ == '__main__':
+    main()
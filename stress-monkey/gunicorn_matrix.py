@@ -0,0 +1,418 @@
+"""
+Benchmarks variants of the deployed gunicorn_config.py against each other.
+
+Every combination of the --workers, --threads, --worker-class, --backlog and
+--keepalive values is rendered from the Ansible template
+(roles/flask_backend/templates/gunicorn_config.py), started locally with
+gunicorn on the stand-in todo app (todo_app.py) and driven with the same
+workload by simulate_traffic.run_stages: a warm-up stage, then a measured one.
+Memory is the peak resident set of the gunicorn master and its workers, read
+from /proc while the load runs. The variants are printed ranked by throughput.
+
+    python gunicorn_matrix.py --workers 2,4,8 --threads 1,4 --worker-class sync,gthread,gevent \\
+        --engine async --pooled --users 50 --duration 30s --app-latency 5
+
+Needs gunicorn (and gevent for the gevent worker class) in the running Python
+environment; variants whose worker class is not installed are skipped.
+"""
+import argparse
+import collections
+import importlib.util
+import itertools
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from capacity import worst_p99
+from latency_histogram import LatencyHistogram
+from load_stats import RunStats, format_ms
+from simulate_traffic import run_stages, simulate_load_sharded
+from stages import Stage, parse_duration
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TEMPLATE = os.path.join(HERE, '..', 'ansible-project', 'roles', 'flask_backend', 'templates',
+                                'gunicorn_config.py')
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+STARTUP_TIMEOUT = 30.0  # Seconds a variant gets to answer GET /todos
+STOP_TIMEOUT = 10.0  # Seconds to wait for a graceful shutdown before killing it
+MEMORY_INTERVAL = 0.5  # Seconds between RSS samples
+
+_ASSIGNMENT = re.compile(r'^(\w+)\s*=')
+
+# The same mix for every variant: a bounded listing, a write and an update of a seeded task
+matrix_endpoints = [
+    ('/todos', 'GET', None),
+    ('/todos', 'POST', {'title': 'Send in the Storm Troopers', 'description': 'Resistance is futile'}),
+    ('/todos/1', 'PUT', {'is_done': True}),
+]
+
+
+class Variant(collections.namedtuple('Variant', 'workers threads worker_class backlog keepalive')):
+    """
+    One gunicorn configuration of the matrix.
+    """
+    __slots__ = ()
+
+    def settings(self):
+        """
+        Returns the gunicorn settings this variant overrides.
+        """
+        return {'workers': self.workers, 'threads': self.threads, 'worker_class': self.worker_class,
+                'backlog': self.backlog, 'keepalive': self.keepalive}
+
+    def describe(self):
+        threads = f"x{self.threads}" if self.worker_class == 'gthread' else ''
+        return f"{self.worker_class} {self.workers}{threads} bl{self.backlog} ka{self.keepalive}"
+
+
+Result = collections.namedtuple('Result', 'variant stats elapsed memory error')
+
+
+def variants(workers, threads, worker_classes, backlogs, keepalives):
+    """
+    Returns every combination of the given values, leaving out duplicates.
+
+    gunicorn only uses `threads` with the gthread worker (it turns a sync worker with
+    threads into gthread), so the other classes run once with threads=1; the sync worker
+    does not keep connections alive, so it runs with the first keepalive value only.
+    """
+    seen = []
+    for worker_class, count, thread_count, backlog, keepalive in itertools.product(
+            worker_classes, workers, threads, backlogs, keepalives):
+        if worker_class != 'gthread':
+            thread_count = 1
+        if worker_class == 'sync':
+            keepalive = keepalives[0]  # The sync worker closes every connection
+        variant = Variant(count, thread_count, worker_class, backlog, keepalive)
+        if variant not in seen:
+            seen.append(variant)
+    return seen
+
+
+def render_config(template, settings):
+    """
+    Returns the template with each setting's assignment replaced, and missing ones appended.
+
+    Args:
+        template (str): The text of a gunicorn_config.py.
+        settings (dict): Setting name -> Python value.
+
+    Returns:
+        str: The rendered config.
+    """
+    pending = dict(settings)
+    lines = []
+    for line in template.splitlines():
+        match = _ASSIGNMENT.match(line)
+        if match and match.group(1) in pending:
+            name = match.group(1)
+            line = f"{name} = {pending.pop(name)!r}"
+        lines.append(line)
+    if pending:
+        lines.append('')
+        lines.append('# gunicorn_matrix.py variant')
+        lines += [f"{name} = {value!r}" for name, value in pending.items()]
+    return '\n'.join(lines) + '\n'
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The parent PID is the second field after the parenthesised command name
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def tree_rss(pid):
+    """
+    Returns the resident memory in bytes of a process and its children (None without /proc).
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    return _rss_bytes(pid) + sum(_rss_bytes(child) for child in _children(pid))
+
+
+class _MemorySampler:
+    # Tracks the peak RSS of the gunicorn process tree while the load runs
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            rss = tree_rss(self.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            if self.stopped.wait(MEMORY_INTERVAL):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+
+class GunicornServer:
+    """
+    One gunicorn master serving todo_app:app with a rendered config, for use in a `with` block.
+
+    Args:
+        config (str): The rendered gunicorn_config.py text.
+        port (int): The local port to bind.
+        workdir (str): Where to write the config and the server log.
+        app_env (dict, optional): Extra environment for the app, e.g. TODO_APP_LATENCY.
+    """
+
+    def __init__(self, config, port, workdir, app_env=None):
+        self.port = port
+        self.config_path = os.path.join(workdir, f"gunicorn_config_{port}.py")
+        self.log_path = os.path.join(workdir, f"gunicorn_{port}.log")
+        with open(self.config_path, 'w') as f:
+            f.write(config)
+        self.env = dict(os.environ, **(app_env or {}))
+        self.process = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        self.log = open(self.log_path, 'wb')
+        self.process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', self.config_path,
+                                         '--chdir', HERE, 'todo_app:app'],
+                                        stdout=self.log, stderr=subprocess.STDOUT, env=self.env)
+        try:
+            self._wait_ready()
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.process.poll() is None:
+            self.process.terminate()  # SIGTERM: gunicorn's graceful shutdown
+            try:
+                self.process.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {self.process.returncode}:\n{self.log_tail()}")
+            try:
+                with urllib.request.urlopen(f"{self.base_url}/todos", timeout=1) as response:
+                    if response.status == 200:
+                        return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"gunicorn did not answer within {STARTUP_TIMEOUT:g}s:\n{self.log_tail()}")
+
+    def log_tail(self, lines=10):
+        self.log.flush()
+        with open(self.log_path, 'rb') as f:
+            return b'\n'.join(f.read().splitlines()[-lines:]).decode(errors='replace')
+
+
+def run_variant(variant, template, workdir, stages, app_env, processes=0, **options):
+    """
+    Starts one variant, runs the load profile against it and stops it.
+
+    Args:
+        variant (Variant): The configuration to run.
+        template (str): The gunicorn_config.py template text.
+        workdir (str): Where to write rendered configs and server logs.
+        stages (list): The Stage list; only the last stage is measured, the rest are warm-up.
+        app_env (dict): Environment for the stand-in app.
+        processes (int, optional): Spread the load across this many processes (default is 0, in-process).
+        **options: Passed through to `run_stages`.
+
+    Returns:
+        Result: The variant with its measured stats, or the reason it could not run.
+    """
+    port = _free_port()
+    config = render_config(template, dict(variant.settings(), bind=f"127.0.0.1:{port}"))
+    try:
+        with GunicornServer(config, port, workdir, app_env) as server:
+            sampler = _MemorySampler(server.process.pid)
+            try:
+                if processes:
+                    stage_stats, _ = simulate_load_sharded(server.base_url, matrix_endpoints, stages, processes,
+                                                           **options)
+                else:
+                    stage_stats = [RunStats() for _ in stages]
+                    run_stages(server.base_url, matrix_endpoints, stages, stage_stats, report=False, **options)
+            finally:
+                memory = sampler.stop()
+            return Result(variant, stage_stats[-1].merged(), stages[-1].duration, memory, None)
+    except RuntimeError as e:
+        return Result(variant, None, 0.0, None, str(e).splitlines()[0])
+
+
+def _p50(stats):
+    # Across all endpoints; the p99 column is the slowest endpoint's, as in the capacity search
+    merged = LatencyHistogram()
+    for counters in stats.endpoints.values():
+        merged.merge(counters.latency)
+    return merged.percentile(50)
+
+
+def rank(results, key='throughput'):
+    """
+    Returns the results that ran, best first, followed by the ones that could not run.
+
+    Args:
+        results (list): Result tuples.
+        key (str, optional): 'throughput' (highest first), 'p99' or 'memory' (lowest first).
+    """
+    ran = [result for result in results if result.stats is not None]
+    failed = [result for result in results if result.stats is None]
+    if key == 'throughput':
+        ran.sort(key=lambda result: -result.stats.total_requests() / max(result.elapsed, 1e-9))
+    elif key == 'p99':
+        ran.sort(key=lambda result: (worst_p99(result.stats) if worst_p99(result.stats) is not None
+                                     else float('inf')))
+    elif key == 'memory':
+        ran.sort(key=lambda result: result.memory if result.memory is not None else float('inf'))
+    else:
+        raise ValueError(f"Unknown ranking: {key}")
+    return ran + failed
+
+
+def print_ranking(results, key):
+    print(f"\nGunicorn variants ranked by {key} (latencies in ms, p99 = slowest endpoint, memory = peak RSS "
+          f"of master and workers)")
+    print(f"{'#':>3}  {'worker_class':<13}{'workers':>8}{'threads':>8}{'backlog':>8}{'keepalive':>10}"
+          f"{'req/s':>10}{'err %':>8}{'p50':>9}{'p99':>9}{'MB':>8}")
+    for position, result in enumerate(rank(results, key), 1):
+        variant = result.variant
+        head = (f"{position:>3}  {variant.worker_class:<13}{variant.workers:>8}{variant.threads:>8}"
+                f"{variant.backlog:>8}{variant.keepalive:>10}")
+        if result.stats is None:
+            print(f"{head}  skipped: {result.error}")
+            continue
+        total = result.stats.total_requests()
+        errors = 100.0 * result.stats.total_errors() / total if total else 0.0
+        memory = '-' if result.memory is None else f"{result.memory / 1e6:.0f}"
+        print(f"{head}{total / max(result.elapsed, 1e-9):>10.1f}{errors:>8.2f}{format_ms(_p50(result.stats)):>9}"
+              f"{format_ms(worst_p99(result.stats)):>9}{memory:>8}")
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def _class_list(value):
+    classes = [item for item in value.split(',') if item]
+    unknown = [item for item in classes if item not in WORKER_CLASSES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown worker class {', '.join(unknown)}; "
+                                         f"choose from {', '.join(WORKER_CLASSES)}")
+    return classes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark gunicorn_config.py variants on a stand-in todo app.")
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE,
+                        help="gunicorn config to render the variants from (default: the Ansible role's)")
+    parser.add_argument('--workers', type=_int_list, default=[2, 4, 8], metavar='N,N,...',
+                        help="worker process counts (default: 2,4,8)")
+    parser.add_argument('--threads', type=_int_list, default=[1, 4], metavar='N,N,...',
+                        help="threads per worker, used by gthread only (default: 1,4)")
+    parser.add_argument('--worker-class', type=_class_list, default=list(WORKER_CLASSES), metavar='CLASS,...',
+                        help="worker classes out of sync, gthread and gevent (default: all three)")
+    parser.add_argument('--backlog', type=_int_list, default=[2048], metavar='N,N,...',
+                        help="listen backlog values (default: 2048, gunicorn's default)")
+    parser.add_argument('--keepalive', type=_int_list, default=[2], metavar='S,S,...',
+                        help="keep-alive seconds, ignored by the sync worker (default: 2, gunicorn's default)")
+    parser.add_argument('--engine', choices=('threads', 'async'), default='async',
+                        help="load generator engine (default: %(default)s)")
+    parser.add_argument('--users', type=int, default=20,
+                        help="closed-loop workers per endpoint, or the in-flight limit with --rate "
+                             "(default: %(default)s)")
+    parser.add_argument('--rate', type=float,
+                        help="offer this many requests per second per endpoint open-loop instead of closed-loop workers")
+    parser.add_argument('--duration', type=parse_duration, default=30.0, metavar='DURATION',
+                        help="measured time per variant (default: %(default)ss)")
+    parser.add_argument('--warmup', type=parse_duration, default=5.0, metavar='DURATION',
+                        help="unmeasured load before each measurement (default: %(default)ss)")
+    parser.add_argument('--pooled', action='store_true',
+                        help="keep-alive connections from the load generator, so --keepalive matters")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="spread the load generator across this many processes (default: in-process)")
+    parser.add_argument('--app-latency', type=float, default=0.0, metavar='MS',
+                        help="milliseconds the stand-in app sleeps per request, e.g. the MySQL round trip "
+                             "(default: %(default)s)")
+    parser.add_argument('--sort', choices=('throughput', 'p99', 'memory'), default='throughput',
+                        help="rank the variants by this (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if importlib.util.find_spec('gunicorn') is None:
+        sys.exit("gunicorn_matrix.py needs gunicorn: pip install gunicorn (and gevent for the gevent worker)")
+    with open(args.template) as f:
+        template = f.read()
+    matrix = variants(args.workers, args.threads, args.worker_class, args.backlog, args.keepalive)
+    target = Stage(args.duration, users=args.users, rate=args.rate)
+    stages = [Stage(args.warmup, users=args.users, rate=args.rate), target] if args.warmup else [target]
+    options = {'engine': args.engine, 'pooled': args.pooled, 'status_interval': 0}
+    app_env = {'TODO_APP_LATENCY': str(args.app_latency)}
+    print(f"Benchmarking {len(matrix)} gunicorn variants, {args.warmup:g}s warm-up and {args.duration:g}s "
+          f"measured each ({target.describe()} per endpoint, {args.engine} engine)")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='gunicorn_matrix_') as workdir:
+        try:
+            for number, variant in enumerate(matrix, 1):
+                if variant.worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+                    results.append(Result(variant, None, 0.0, None, 'gevent is not installed'))
+                    continue
+                print(f"[{number}/{len(matrix)}] {variant.describe()}", flush=True)
+                results.append(run_variant(variant, template, workdir, stages, app_env,
+                                           processes=args.processes, **options))
+        except KeyboardInterrupt:
+            print("\nMatrix stopped early. The Empire retreats.")
+    print_ranking(results, args.sort)
+
+
+if __name__ == '__main__':
+    main()
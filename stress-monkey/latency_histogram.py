@@ -0,0 +1,169 @@
+"""
+Fixed-memory, log-bucketed (HDR-style) latency histogram.
+
+Latencies are recorded in whole microseconds. Values below 2**SUB_BUCKET_BITS
+get a bucket each; above that every power-of-two range is split into
+2**(SUB_BUCKET_BITS - 1) equal buckets, so any recorded value is reported
+within 1/64 (about 1.6%) of its true value. The bucket array is allocated once
+and never grows, recording is a couple of integer operations plus one list
+increment, and two histograms merge by adding their buckets, which is what lets
+thread, process and agent stats be combined without losing the tail.
+"""
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+MAX_TRACKABLE_US = 3600 * 1000 * 1000  # One hour; anything slower is clamped here
+
+
+def _bucket_index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+
+def _bucket_upper_value(index):
+    # Highest value that lands in the bucket, so percentiles never under-report
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+    top = index - (shift << (SUB_BUCKET_BITS - 1))
+    return ((top + 1) << shift) - 1
+
+
+BUCKET_COUNT = _bucket_index(MAX_TRACKABLE_US) + 1
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with fixed memory and O(1) recording.
+    """
+    __slots__ = ('counts', 'count', 'total_us', 'max_us')
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def record(self, seconds):
+        """
+        Records one latency.
+
+        Args:
+            seconds (float): The latency in seconds.
+
+        Returns:
+            None
+        """
+        value = int(seconds * 1000000)
+        if value > MAX_TRACKABLE_US:
+            value = MAX_TRACKABLE_US
+        elif value < 0:
+            value = 0
+        self.counts[_bucket_index(value)] += 1
+        self.count += 1
+        self.total_us += value
+        if value > self.max_us:
+            self.max_us = value
+
+    def merge(self, other):
+        """
+        Adds the recordings of another histogram into this one.
+
+        Args:
+            other (LatencyHistogram): The histogram to add.
+
+        Returns:
+            None
+        """
+        counts = self.counts
+        for index, bucket in enumerate(other.counts):
+            if bucket:
+                counts[index] += bucket
+        self.count += other.count
+        self.total_us += other.total_us
+        if other.max_us > self.max_us:
+            self.max_us = other.max_us
+
+    def to_dict(self):
+        """
+        Returns the histogram as JSON-serializable data, with only the non-empty buckets.
+        """
+        return {'buckets': [[index, bucket] for index, bucket in enumerate(self.counts) if bucket],
+                'count': self.count, 'total_us': self.total_us, 'max_us': self.max_us}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a histogram from `to_dict()` data.
+        """
+        histogram = cls()
+        for index, bucket in data['buckets']:
+            histogram.counts[index] = bucket
+        histogram.count = data['count']
+        histogram.total_us = data['total_us']
+        histogram.max_us = data['max_us']
+        return histogram
+
+    def since(self, earlier):
+        """
+        Returns the recordings made after `earlier`, an older copy of this histogram.
+
+        The maximum of the result is the top of its highest non-empty bucket.
+
+        Args:
+            earlier (LatencyHistogram): A snapshot of this histogram taken before.
+
+        Returns:
+            LatencyHistogram: A new histogram with only the newer recordings.
+        """
+        delta = LatencyHistogram()
+        counts = delta.counts
+        for index, (now, before) in enumerate(zip(self.counts, earlier.counts)):
+            if now != before:
+                counts[index] = now - before
+                delta.max_us = _bucket_upper_value(index)
+        delta.count = self.count - earlier.count
+        delta.total_us = self.total_us - earlier.total_us
+        delta.max_us = min(delta.max_us, self.max_us)
+        return delta
+
+    def percentile(self, pct):
+        """
+        Returns the latency at the given percentile.
+
+        Args:
+            pct (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The latency in seconds, or None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        if pct >= 100:
+            return self.max_us / 1000000.0
+        wanted = max(int(pct / 100.0 * self.count + 0.999999), 1)
+        seen = 0
+        for index, bucket in enumerate(self.counts):
+            seen += bucket
+            if seen >= wanted:
+                return min(_bucket_upper_value(index), self.max_us) / 1000000.0
+        return self.max_us / 1000000.0
+
+    def mean(self):
+        """
+        Returns the mean latency in seconds, or None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        return self.total_us / self.count / 1000000.0
+
+    def max(self):
+        """
+        Returns the largest recorded latency in seconds, or None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        return self.max_us / 1000000.0
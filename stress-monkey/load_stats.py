@@ -0,0 +1,415 @@
+"""
+Request counters shared by the load engines in simulate_traffic.py.
+
+Every worker (thread or coroutine) records into its own RunStats shard so the
+hot path never takes a lock. The shards are merged when the run is reported.
+"""
+import time
+
+from latency_histogram import LatencyHistogram
+
+
+# Index into EndpointStats.statuses: 0 for requests without a response, else the status class
+STATUS_CLASSES = ['failed', '1xx', '2xx', '3xx', '4xx', '5xx']
+
+# The parts of a request timed with --phases, in order: opening the connection (only for
+# requests that opened one), writing the request, waiting for the first response byte, and
+# reading the rest of the response
+PHASES = ['connect', 'send', 'ttfb', 'body']
+
+
+class EndpointStats:
+    """
+    Counters for a single (method, endpoint) pair.
+    """
+    __slots__ = ('requests', 'errors', 'statuses', 'bytes', 'latency', 'phases')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.statuses = [0] * len(STATUS_CLASSES)
+        self.bytes = 0
+        self.latency = LatencyHistogram()
+        self.phases = None  # One LatencyHistogram per PHASES entry, once a timed request is recorded
+
+    def record_phases(self, times):
+        """
+        Records the phase times of one request.
+
+        Args:
+            times (tuple): Seconds per PHASES entry; connect is None if no connection was opened.
+
+        Returns:
+            None
+        """
+        phases = self.phases
+        if phases is None:
+            phases = self.phases = [LatencyHistogram() for _ in PHASES]
+        connect, send, ttfb, body = times
+        if connect is not None:
+            phases[0].record(connect)
+        phases[1].record(send)
+        phases[2].record(ttfb)
+        phases[3].record(body)
+
+    def merge(self, other):
+        """
+        Adds the counters of another EndpointStats into this one.
+
+        Args:
+            other (EndpointStats): The counters to add.
+
+        Returns:
+            None
+        """
+        self.requests += other.requests
+        self.errors += other.errors
+        for index, count in enumerate(other.statuses):
+            self.statuses[index] += count
+        self.bytes += other.bytes
+        self.latency.merge(other.latency)
+        if other.phases is not None:
+            if self.phases is None:
+                self.phases = [LatencyHistogram() for _ in PHASES]
+            for mine, theirs in zip(self.phases, other.phases):
+                mine.merge(theirs)
+
+    def percentile(self, pct):
+        """
+        Returns the latency at the given percentile.
+
+        Args:
+            pct (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The latency in seconds, or None if nothing was timed.
+        """
+        return self.latency.percentile(pct)
+
+
+class RunStats:
+    """
+    Request counters for one load run, keyed by (method, endpoint).
+
+    A RunStats can hand out shards with `shard()`. Each worker writes only to
+    its own shard and `merged()` folds them together for reporting. If `results`
+    is set to a ResultLog, every recorded request is also appended to it.
+
+    Requests a circuit breaker did not let through are counted apart, in
+    `short_circuited`, since they were never sent. `failed` counts the requests
+    recorded without a response into this RunStats itself (not its shards), so a
+    worker can tell cheaply whether its last request failed.
+
+    With `time_phases` set (shards inherit it), the raw and async clients time the
+    PHASES of each request and leave them in `phase_times`; the next `record()`
+    adds them to the endpoint's phase histograms.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.short_circuited = {}
+        self.connections_new = 0
+        self.connections_reused = 0
+        self.failed = 0
+        self.results = None
+        self.time_phases = False
+        self.phase_times = None
+        self._shards = []
+
+    def shard(self):
+        """
+        Creates a child RunStats owned by a single worker.
+
+        Returns:
+            RunStats: The new shard, included in `merged()` from now on.
+        """
+        shard = RunStats()
+        shard.results = self.results
+        shard.time_phases = self.time_phases
+        self._shards.append(shard)
+        return shard
+
+    def record(self, method, endpoint, status_code, latency=None, size=0):
+        """
+        Records one completed (or failed) request.
+
+        Args:
+            method (str): The HTTP method of the request.
+            endpoint (str): The endpoint the request was sent to.
+            status_code (int): The response status, or None if the request failed.
+            latency (float, optional): Seconds from send to full response (default is None, not timed).
+            size (int, optional): Bytes in the response body (default is 0).
+
+        Returns:
+            None
+        """
+        key = (method, endpoint)
+        counters = self.endpoints.get(key)
+        if counters is None:
+            counters = self.endpoints[key] = EndpointStats()
+        counters.requests += 1
+        if status_code is None:
+            counters.errors += 1
+            counters.statuses[0] += 1
+            self.failed += 1
+        else:
+            if status_code >= 400:
+                counters.errors += 1
+            counters.statuses[min(max(status_code // 100, 1), 5)] += 1
+        counters.bytes += size
+        if latency is not None:
+            counters.latency.record(latency)
+        phase_times = self.phase_times
+        if phase_times is not None:
+            self.phase_times = None
+            if status_code is not None:
+                counters.record_phases(phase_times)
+        if self.results is not None:
+            self.results.append(method, endpoint, status_code, latency, size)
+
+    def record_short_circuit(self, method, endpoint):
+        """
+        Records a request that was not sent because the endpoint's circuit breaker was open.
+
+        Args:
+            method (str): The HTTP method of the request.
+            endpoint (str): The endpoint the request was meant for.
+
+        Returns:
+            None
+        """
+        key = (method, endpoint)
+        self.short_circuited[key] = self.short_circuited.get(key, 0) + 1
+
+    def record_connection(self, reused):
+        """
+        Records whether a request went out on a kept-alive connection or a new one.
+
+        Args:
+            reused (bool): True if an existing connection was reused.
+
+        Returns:
+            None
+        """
+        if reused:
+            self.connections_reused += 1
+        else:
+            self.connections_new += 1
+
+    def merge(self, other):
+        """
+        Adds the counters of another RunStats (and its shards) into this one.
+
+        Args:
+            other (RunStats): The stats to add.
+
+        Returns:
+            None
+        """
+        for key, counters in list(other.endpoints.items()):
+            mine = self.endpoints.get(key)
+            if mine is None:
+                mine = self.endpoints[key] = EndpointStats()
+            mine.merge(counters)
+        for key, count in list(other.short_circuited.items()):
+            self.short_circuited[key] = self.short_circuited.get(key, 0) + count
+        self.connections_new += other.connections_new
+        self.connections_reused += other.connections_reused
+        for shard in list(other._shards):
+            self.merge(shard)
+
+    def merged(self):
+        """
+        Returns a snapshot of this RunStats with all shards folded in.
+
+        Returns:
+            RunStats: A new RunStats without shards.
+        """
+        snapshot = RunStats()
+        snapshot.merge(self)
+        return snapshot
+
+    def total_requests(self):
+        return sum(counters.requests for counters in self.endpoints.values())
+
+    def total_errors(self):
+        return sum(counters.errors for counters in self.endpoints.values())
+
+    def total_failed(self):
+        return sum(counters.statuses[0] for counters in self.endpoints.values())
+
+    def total_server_errors(self):
+        # Requests without a response or with a 5xx; a 4xx is the API answering as designed
+        return sum(counters.statuses[0] + counters.statuses[5] for counters in self.endpoints.values())
+
+    def total_short_circuited(self):
+        return sum(self.short_circuited.values())
+
+    def to_dict(self):
+        """
+        Returns the stats, with shards folded in, as JSON-serializable data (e.g. to send to another host).
+        """
+        merged = self.merged() if self._shards else self
+        return {'endpoints': [[method, endpoint, counters.requests, counters.errors, counters.statuses,
+                               counters.bytes, counters.latency.to_dict(),
+                               None if counters.phases is None else [phase.to_dict() for phase in counters.phases]]
+                              for (method, endpoint), counters in merged.endpoints.items()],
+                'short_circuited': [[method, endpoint, count]
+                                    for (method, endpoint), count in merged.short_circuited.items()],
+                'connections_new': merged.connections_new, 'connections_reused': merged.connections_reused}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a RunStats from `to_dict()` data.
+        """
+        stats = cls()
+        for method, endpoint, requests, errors, statuses, size, latency, *phases in data['endpoints']:
+            counters = stats.endpoints[(method, endpoint)] = EndpointStats()
+            counters.requests = requests
+            counters.errors = errors
+            counters.statuses = list(statuses)
+            counters.bytes = size
+            counters.latency = LatencyHistogram.from_dict(latency)
+            if phases and phases[0] is not None:
+                counters.phases = [LatencyHistogram.from_dict(phase) for phase in phases[0]]
+        for method, endpoint, count in data.get('short_circuited', []):
+            stats.short_circuited[(method, endpoint)] = count
+        stats.connections_new = data['connections_new']
+        stats.connections_reused = data['connections_reused']
+        return stats
+
+    def __getstate__(self):
+        # Worker processes send their stats back pickled; ship them with shards folded in
+        merged = self.merged() if self._shards else self
+        return {'endpoints': merged.endpoints, 'short_circuited': merged.short_circuited,
+                'failed': 0, 'connections_new': merged.connections_new,
+                'connections_reused': merged.connections_reused, 'time_phases': self.time_phases,
+                'phase_times': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.results = None
+        self._shards = []
+
+
+# Column label and percentile for each latency column of the summary (milliseconds)
+REPORT_PERCENTILES = [('p50', 50), ('p90', 90), ('p99', 99), ('p99.9', 99.9)]
+
+
+def format_ms(seconds):
+    """
+    Returns `seconds` as milliseconds with one decimal, or '-' for None, for report columns.
+    """
+    return '-' if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def print_summary(stats, elapsed, cpu_seconds, title="Run summary"):
+    """
+    Prints per-endpoint and total throughput for a run.
+
+    Args:
+        stats (RunStats): The merged stats of the run.
+        elapsed (float): Wall-clock duration of the run in seconds.
+        cpu_seconds (float): CPU time the generator process used in seconds.
+        title (str, optional): Heading printed above the table.
+
+    Returns:
+        None
+    """
+    elapsed = max(elapsed, 1e-9)
+    print(f"\n{title} ({elapsed:.1f}s, latencies in ms)")
+    print(f"{'method':<8}{'endpoint':<24}{'requests':>10}{'errors':>10}{'req/s':>10}"
+          + ''.join(f"{label:>9}" for label, _ in REPORT_PERCENTILES) + f"{'max':>9}")
+    for (method, endpoint), counters in sorted(stats.endpoints.items()):
+        print(f"{method:<8}{endpoint:<24}{counters.requests:>10}{counters.errors:>10}"
+              f"{counters.requests / elapsed:>10.1f}"
+              + ''.join(f"{format_ms(counters.percentile(pct)):>9}" for _, pct in REPORT_PERCENTILES)
+              + f"{format_ms(counters.latency.max()):>9}")
+    total = stats.total_requests()
+    print(f"{'total':<32}{total:>10}{stats.total_errors():>10}{total / elapsed:>10.1f}")
+    short_circuited = stats.total_short_circuited()
+    if short_circuited:
+        # Never sent, so not in the table; failed requests are, among the errors
+        per_endpoint = ', '.join(f"{method} {endpoint} {count}"
+                                 for (method, endpoint), count in sorted(stats.short_circuited.items()))
+        print(f"Failures: {stats.total_failed()} requests without a response; {short_circuited} short-circuited "
+              f"by an open circuit breaker and not sent ({per_endpoint})")
+    timed = [(key, counters.phases) for key, counters in sorted(stats.endpoints.items()) if counters.phases]
+    if timed:
+        print("Phases (p50/p99 ms; connect over the requests that opened a connection):")
+        print(f"{'method':<8}{'endpoint':<24}" + ''.join(f"{phase:>16}" for phase in PHASES))
+        for (method, endpoint), phases in timed:
+            print(f"{method:<8}{endpoint:<24}"
+                  + ''.join(f"{format_ms(phase.percentile(50)) + '/' + format_ms(phase.percentile(99)):>16}"
+                            for phase in phases))
+    connections = stats.connections_new + stats.connections_reused
+    if connections:
+        print(f"Connections: {stats.connections_new} new, {stats.connections_reused} reused "
+              f"({100.0 * stats.connections_reused / connections:.1f}% reuse)")
+    if cpu_seconds > 0:
+        # Requests per CPU-second is the number to compare engines on the same box
+        print(f"Generator CPU time: {cpu_seconds:.1f}s, {total / cpu_seconds:.1f} requests per CPU-second")
+
+
+def print_phase_growth(stage_stats, labels):
+    """
+    Prints the p99 of every request phase per stage, and which phase grew the most.
+
+    For each endpoint, the phases of its first stage are compared with those of its
+    stage with the highest p99 latency, so the phase that grows as load increases
+    (connect for a full accept backlog, ttfb for a busy app, body for transfer) stands out.
+
+    Args:
+        stage_stats (list): The merged RunStats of each stage.
+        labels (list): A short label per stage for the column headings.
+
+    Returns:
+        None
+    """
+    keys = sorted({key for stats in stage_stats for key, counters in stats.endpoints.items() if counters.phases})
+    if not keys:
+        return
+    print("\nPhase p99 by stage (ms)")
+    print(f"{'method':<8}{'endpoint':<24}{'phase':<9}" + ''.join(f"{label:>10}" for label in labels))
+    verdicts = []
+    for method, endpoint in keys:
+        seen = [(index, stats.endpoints[(method, endpoint)]) for index, stats in enumerate(stage_stats)
+                if (method, endpoint) in stats.endpoints and stats.endpoints[(method, endpoint)].phases]
+        for number, phase in enumerate(PHASES):
+            cells = ['-'] * len(stage_stats)
+            for index, counters in seen:
+                cells[index] = format_ms(counters.phases[number].percentile(99))
+            print(f"{method if number == 0 else '':<8}{endpoint if number == 0 else '':<24}{phase:<9}"
+                  + ''.join(f"{cell:>10}" for cell in cells))
+        first, base = seen[0]
+        worst, peak = max(seen, key=lambda item: item[1].percentile(99) or 0)
+        if worst == first:
+            continue
+        growth = [((peak.phases[number].percentile(99) or 0) - (base.phases[number].percentile(99) or 0), phase,
+                   number) for number, phase in enumerate(PHASES)]
+        grown, phase, number = max(growth)
+        if grown > 0:
+            verdicts.append(f"{method} {endpoint}: {phase} grew the most, p99 "
+                            f"{format_ms(base.phases[number].percentile(99))} -> "
+                            f"{format_ms(peak.phases[number].percentile(99))} ms from {labels[first]} to "
+                            f"{labels[worst]} (total p99 {format_ms(base.percentile(99))} -> "
+                            f"{format_ms(peak.percentile(99))} ms)")
+    for verdict in verdicts:
+        print(verdict)
+
+
+class RunTimer:
+    """
+    Captures wall-clock and process CPU time for a run.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.cpu_started = time.process_time()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def cpu_seconds(self):
+        return time.process_time() - self.cpu_started
@@ -0,0 +1,170 @@
+"""
+Per-second time series of a load run, for lining client-side load up with
+server CPU, gunicorn and MySQL graphs.
+
+Every METRICS_INTERVAL the StatusReporter thread hands the running stage's
+stats to a MetricsRecorder. It appends one JSON line per endpoint with that
+second's requests, responses by status class, response bytes and latency
+percentiles, and can serve the run's counters in the Prometheus text format
+from a local HTTP endpoint.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from load_stats import STATUS_CLASSES, RunStats
+
+METRICS_INTERVAL = 1.0  # Seconds per time-series row
+SERIES_PERCENTILES = [('p50', 50), ('p90', 90), ('p99', 99), ('p99.9', 99.9)]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.recorder.exposition.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown the status lines
+
+
+class MetricsRecorder:
+    """
+    Writes the per-second time series of a run and serves its Prometheus metrics.
+
+    Args:
+        path (str, optional): Append JSON lines to this file (default is None, no file).
+        port (int, optional): Serve Prometheus metrics on this local port (default is None, no server).
+        host (str, optional): The address the metrics server listens on (default is '127.0.0.1').
+        process (int, optional): The worker process index, added to every row and metric
+            under --processes (default is None).
+    """
+
+    def __init__(self, path=None, port=None, host='127.0.0.1', process=None):
+        self.file = open(path, 'a') if path else None
+        self.extra = {} if process is None else {'process': process}
+        self.totals = RunStats()  # Finished stages
+        self.current = None  # (stats, stage, last snapshot) of the running stage
+        self.started = time.monotonic()
+        self.exposition = ''
+        self.server = None
+        if port is not None:
+            self.server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            self.server.daemon_threads = True
+            self.server.recorder = self
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def sample(self, stats, stage):
+        """
+        Records the second that just ended.
+
+        Args:
+            stats (RunStats): The stats the running stage records into.
+            stage (int): The index of the running stage.
+
+        Returns:
+            None
+        """
+        if self.current is not None and self.current[0] is not stats:
+            # The stage changed: close the old one out with whatever it recorded since the last row
+            old_stats, old_stage, previous = self.current
+            final = old_stats.merged()
+            self._write(old_stage, final, previous)
+            self.totals.merge(final)
+            self.current = None
+        previous = self.current[2] if self.current is not None else RunStats()
+        snapshot = stats.merged()
+        latest = self._write(stage, snapshot, previous)
+        self.current = (stats, stage, snapshot)
+        self._expose(stage, snapshot, latest)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def _write(self, stage, snapshot, previous):
+        now = time.time()
+        elapsed = round(time.monotonic() - self.started, 3)
+        latest = {}
+        lines = []
+        for (method, endpoint), counters in sorted(snapshot.endpoints.items()):
+            before = previous.endpoints.get((method, endpoint))
+            if before is None:
+                latency = counters.latency
+                requests, errors, size = counters.requests, counters.errors, counters.bytes
+                statuses = counters.statuses
+            else:
+                latency = counters.latency.since(before.latency)
+                requests = counters.requests - before.requests
+                errors = counters.errors - before.errors
+                size = counters.bytes - before.bytes
+                statuses = [now_count - then for now_count, then in zip(counters.statuses, before.statuses)]
+            latest[(method, endpoint)] = latency
+            if self.file is None:
+                continue
+            row = {'time': round(now, 3), 'elapsed': elapsed, 'stage': stage + 1}
+            row.update(self.extra)
+            row.update({'method': method, 'endpoint': endpoint, 'requests': requests, 'errors': errors,
+                        'status': {label: count for label, count in zip(STATUS_CLASSES, statuses) if count},
+                        'bytes': size})
+            for label, pct in SERIES_PERCENTILES:
+                value = latency.percentile(pct)
+                row[f"{label}_ms"] = None if value is None else round(value * 1000, 3)
+            lines.append(json.dumps(row))
+        if lines:
+            # One append per second keeps the file readable while the run is still going
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+        return latest
+
+    def _expose(self, stage, snapshot, latest):
+        if self.server is None:
+            return
+        totals = self.totals.merged()
+        totals.merge(snapshot)
+        out = ['# HELP stress_stage The stage of the load profile that is running.',
+               '# TYPE stress_stage gauge',
+               f"stress_stage{_labels(self.extra)} {stage + 1}"]
+        metrics = [
+            ('stress_requests_total', 'counter', 'Requests sent.',
+             lambda counters: [({}, counters.requests)]),
+            ('stress_errors_total', 'counter', 'Requests that failed or got a 4xx/5xx response.',
+             lambda counters: [({}, counters.errors)]),
+            ('stress_responses_total', 'counter', 'Requests by response status class.',
+             lambda counters: [({'class': label}, count) for label, count in zip(STATUS_CLASSES, counters.statuses)]),
+            ('stress_response_bytes_total', 'counter', 'Response body bytes received.',
+             lambda counters: [({}, counters.bytes)]),
+        ]
+        for name, kind, help_text, values in metrics:
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for (method, endpoint), counters in sorted(totals.endpoints.items()):
+                for labels, value in values(counters):
+                    labels = dict(method=method, endpoint=endpoint, **labels, **self.extra)
+                    out.append(f"{name}{_labels(labels)} {value}")
+        out += ['# HELP stress_latency_seconds Response time percentiles over the last second.',
+                '# TYPE stress_latency_seconds gauge']
+        for (method, endpoint), latency in sorted(latest.items()):
+            for _, pct in SERIES_PERCENTILES:
+                value = latency.percentile(pct)
+                if value is not None:
+                    labels = dict(method=method, endpoint=endpoint, quantile=f"{pct / 100:g}", **self.extra)
+                    out.append(f"stress_latency_seconds{_labels(labels)} {value:.6f}")
+        self.exposition = '\n'.join(out) + '\n'
@@ -0,0 +1,150 @@
+"""
+Pre-encoded request bodies for simulate_traffic.py.
+
+Endpoint data is serialized to JSON bytes once, when the workers for an endpoint
+are created, instead of calling json.dumps on every request. Bodies that need a
+different value per request put a slot (Sequence or Choice) where the value goes:
+the body is still serialized once, split around the slots, and each request only
+joins the fixed fragments with the slots' pre-encoded values.
+
+    {'title': Sequence('Storm Trooper #'), 'is_done': Choice(True, False)}
+"""
+import itertools
+import json
+import random
+import re
+
+PUT_DONE_BODY = json.dumps({'is_done': True}).encode()
+
+# Slots are serialized as '\x1e<n>\x1e' strings, which json.dumps always escapes like this
+_SLOT_MARKER = re.compile(rb'"\\u001e(\d+)\\u001e"')
+
+process_tag = ''  # Set per worker process so Sequence values stay unique across processes
+
+
+class Slot:
+    """
+    A value in a body template that changes from one request to the next.
+    """
+
+    def prepare(self):
+        """
+        Called once when a body using the slot is compiled.
+        """
+
+    def render(self):
+        """
+        Returns the JSON encoding of the next value, as bytes.
+        """
+        raise NotImplementedError
+
+
+class Sequence(Slot):
+    """
+    A unique string per request: the prefix followed by a counter.
+
+    Args:
+        prefix (str, optional): Text before the counter (default is '').
+        start (int, optional): The first counter value (default is 1).
+    """
+
+    def __init__(self, prefix='', start=1):
+        self.prefix = prefix
+        self.start = start
+        self.counter = None
+        self.head = None
+
+    def prepare(self):
+        if self.counter is not None:
+            return  # Shared by several endpoints: keep one counter
+        # next() on itertools.count is atomic, so worker threads can share one counter
+        self.counter = itertools.count(self.start)
+        self.head = json.dumps(f"{self.prefix}{process_tag}").encode()[:-1]
+
+    def render(self):
+        return b'%s%d"' % (self.head, next(self.counter))
+
+
+class Choice(Slot):
+    """
+    A value picked at random from a fixed set for each request.
+
+    Args:
+        *values: The JSON-serializable values to pick from.
+    """
+
+    def __init__(self, *values):
+        if not values:
+            raise ValueError("Choice needs at least one value")
+        self.values = values
+        self.encoded = [json.dumps(value).encode() for value in values]
+
+    def render(self):
+        return random.choice(self.encoded)
+
+
+class RequestBody:
+    """
+    A request body serialized once, with slots filled in per request.
+
+    Build one with `compile_body`.
+    """
+    __slots__ = ('fragments', 'slots')
+
+    def __init__(self, fragments, slots):
+        self.fragments = fragments
+        self.slots = slots
+
+    def render(self):
+        """
+        Returns the body for one request.
+
+        Returns:
+            bytes: The encoded JSON body, or None for a request without a body.
+        """
+        if not self.slots:
+            return self.fragments[0]
+        fragments = self.fragments
+        parts = [fragments[0]]
+        for index, slot in enumerate(self.slots, 1):
+            parts.append(slot.render())
+            parts.append(fragments[index])
+        return b''.join(parts)
+
+
+def compile_body(data):
+    """
+    Serializes endpoint data into a RequestBody.
+
+    Args:
+        data (dict): The body to send, possibly holding Slot values (None for no body).
+
+    Returns:
+        RequestBody: The compiled body.
+
+    Raises:
+        TypeError: If the data is not JSON-serializable.
+    """
+    if data is None:
+        return RequestBody([None], [])
+    slots = []
+
+    def mark(value):
+        if isinstance(value, Slot):
+            slots.append(value)
+            return f"\x1e{len(slots) - 1}\x1e"
+        if isinstance(value, dict):
+            return {key: mark(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [mark(item) for item in value]
+        return value
+
+    encoded = json.dumps(mark(data)).encode()
+    if not slots:
+        return RequestBody([encoded], [])
+    pieces = _SLOT_MARKER.split(encoded)
+    # split() alternates fixed fragments and slot numbers: reorder the slots to match
+    order = [slots[int(number)] for number in pieces[1::2]]
+    for slot in order:
+        slot.prepare()
+    return RequestBody(pieces[0::2], order)
@@ -0,0 +1,346 @@
+"""
+Lean raw-socket HTTP/1.1 client for simulate_traffic.py --engine raw.
+
+`requests` spends tens of microseconds of Python per call on header
+dictionaries, cookie jars and response objects the load generator never looks
+at. RawHTTPClient does the least the todo API needs: the request bytes for an
+endpoint are built once and reused, a response is read into one receive buffer
+per connection that is never reallocated for the common case, and only the
+status line, Content-Length and Connection headers are parsed. The body is
+handed back as a memoryview into that buffer, valid until the next request, so
+it is only copied if the scenario parses it (e.g. the POST response of
+--track-ids).
+
+It is a drop-in for the thread engine's clients, so every scenario runs on it
+and is recorded the same way. With --pipeline N, a closed-loop worker of a
+fixed-request endpoint sends N requests back to back on its connection and
+then reads the N responses, each timed from the moment the batch was sent.
+
+When the stats ask for it (--phases), each request is also timed in phases:
+connect, send (until the request is written to the socket), ttfb (until the
+first byte of its response is received) and body (the rest of the response).
+"""
+import json
+import socket
+import time
+from urllib.parse import urlsplit
+
+BUFFER_SIZE = 65536  # Initial receive buffer per connection; grows only for larger responses
+_CRLF2 = b"\r\n\r\n"
+# How a kept-alive connection the server closed while it was idle fails (EOF is a reset here)
+_IDLE_CLOSED = (ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+
+class RawResponse:
+    """
+    The parts of a response the load generator uses.
+
+    `content` is a memoryview into the connection's receive buffer and is only valid
+    until the next request on the same client.
+    """
+    __slots__ = ('status_code', 'content')
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(bytes(self.content))
+
+
+class RawHTTPClient:
+    """
+    A single HTTP/1.1 connection on a plain socket, reconnected as needed.
+
+    A kept-alive connection the server closed between requests (gunicorn's keepalive
+    timeout, a worker restart) fails before the first response byte; the requests then go
+    out once more on a new connection instead of being counted as failures.
+
+    Args:
+        stats (RunStats): Where to count new vs. reused connections, and to leave the phase
+            times of each request if its `time_phases` is set.
+        keep_alive (bool, optional): Keep the connection open between requests (default is
+            True); otherwise every request opens its own, like OneShotClient.
+        max_keepalive (int, optional): Reconnect after this many requests (default is 0, no limit).
+        timeout (float, optional): Seconds to wait on connect, send and receive (default is 30).
+        pipeline (int, optional): Requests `send_pipelined` sends per batch (default is 1).
+    """
+
+    def __init__(self, stats, keep_alive=True, max_keepalive=0, timeout=30.0, pipeline=1):
+        self.stats = stats
+        self.keep_alive = keep_alive
+        self.max_keepalive = max_keepalive
+        self.timeout = timeout
+        self.pipeline = pipeline
+        self.sock = None
+        self.address = None
+        self.served = 0
+        self.reused = None  # Whether the last send went out on a kept-alive connection, None before it did
+        self.heads = {}  # (method, url) -> ((host, port), request bytes up to the body headers)
+        self.last = (None, None, None, None, None)  # (method, url, body, address, request bytes) of the last one
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Unread received bytes are buffer[start:end]
+        self.end = 0
+        self.connect_time = None  # Phases of the last send, while --phases is on
+        self.send_time = None
+        self.sent = 0.0
+
+    def _head(self, method, url):
+        cached = self.heads.get((method, url))
+        if cached is None:
+            parts = urlsplit(url)
+            if parts.scheme != 'http':
+                raise ValueError(f"The raw engine only supports http:// URLs, got {url}")
+            path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+            head = (f"{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+                    f"Connection: {'keep-alive' if self.keep_alive else 'close'}\r\n").encode('latin-1')
+            cached = self.heads[(method, url)] = ((parts.hostname, parts.port or 80), head)
+        return cached
+
+    def _request_bytes(self, method, url, body):
+        last_method, last_url, last_body, last_address, last_request = self.last
+        if body is last_body and method == last_method and url == last_url:
+            return last_address, last_request  # The same pre-encoded body object: reuse the bytes
+        address, head = self._head(method, url)
+        if body is None:
+            request = head + b"\r\n"
+        else:
+            request = b"%sContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (head, len(body), body)
+        self.last = (method, url, body, address, request)
+        return address, request
+
+    def _connect(self, address):
+        self.close()
+        self.sock = socket.create_connection(address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.address = address
+        self.served = 0
+        self.start = self.end = 0
+
+    def _send(self, address, request, count):
+        if self.max_keepalive and self.served + count > self.max_keepalive:
+            self.close()
+        reused = self.sock is not None and address == self.address
+        timed = self.stats.time_phases
+        if timed:
+            begun = time.perf_counter()
+        if not reused:
+            self._connect(address)
+        self.reused = reused
+        self.served += count
+        if timed:
+            connected = time.perf_counter()
+            self.sock.sendall(request)
+            self.sent = time.perf_counter()
+            self.connect_time = None if reused else connected - begun
+            self.send_time = self.sent - connected
+        else:
+            self.sock.sendall(request)
+
+    def _exchange(self, address, request, count):
+        # Sends `count` requests and reads the first response, resending once on a new connection
+        # if a kept-alive one turns out to be closed; the connection is counted once per request
+        self.reused = None
+        try:
+            try:
+                self._send(address, request, count)
+                return self._read_response()
+            except _IDLE_CLOSED:
+                if not self.reused or self.start != self.end:
+                    raise  # A new connection, or the response had begun: a real failure
+            self.close()
+            self._send(address, request, count)
+            return self._read_response()
+        finally:
+            if self.reused is not None:
+                self.stats.record_connection(self.reused)
+                for _ in range(count - 1):
+                    self.stats.record_connection(True)
+
+    def request(self, method, url, headers=None, data=None):
+        """
+        Sends one request and reads its response (the `requests`-style signature of the other clients).
+
+        Args:
+            method (str): The HTTP method to use.
+            url (str): The full http:// URL.
+            headers (dict, optional): Ignored; JSON bodies always go out as application/json.
+            data (bytes, optional): The request body.
+
+        Returns:
+            RawResponse: The status and a view of the body.
+
+        Raises:
+            OSError, ValueError: If the connection or response is broken.
+        """
+        address, request = self._request_bytes(method, url, data)
+        try:
+            return self._exchange(address, request, 1)
+        except BaseException:
+            self.close()
+            raise
+
+    def pipelined(self, method, url, body, count):
+        """
+        Sends `count` requests in one write, then yields each response as it is read.
+
+        Args:
+            method (str): The HTTP method to use.
+            url (str): The full http:// URL.
+            body (RequestBody): The pre-encoded body, rendered once per request.
+            count (int): The number of requests.
+
+        Yields:
+            RawResponse: The responses in order; each is valid until the next one is read.
+        """
+        requests = []
+        for _ in range(count):
+            address, request = self._request_bytes(method, url, body.render())
+            requests.append(request)
+        try:
+            yield self._exchange(address, b"".join(requests), count)
+            for _ in range(count - 1):
+                yield self._read_response()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _fill(self, wanted):
+        # Reads until buffer[start:end] holds at least `wanted` bytes. The unread bytes may move
+        # to the front of the buffer, or into a larger one, so only offsets from `start` stay valid
+        if self.start + wanted > len(self.buffer):
+            pending = self.end - self.start
+            if wanted > len(self.buffer):
+                grown = bytearray(max(wanted, 2 * len(self.buffer)))
+                grown[:pending] = self.view[self.start:self.end]
+                self.buffer = grown
+                self.view = memoryview(grown)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]  # Leftover pipelined bytes
+            self.start, self.end = 0, pending
+        while self.end - self.start < wanted:
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                raise ConnectionResetError("connection closed before the response was complete")
+            self.end += received
+
+    def _consume(self, size):
+        # Returns a view of the next `size` buffered bytes and marks them read
+        content = self.view[self.start:self.start + size]
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return content
+
+    def _read_response(self):
+        timed = self.stats.time_phases
+        if timed:
+            if self.start == self.end:
+                self._fill(1)
+            first = time.perf_counter()
+        searched = 0
+        while True:
+            header_end = self.buffer.find(_CRLF2, self.start + max(searched - 3, 0), self.end)
+            if header_end >= 0:
+                break
+            searched = self.end - self.start
+            self._fill(searched + 1)
+        header = bytes(self.view[self.start:header_end + 2]).lower()  # Every header line ends in CRLF
+        self.start = header_end + 4
+        status = int(header[9:12])
+        closes = not self.keep_alive or b"\nconnection: close" in header
+        length = header.find(b"\ncontent-length:")
+        if length >= 0:
+            content = self._read_body(int(header[length + 16:header.find(b"\r", length + 1)]))
+        elif b"\ntransfer-encoding: chunked" in header:
+            content = self._read_chunked()
+        elif status in (204, 304) or status < 200:
+            content = self._consume(0)
+        else:
+            content = self._read_to_close()
+            closes = True
+        if closes:
+            self.close()
+        if timed:
+            # Later responses of a pipelined batch share its send but did not open the connection
+            self.stats.phase_times = (self.connect_time, self.send_time, first - self.sent,
+                                      time.perf_counter() - first)
+            self.connect_time = None
+        return RawResponse(status, content)
+
+    def _read_body(self, size):
+        self._fill(size)
+        return self._consume(size)
+
+    def _line(self):
+        searched = 0
+        while True:
+            end = self.buffer.find(b"\r\n", self.start + max(searched - 1, 0), self.end)
+            if end >= 0:
+                return bytes(self._consume(end - self.start + 2))
+            searched = self.end - self.start
+            self._fill(searched + 1)
+
+    def _read_chunked(self):
+        # Rare for the todo API, so the chunks are simply copied together
+        payload = bytearray()
+        while True:
+            size = int(self._line().split(b";")[0], 16)
+            if size == 0:
+                while self._line() != b"\r\n":  # Trailers
+                    pass
+                return memoryview(payload)
+            payload += self._read_body(size)
+            self._line()
+
+    def _read_to_close(self):
+        payload = bytearray(self.view[self.start:self.end])
+        self.start = self.end = 0
+        while True:
+            chunk = self.sock.recv(BUFFER_SIZE)
+            if not chunk:
+                return memoryview(payload)
+            payload += chunk
+
+
+def send_pipelined(client, url, endpoint, method, body, stats, log=None):
+    """
+    Sends one pipelined batch of `client.pipeline` requests to a fixed-request endpoint.
+
+    Every response is recorded with its latency from the moment the batch was sent; if the
+    connection breaks, the requests still unanswered are recorded as failed.
+
+    Args:
+        client (RawHTTPClient): The worker's client.
+        url (str): The full URL of the endpoint.
+        endpoint (str): The endpoint label used in stats and output.
+        method (str): The HTTP method to use.
+        body (RequestBody): The pre-encoded request body, see `compile_body`.
+        stats (RunStats): Where to record each request.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+
+    Returns:
+        None
+    """
+    answered = 0
+    started = time.perf_counter()
+    try:
+        for response in client.pipelined(method, url, body, client.pipeline):
+            stats.record(method, endpoint, response.status_code, time.perf_counter() - started,
+                         len(response.content))
+            answered += 1
+        if log is not None and log.sampled():
+            log.write(f"Response from {answered} pipelined {method} {endpoint}: {response.status_code}. "
+                      f"May the Force be with you.")
+    except Exception as e:
+        for _ in range(client.pipeline - answered):
+            stats.record(method, endpoint, None)
+        if log is not None and log.sampled():
+            log.write(f"Pipelined {method} {endpoint} failed after {answered} responses: {e!r}. "
+                      f"I've got a bad feeling about this.")
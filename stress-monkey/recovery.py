@@ -0,0 +1,300 @@
+"""
+Outage recovery measurement for simulate_traffic.py --recovery.
+
+Run load while `service_stop_restart.sh` stops todolist.service, and this
+monitor finds the outage in the stream of completed requests and measures how
+the service comes back:
+
+* time to first success: from the first failed request of the outage to the
+  first request served again,
+* time to 95% throughput: from the first success until a sliding one-second
+  window serves --recovery-target of the throughput of the --recovery-baseline
+  seconds before the outage,
+* elevated tail: from the first success until the per-second p99 settles back
+  within --recovery-tolerance times the pre-outage p99 (for SETTLE_SECONDS in a row).
+
+A request is served if it got a response below 500; no response and 5xx (a
+proxy in front of a stopped app) count as failed. An outage starts once
+OUTAGE_FAILURES requests in a row have failed over at least OUTAGE_GRACE
+seconds. Like ResultLog, the monitor hangs off RunStats.results: workers only
+append to a deque, and a thread bins the requests into RESOLUTION-second
+buckets and one latency histogram per second, keeping only the p99 of each
+finished second. Closed-loop workers back off while the target is down (see
+resilience.py), which delays their return by up to the backoff cap; measure
+recovery with a rate stage, or a small --backoff cap, to time the server alone.
+"""
+import collections
+import json
+import math
+import threading
+import time
+
+from latency_histogram import LatencyHistogram
+
+RESOLUTION = 0.1  # Seconds per throughput bucket
+THROUGHPUT_WINDOW = 1.0  # Seconds of the sliding window compared with the pre-outage throughput
+OUTAGE_FAILURES = 3  # Failed requests in a row that can start an outage...
+OUTAGE_GRACE = 0.5  # ...once they span at least this many seconds
+SETTLE_SECONDS = 5  # Seconds in a row with the p99 back in tolerance that end the elevated tail
+DRAIN_INTERVAL = 0.1  # Seconds between passes of the monitor thread
+
+
+class Outage:
+    """
+    One outage seen in the request stream; times are seconds since the monitor started.
+
+    The pre-outage baseline is taken when the outage is detected; the recovery times are
+    filled in by `RecoveryMonitor.analyze()`.
+    """
+
+    def __init__(self, began, last_success):
+        self.began = began  # The first failed request
+        self.last_success = last_success
+        self.first_success = None
+        self.baseline_seconds = 0.0
+        self.baseline_rate = None  # Served requests per second
+        self.baseline_p99 = None
+        self.to_target = None  # Seconds from the first success
+        self.tail = None  # Seconds from the first success
+        self.peak_p99 = None
+        self.measured_until = None
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class RecoveryMonitor:
+    """
+    Finds outages in the requests of a run and measures the recovery from each.
+
+    Attach it as `stats.results` of the run's RunStats (run_stages does this).
+
+    Args:
+        baseline (float, optional): Seconds before an outage that set the throughput and p99
+            to recover to (default is 10).
+        target (float, optional): The share of the pre-outage throughput that counts as
+            recovered (default is 0.95).
+        tolerance (float, optional): The tail is elevated while the p99 is above this many
+            times the pre-outage p99 (default is 1.5).
+        results (ResultLog, optional): Also pass every request on to this results file
+            (default is None).
+        announce (bool, optional): Print a line when an outage starts and ends (default is True).
+    """
+
+    def __init__(self, baseline=10.0, target=0.95, tolerance=1.5, results=None, announce=True):
+        self.baseline = baseline
+        self.target = target
+        self.tolerance = tolerance
+        self.results = results
+        self.announce = announce
+        self.started = time.monotonic()
+        self.ended = None
+        self.pending = collections.deque()
+        self.served = []  # Served requests per RESOLUTION bucket
+        self.failed = []
+        self.open_seconds = {}  # Second -> LatencyHistogram of its served requests, until it is over
+        self.recent = collections.deque(maxlen=int(math.ceil(baseline)) + 2)  # (second, histogram) finished
+        self.second_p99 = []  # p99 of every finished second in seconds, None without served requests
+        self.outages = []
+        self.down = None
+        self.last_success = None
+        self.failing_since = None
+        self.failing = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, method, endpoint, status_code, latency, size):
+        """
+        Queues one request; called on the hot path by RunStats.record.
+        """
+        self.pending.append((time.monotonic(), status_code, latency))
+        if self.results is not None:
+            self.results.append(method, endpoint, status_code, latency, size)
+
+    def close(self):
+        """
+        Processes everything still queued and stops the thread; the results file stays open.
+        """
+        if self.ended is not None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self._drain()
+        self.ended = time.monotonic() - self.started
+        for second in sorted(self.open_seconds):
+            self._finish_second(second)
+
+    def _run(self):
+        while not self.stopped.wait(DRAIN_INTERVAL):
+            self._drain()
+            # Requests are stamped when they complete and drained within an interval
+            done = int(time.monotonic() - self.started) - 1
+            for second in sorted(self.open_seconds):
+                if second < done:
+                    self._finish_second(second)
+
+    def _drain(self):
+        pending = self.pending
+        served = self.served
+        failed = self.failed
+        for _ in range(len(pending)):
+            stamp, status_code, latency = pending.popleft()
+            t = max(stamp - self.started, 0.0)
+            bucket = int(t / RESOLUTION)
+            if bucket >= len(served):
+                grow = bucket + 1 - len(served)
+                served.extend([0] * grow)
+                failed.extend([0] * grow)
+            if status_code is not None and status_code < 500:
+                served[bucket] += 1
+                if latency is not None:
+                    second = int(t)
+                    histogram = self.open_seconds.get(second)
+                    if histogram is None:
+                        histogram = self.open_seconds[second] = LatencyHistogram()
+                    histogram.record(latency)
+                self._success(t)
+            else:
+                failed[bucket] += 1
+                self._failure(t)
+
+    def _finish_second(self, second):
+        histogram = self.open_seconds.pop(second)
+        if second >= len(self.second_p99):
+            self.second_p99.extend([None] * (second + 1 - len(self.second_p99)))
+        self.second_p99[second] = histogram.percentile(99)
+        self.recent.append((second, histogram))
+
+    def _success(self, t):
+        if self.down is not None:
+            self.down.first_success = t
+            if self.announce:
+                print(f"[{t:7.1f}s] First success {t - self.down.began:.1f}s after the outage began; "
+                      f"measuring recovery.", flush=True)
+            self.down = None
+        self.failing_since = None
+        if self.last_success is None or t > self.last_success:
+            self.last_success = t
+
+    def _failure(self, t):
+        if self.down is not None:
+            return
+        if self.failing_since is None:
+            self.failing_since = t
+            self.failing = 0
+        self.failing += 1
+        if self.failing >= OUTAGE_FAILURES and t - self.failing_since >= OUTAGE_GRACE:
+            outage = Outage(self.failing_since, self.last_success)
+            self._take_baseline(outage)
+            self.outages.append(outage)
+            self.down = outage
+            if self.announce:
+                since = '' if outage.last_success is None else f", last success at {outage.last_success:.1f}s"
+                print(f"[{t:7.1f}s] Outage: requests failing since {outage.began:.1f}s{since}. "
+                      f"Lost in hyperspace.", flush=True)
+
+    def _take_baseline(self, outage):
+        start = max(outage.began - self.baseline, 0.0)
+        if self.outages and self.outages[-1].first_success is not None:
+            start = max(start, self.outages[-1].first_success)  # Not the previous outage's recovery
+        first, last = int(start / RESOLUTION), int(outage.began / RESOLUTION)
+        span = (last - first) * RESOLUTION
+        if span < THROUGHPUT_WINDOW:
+            return  # Too little load before the outage to recover to
+        outage.baseline_seconds = span
+        outage.baseline_rate = sum(self.served[first:last]) / span
+        histogram = LatencyHistogram()
+        seconds = list(self.recent) + list(self.open_seconds.items())
+        for second, counts in seconds:
+            if start <= second and second + 1 <= outage.began:
+                histogram.merge(counts)
+        outage.baseline_p99 = histogram.percentile(99)
+
+    def analyze(self):
+        """
+        Fills in the recovery times of every outage (call after `close()`).
+
+        Returns:
+            list: The Outage objects, oldest first.
+        """
+        window = int(round(THROUGHPUT_WINDOW / RESOLUTION))
+        for index, outage in enumerate(self.outages):
+            if outage.first_success is None:
+                outage.measured_until = self.ended
+                continue
+            horizon = self.outages[index + 1].began if index + 1 < len(self.outages) else self.ended
+            outage.measured_until = horizon
+            if outage.baseline_rate:
+                wanted = self.target * outage.baseline_rate * THROUGHPUT_WINDOW
+                for end in range(int(outage.first_success / RESOLUTION), int(horizon / RESOLUTION)):
+                    if sum(self.served[max(end - window + 1, 0):end + 1]) >= wanted:
+                        outage.to_target = max((end + 1) * RESOLUTION - outage.first_success, 0.0)
+                        break
+            if outage.baseline_p99 is not None:
+                ceiling = self.tolerance * outage.baseline_p99
+                seconds = range(int(outage.first_success), min(int(horizon), len(self.second_p99)))
+                calm = 0
+                peak = None
+                for second in seconds:
+                    p99 = self.second_p99[second]
+                    if p99 is not None and p99 <= ceiling:
+                        calm += 1
+                        if calm == SETTLE_SECONDS:
+                            outage.tail = max(second + 1 - SETTLE_SECONDS - outage.first_success, 0.0)
+                            break
+                    else:
+                        calm = 0
+                        if p99 is not None and (peak is None or p99 > peak):
+                            peak = p99
+                outage.peak_p99 = peak
+        return self.outages
+
+    def print_report(self):
+        """
+        Prints the recovery report of the run (call after `close()`).
+        """
+        outages = self.analyze()
+        print(f"\nRecovery report: {len(outages)} outage(s) in {self.ended:.1f}s of load")
+        if not outages:
+            print("No outage seen: no run of failed requests without a success in between.")
+        for number, outage in enumerate(outages, 1):
+            since = '' if outage.last_success is None else f", last success at {outage.last_success:.1f}s"
+            print(f"Outage {number}: began {outage.began:.1f}s into the run (first failed request{since})")
+            if outage.baseline_rate is None:
+                print(f"  {'pre-outage':<24}not enough load before the outage to compare against")
+            else:
+                p99 = '-' if outage.baseline_p99 is None else f"{outage.baseline_p99 * 1000:.1f} ms"
+                print(f"  {'pre-outage':<24}{outage.baseline_rate:.1f} req/s served, p99 {p99} "
+                      f"(the {outage.baseline_seconds:.1f}s before)")
+            if outage.first_success is None:
+                print(f"  {'time to first success':<24}none before the run ended, "
+                      f"{outage.measured_until - outage.began:.1f}s after the outage began")
+                continue
+            print(f"  {'time to first success':<24}{outage.first_success - outage.began:.1f}s")
+            if outage.baseline_rate is not None:
+                label = f"time to {100 * self.target:g}% throughput"
+                if outage.to_target is None:
+                    print(f"  {label:<24}not reached in the {outage.measured_until - outage.first_success:.1f}s "
+                          f"after the first success")
+                else:
+                    print(f"  {label:<24}{outage.to_target:.1f}s after the first success "
+                          f"({outage.first_success + outage.to_target - outage.began:.1f}s after the outage began)")
+            if outage.baseline_p99 is not None:
+                ceiling = f"p99 above {self.tolerance * outage.baseline_p99 * 1000:.1f} ms"
+                peak = '' if outage.peak_p99 is None else f", peak {outage.peak_p99 * 1000:.1f} ms"
+                if outage.tail is None:
+                    print(f"  {'tail elevated':<24}for all {outage.measured_until - outage.first_success:.1f}s "
+                          f"measured after the first success ({ceiling}{peak})")
+                else:
+                    print(f"  {'tail elevated':<24}{outage.tail:.1f}s after the first success ({ceiling}{peak})")
+
+    def save(self, path, **labels):
+        """
+        Appends the run's outages as one JSON line to `path`, with `labels` (e.g. the base URL),
+        so recovery can be compared from one release to the next.
+        """
+        record = dict(labels, time=time.time(), target=self.target, tolerance=self.tolerance,
+                      baseline=self.baseline, outages=[outage.to_dict() for outage in self.analyze()])
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
@@ -0,0 +1,248 @@
+"""
+Replays the requests of gunicorn/nginx access logs against the backend.
+
+Both servers' default formats (the "combined" log format) carry a timestamp
+and the request line:
+
+    1.2.3.4 - - [10/Oct/2023:13:55:36 +0000] "GET /todos HTTP/1.1" 200 2326 "-" "Mozilla/5.0"
+
+AccessLogReplay reads the logs line by line, oldest file first (plain or
+.gz), and yields every request at its original offset from the first one,
+divided by the speed-up factor. Timestamps only have whole seconds, so the
+requests logged in one second are spread evenly over it. Only one second's
+worth of requests is held in memory, whatever the size of the logs.
+
+run_replay_async sends them open-loop on the async engine: each request is
+due at its replayed time, and its latency is measured from then, so a
+backend that falls behind shows it in the tail. Paths are sent as logged;
+stats group them by endpoint with numeric path segments shown as '<id>'.
+Access logs have no bodies, so POST and PUT get one from REPLAY_BODIES.
+"""
+import asyncio
+import datetime
+import gzip
+import json
+import re
+import time
+from urllib.parse import urlsplit
+
+from async_engine import REQUEST_ERRORS, AsyncHTTPConnection
+from payloads import Choice, Sequence, compile_body
+from scenario import ID_PLACEHOLDER, created_task_id
+from stages import SHUTDOWN_GRACE
+
+# The bracketed time and the quoted request line, wherever they are in the line
+_LOG_LINE = re.compile(r'\[(?P<time>[^\]]+)\]\s+"(?P<method>[A-Z]+) (?P<target>\S+)(?: HTTP/[0-9.]+)?"')
+_NUMERIC_SEGMENT = re.compile(r'/\d+(?=/|$)')
+QUEUED_PER_SENDER = 10  # Due requests queued per sender before the log reader waits
+
+# Bodies for the logged requests that need one, by (method, endpoint label)
+REPLAY_BODIES = {
+    ('POST', '/todos'): {'title': Sequence('Replayed task #'), 'description': 'Resistance is futile'},
+    ('PUT', '/todos/<id>'): {'is_done': Choice(True, False)},
+}
+
+
+def endpoint_label(target):
+    """
+    Returns the endpoint a logged request is counted under, e.g. '/todos/<id>' for '/todos/42?x=1'.
+    """
+    return _NUMERIC_SEGMENT.sub('/' + ID_PLACEHOLDER, target.split('?', 1)[0])
+
+
+class _TimeParser:
+    # Consecutive lines mostly share a timestamp, so the last one is cached
+    def __init__(self):
+        self.text = None
+        self.value = None
+
+    def __call__(self, text):
+        if text != self.text:
+            stamp, _, zone = text.partition(' ')
+            stamp, _, fraction = stamp.partition('.')
+            parsed = datetime.datetime.strptime(f"{stamp} {zone or '+0000'}", '%d/%b/%Y:%H:%M:%S %z')
+            self.value = parsed.timestamp() + (float('0.' + fraction) if fraction else 0.0)
+            self.text = text
+        return self.value
+
+
+def _open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+class AccessLogReplay:
+    """
+    The request stream of one or more access logs, with its original timing.
+
+    Args:
+        paths (list): Log files, oldest first (e.g. access.log.2.gz access.log.1 access.log).
+        speed (float, optional): Replay this many times faster than logged (default is 1).
+        loop (bool, optional): Start over at the first file when the last one ends (default is False).
+    """
+
+    def __init__(self, paths, speed=1.0, loop=False):
+        if speed <= 0:
+            raise ValueError(f"Replay speed must be positive, got {speed}")
+        self.paths = list(paths)
+        self.speed = speed
+        self.loop = loop
+        self.skipped = 0  # Lines that are not requests in a known format, counted on the first pass
+        self.passes = 0
+
+    def describe(self):
+        files = self.paths[0] if len(self.paths) == 1 else f"{len(self.paths)} logs"
+        return f"replay of {files} at {self.speed:g}x{', looping' if self.loop else ''}"
+
+    def _logged(self):
+        # (seconds since the first request, method, target) for one pass over the logs
+        parse_time = _TimeParser()
+        first = None
+        for path in self.paths:
+            with _open_log(path) as f:
+                for line in f:
+                    match = _LOG_LINE.search(line)
+                    if match is None:
+                        self.skipped += not self.passes
+                        continue
+                    try:
+                        logged = parse_time(match.group('time'))
+                    except ValueError:
+                        self.skipped += not self.passes
+                        continue
+                    if first is None:
+                        first = logged
+                    yield logged - first, match.group('method'), match.group('target')
+
+    def __iter__(self):
+        """
+        Yields (seconds after the start of the replay, method, target) for every request.
+        """
+        base = 0.0
+        while True:
+            group = []
+            group_time = 0.0
+            count = 0
+            for offset, method, target in self._logged():
+                count += 1
+                if offset > group_time and group:
+                    yield from self._spread(base, group_time, min(offset - group_time, 1.0), group)
+                    group = []
+                group_time = max(offset, group_time)  # Lines logged slightly out of order go with the current second
+                group.append((method, target))
+            if group:
+                yield from self._spread(base, group_time, 1.0, group)
+            self.passes += 1
+            if not self.loop or not count:
+                return
+            base += group_time + 1.0  # The next pass starts one second after the last logged second
+
+    def _spread(self, base, start, width, group):
+        step = width / len(group)
+        for position, (method, target) in enumerate(group):
+            yield (base + start + position * step) / self.speed, method, target
+
+
+class _ReplaySender:
+    # One connection sending queued replay requests one at a time
+    def __init__(self, host, port, prefix, jobs, stats, log, keep_alive, max_keepalive, ids):
+        self.prefix = prefix
+        self.jobs = jobs
+        self.stats = stats
+        self.log = log
+        self.ids = ids
+        self.conn = AsyncHTTPConnection(host, port, keep_alive=keep_alive, stats=stats, max_keepalive=max_keepalive)
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                job = await self.jobs.get()
+                if job is None:
+                    return
+                await self._send(*job)
+        finally:
+            self.conn.close()
+
+    async def _send(self, intended, method, target, endpoint, body):
+        say = self.log is not None and self.log.sampled()
+        stats = self.stats
+        if self.ids is not None and ID_PLACEHOLDER in endpoint:
+            task_id = self.ids.take(remove=method == 'DELETE')
+            if task_id is not None:  # Otherwise the logged ID is sent as it is
+                target = endpoint.replace(ID_PLACEHOLDER, str(task_id))
+        try:
+            status, payload = await self.conn.request(method, self.prefix + target, body.render())
+            stats.record(method, endpoint, status, time.perf_counter() - intended, len(payload))
+            if self.ids is not None and method == 'POST' and status == 201 and payload:
+                task_id = created_task_id(json.loads(payload))
+                if task_id is not None:
+                    self.ids.add(task_id)
+            if say:
+                self.log.write(f"Replayed {method} {target}: {status}. May the Force be with you.")
+        except REQUEST_ERRORS as e:
+            stats.record(method, endpoint, None)
+            if say:
+                self.log.write(f"Replayed {method} {target} failed: {e!r}. I've got a bad feeling about this.")
+
+
+async def run_replay_async(base_url, replay, stats, log=None, keep_alive=False, max_keepalive=0, max_in_flight=100,
+                           duration=None, ids=None):
+    """
+    Sends the requests of an access log replay open-loop, each at its replayed time.
+
+    Args:
+        base_url (str): The base URL of the API (http:// only).
+        replay (AccessLogReplay): The request stream.
+        stats (RunStats): Where to record requests.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        keep_alive (bool, optional): Reuse TCP connections between requests (default is False).
+        max_keepalive (int, optional): Reconnect after this many requests on one connection (0 for no limit).
+        max_in_flight (int, optional): The most requests in flight at once (default is 100).
+        duration (float, optional): Stop after this many seconds (default is None, at the end of the logs).
+        ids (TaskIdPool, optional): Send '<id>' endpoints to tasks created during the replay instead
+            of the logged IDs while the pool has any (default is None).
+
+    Returns:
+        None
+    """
+    parts = urlsplit(base_url)
+    if parts.scheme != 'http':
+        raise ValueError(f"The async engine only supports http:// URLs, got {base_url}")
+    prefix = parts.path.rstrip('/')
+    jobs = asyncio.Queue(maxsize=max_in_flight * QUEUED_PER_SENDER)
+    shard = stats.shard()  # One event loop, so the senders share it
+    senders = [_ReplaySender(parts.hostname, parts.port or 80, prefix, jobs, shard, log, keep_alive,
+                             max_keepalive, ids) for _ in range(max_in_flight)]
+    bodies = {}
+    started = time.perf_counter()
+    ends = started + duration if duration else None
+    finished = False
+    try:
+        for offset, method, target in replay:
+            due = started + offset
+            if ends is not None and due >= ends:
+                break
+            wait = due - time.perf_counter()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            endpoint = endpoint_label(target)
+            key = (method, endpoint)
+            if key not in bodies:
+                bodies[key] = compile_body(REPLAY_BODIES.get(key))
+            await jobs.put((due, method, target, endpoint, bodies[key]))
+        for _ in senders:
+            await jobs.put(None)  # After the requests still queued
+        finished = True
+    finally:
+        if not finished:
+            while not jobs.empty():
+                job = jobs.get_nowait()
+                if job is not None:
+                    shard.record(job[1], job[3], None)  # Due but never sent
+            for _ in senders:
+                jobs.put_nowait(None)
+        _, unfinished = await asyncio.wait([sender.task for sender in senders], timeout=SHUTDOWN_GRACE)
+        for task in unfinished:
+            task.cancel()
@@ -0,0 +1,202 @@
+"""
+Live progress output for simulate_traffic.py.
+
+Workers never print. They record into their own RunStats shard and, in verbose
+mode, append a sampled request's lines to a RequestLog ring buffer. A single
+StatusReporter thread prints the buffered lines and, every interval, one status
+line with the throughput, error rate and latency percentiles of each endpoint
+over that interval, so console I/O costs the same at 10 or 10,000 requests per
+second and no worker ever waits on the stdout lock. The same thread feeds the
+per-second time series of a MetricsRecorder.
+"""
+import collections
+import itertools
+import sys
+import threading
+import time
+
+from load_stats import RunStats, format_ms
+from metrics import METRICS_INTERVAL
+
+STATUS_INTERVAL = 5.0  # Seconds between status lines
+FLUSH_INTERVAL = 0.5  # Seconds between writes of buffered request lines
+LOG_CAPACITY = 10000  # Request lines buffered between writes; older ones are dropped
+STATUS_PERCENTILES = [('p50', 50), ('p99', 99)]
+
+
+class RequestLog:
+    """
+    Sampled per-request output lines.
+
+    Args:
+        sample_every (int, optional): Keep the lines of one request in this many (default is 1, all).
+        buffered (bool, optional): Keep lines for a StatusReporter to print instead of
+            printing them at once (default is True).
+        capacity (int, optional): The most lines kept between writes (default is LOG_CAPACITY).
+    """
+
+    def __init__(self, sample_every=1, buffered=True, capacity=LOG_CAPACITY):
+        self.sample_every = max(int(sample_every), 1)
+        self.buffered = buffered
+        # deque.append and popleft are atomic, so workers need no lock
+        self.lines = collections.deque(maxlen=capacity)
+        self._requests = itertools.count()
+        self._written = itertools.count()
+        self._drains = 0
+        self._popped = 0
+        self._dropped = 0
+
+    def sampled(self):
+        """
+        Returns True if the current request's lines should be kept.
+        """
+        return next(self._requests) % self.sample_every == 0
+
+    def write(self, line):
+        """
+        Adds one line of output.
+
+        Args:
+            line (str): The line, without a newline.
+
+        Returns:
+            None
+        """
+        if not self.buffered:
+            print(line)
+            return
+        self.lines.append(line)
+        next(self._written)  # Counted after the append, so drain() never sees a line as dropped early
+
+    def drain(self):
+        """
+        Removes and returns the buffered lines.
+
+        Returns:
+            tuple: (list of lines, number of lines dropped because the buffer was full)
+        """
+        # Every drain advances the write counter once too
+        written = next(self._written) - self._drains
+        self._drains += 1
+        lines = []
+        while True:
+            try:
+                lines.append(self.lines.popleft())
+            except IndexError:
+                break
+        self._popped += len(lines)
+        # Lines written before the count was read were either popped now or pushed out of the deque
+        dropped = max(written - self._popped - self._dropped, 0)
+        self._dropped += dropped
+        return lines, dropped
+
+
+def _interval_line(elapsed, interval, stats, previous):
+    requests = stats.total_requests() - previous.total_requests()
+    errors = stats.total_errors() - previous.total_errors()
+    parts = [f"[{elapsed:7.1f}s] {requests / max(interval, 1e-9):8.1f} req/s, "
+             f"{100.0 * errors / requests if requests else 0.0:5.1f}% errors"]
+    short_circuited = stats.total_short_circuited() - previous.total_short_circuited()
+    if short_circuited:
+        parts[0] += f", {short_circuited} short-circuited"
+    for (method, endpoint), counters in sorted(stats.endpoints.items()):
+        before = previous.endpoints.get((method, endpoint))
+        latency = counters.latency.since(before.latency) if before is not None else counters.latency
+        count = counters.requests - (before.requests if before is not None else 0)
+        parts.append(f"{method} {endpoint} {count}"
+                     + ''.join(f" {label} {format_ms(latency.percentile(pct))}" for label, pct in STATUS_PERCENTILES))
+    return ' | '.join(parts)
+
+
+class StatusReporter:
+    """
+    The one thread that writes live output while a load profile runs.
+
+    Args:
+        interval (float, optional): Seconds between status lines, 0 for none (default is STATUS_INTERVAL).
+        log (RequestLog, optional): Buffered request lines to print (default is None).
+        metrics (MetricsRecorder, optional): Sampled every METRICS_INTERVAL (default is None).
+    """
+
+    def __init__(self, interval=STATUS_INTERVAL, log=None, metrics=None):
+        self.interval = interval
+        self.log = log
+        self.metrics = metrics
+        self.watched = None
+        self.lock = threading.Lock()  # stage_done() flushes from the controller thread too
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def watch(self, stats, stage=0):
+        """
+        Reports on `stats` from now on, e.g. the RunStats of a new stage.
+
+        Args:
+            stats (RunStats): The stats the workers are recording into.
+            stage (int, optional): The index of the stage they belong to (default is 0).
+
+        Returns:
+            None
+        """
+        self.watched = (stats, time.monotonic(), RunStats(), 0.0, stage)
+
+    def start(self):
+        if self.interval or self.log is not None or self.metrics is not None:
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stops the thread after it has printed the remaining request lines and metrics.
+        """
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def flush(self):
+        """
+        Prints the buffered request lines now, e.g. before a stage summary.
+        """
+        if self.log is None:
+            return
+        with self.lock:
+            lines, dropped = self.log.drain()
+            if dropped:
+                lines.append(f"({dropped} request lines dropped, the console could not keep up)")
+            if lines:
+                # One write for the whole batch instead of one print per line
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+
+    def _status(self):
+        if self.watched is None:
+            return
+        stats, started, previous, previous_elapsed, stage = self.watched
+        snapshot = stats.merged()
+        elapsed = time.monotonic() - started
+        print(_interval_line(elapsed, elapsed - previous_elapsed, snapshot, previous), flush=True)
+        if self.watched[0] is stats:  # Unless a new stage started meanwhile
+            self.watched = (stats, started, snapshot, elapsed, stage)
+
+    def _sample(self):
+        if self.watched is not None:
+            self.metrics.sample(self.watched[0], self.watched[4])
+
+    def _run(self):
+        next_status = time.monotonic() + self.interval
+        next_sample = time.monotonic() + METRICS_INTERVAL if self.metrics is not None else float('inf')
+        try:
+            while not self.stopped.wait(min(FLUSH_INTERVAL, max(next_sample - time.monotonic(), 0))):
+                self.flush()
+                now = time.monotonic()
+                if now >= next_sample:
+                    self._sample()
+                    next_sample += METRICS_INTERVAL
+                if self.interval and now >= next_status:
+                    self._status()
+                    next_status += self.interval
+            self.flush()
+            if self.metrics is not None:
+                self._sample()  # The partial last second
+        finally:
+            if self.metrics is not None:
+                self.metrics.close()
@@ -0,0 +1,230 @@
+"""
+What the load engines do when requests fail, for simulate_traffic.py.
+
+Without this, a worker whose request gets no response (connection refused while
+`service_stop_restart.sh` has the service down, say) sends its next request at
+once, and every closed-loop worker spins at full CPU against a dead host. Two
+mechanisms keep the generator calm and the numbers honest:
+
+* Backoff: after a failed request a closed-loop worker waits an exponentially
+  growing, jittered delay before its next one (base * 2**(failures - 1), capped).
+  Open-loop workers keep to their schedule; their load is set by the rate and
+  bounded by the stage's in-flight limit.
+* Circuit breaker, one per endpoint: after N consecutive failures it opens and
+  requests to the endpoint are short-circuited (counted, not sent) for a
+  cooldown. Then it lets a few half-open probes through; the first one to succeed
+  closes it again, a failed one reopens it for another cooldown.
+
+A failure is a request without a response. Error statuses are responses: they
+mean the server is up, and error-injection runs should not change their pace.
+"""
+import argparse
+import collections
+import random
+import threading
+import time
+
+from stages import parse_duration
+
+JITTER_KINDS = ('full', 'equal', 'none')
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+PROBE_WAIT = 0.05  # Seconds a closed-loop worker without backoff waits while a breaker's probes are out
+
+
+class Backoff(collections.namedtuple('Backoff', 'base cap jitter')):
+    """
+    An exponential backoff policy.
+
+    Args:
+        base (float): Seconds to wait after the first failure.
+        cap (float): The longest wait in seconds.
+        jitter (str): 'full' waits a uniform random time up to the delay, 'equal' half the
+            delay plus up to as much again, 'none' the delay itself.
+    """
+    __slots__ = ()
+
+    def delay(self, failures):
+        """
+        Returns the seconds to wait after `failures` consecutive failures (0 for none).
+        """
+        if failures <= 0 or self.base <= 0:
+            return 0.0
+        delay = min(self.base * 2 ** min(failures - 1, 32), self.cap)
+        if self.jitter == 'full':
+            return random.uniform(0, delay)
+        if self.jitter == 'equal':
+            return delay / 2 + random.uniform(0, delay / 2)
+        return delay
+
+    def describe(self):
+        return f"backoff {self.base:g}s to {self.cap:g}s, {self.jitter} jitter"
+
+
+DEFAULT_BACKOFF = Backoff(0.05, 2.0, 'full')
+
+
+def parse_backoff(text):
+    """
+    Parses a '--backoff' argument of the form BASE[:CAP[:JITTER]], e.g. '0.05:2s:full', or '0' for none.
+
+    Raises:
+        argparse.ArgumentTypeError: If the text is not a valid policy.
+    """
+    parts = text.split(':')
+    try:
+        if len(parts) > 3:
+            raise ValueError("expected BASE[:CAP[:JITTER]]")
+        base = parse_duration(parts[0])
+        if base <= 0:
+            return None
+        cap = parse_duration(parts[1]) if len(parts) > 1 else DEFAULT_BACKOFF.cap
+        jitter = parts[2] if len(parts) > 2 else DEFAULT_BACKOFF.jitter
+        if jitter not in JITTER_KINDS:
+            raise ValueError(f"unknown jitter {jitter!r} (use {', '.join(JITTER_KINDS)})")
+        return Backoff(base, max(cap, base), jitter)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid backoff {text!r}: {e}")
+
+
+class BreakerPolicy(collections.namedtuple('BreakerPolicy', 'failures cooldown probes')):
+    """
+    When a circuit breaker opens and how it recovers.
+
+    Args:
+        failures (int): Consecutive failures that open the breaker.
+        cooldown (float): Seconds it stays open before letting probes through.
+        probes (int): The most half-open probe requests in flight at once.
+    """
+    __slots__ = ()
+
+    def describe(self):
+        return f"circuit breaker at {self.failures} failures, {self.cooldown:g}s cooldown, {self.probes} probe(s)"
+
+
+def parse_breaker(text):
+    """
+    Parses a '--circuit-breaker' argument of the form FAILURES[:COOLDOWN[:PROBES]], e.g. '5:10s:1'.
+
+    Raises:
+        argparse.ArgumentTypeError: If the text is not a valid policy.
+    """
+    parts = text.split(':')
+    try:
+        if len(parts) > 3:
+            raise ValueError("expected FAILURES[:COOLDOWN[:PROBES]]")
+        policy = BreakerPolicy(int(parts[0]), parse_duration(parts[1]) if len(parts) > 1 else 5.0,
+                               int(parts[2]) if len(parts) > 2 else 1)
+        if policy.failures < 1 or policy.cooldown <= 0 or policy.probes < 1:
+            raise ValueError("failures, cooldown and probes must be positive")
+        return policy
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid circuit breaker {text!r}: {e}")
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker for one endpoint, shared by all of its workers.
+
+    Args:
+        policy (BreakerPolicy): When to open and how to recover.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = 0
+        self.reopens_at = 0.0
+        self.opened = 0  # Times the breaker has opened, for reporting
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns True if a request may be sent now, False if it is short-circuited.
+        """
+        if self.state == CLOSED:  # Unlocked fast path; a stale read only lets one more request through
+            return True
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() < self.reopens_at:
+                    return False
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self.probing >= self.policy.probes:
+                    return False
+                self.probing += 1
+            return True
+
+    def record(self, failed):
+        """
+        Records the outcome of a request that `allow()` let through.
+
+        Args:
+            failed (bool): True if the request got no response.
+
+        Returns:
+            None
+        """
+        if not failed and self.state == CLOSED and not self.failures:
+            return
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = max(self.probing - 1, 0)
+                if failed:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self.failures = 0
+            elif self.state == CLOSED:
+                if not failed:
+                    self.failures = 0
+                else:
+                    self.failures += 1
+                    if self.failures >= self.policy.failures:
+                        self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.failures = 0
+        self.probing = 0
+        self.reopens_at = time.monotonic() + self.policy.cooldown
+        self.opened += 1
+
+
+class FailureGuard:
+    """
+    The failure handling of one worker: its own backoff and its endpoint's shared breaker.
+
+    Args:
+        backoff (Backoff, optional): The backoff policy (default is None, no waiting).
+        breaker (CircuitBreaker, optional): The endpoint's breaker (default is None, always send).
+    """
+
+    def __init__(self, backoff=None, breaker=None):
+        self.backoff = backoff
+        self.breaker = breaker
+        self.failures = 0
+
+    def allow(self):
+        return self.breaker is None or self.breaker.allow()
+
+    def short_circuited(self):
+        """
+        Returns the seconds a closed-loop worker should wait after a short-circuited request.
+        """
+        self.failures += 1
+        if self.backoff is not None:
+            return self.backoff.delay(self.failures)
+        return max(self.breaker.reopens_at - time.monotonic(), PROBE_WAIT)
+
+    def done(self, failed):
+        """
+        Records the outcome of a sent request and returns the seconds to wait before the next one.
+        """
+        if self.breaker is not None:
+            self.breaker.record(failed)
+        if not failed:
+            self.failures = 0
+            return 0.0
+        self.failures += 1
+        return self.backoff.delay(self.failures) if self.backoff is not None else 0.0
@@ -0,0 +1,170 @@
+"""
+Compact binary log of every request in a run, for offline analysis.
+
+The file is a HEADER_SIZE-byte header followed by fixed-width little-endian
+records, so it can be memory-mapped (e.g. numpy.memmap with RECORD_DTYPE at
+offset HEADER_SIZE) and read without parsing:
+
+    time_us     int64   completion time, microseconds since the epoch
+    latency_us  uint32  UNTIMED for requests that failed before a response
+    bytes       uint32  response body bytes
+    status      uint16  0 for requests that got no response
+    endpoint    uint16  index into the header's "endpoints" list
+    method      uint8   index into the header's "methods" list
+    (3 padding bytes, for 24-byte records)
+
+The header is the magic string followed by a JSON object, padded with spaces.
+It is rewritten in place whenever a new endpoint name shows up. Workers only
+append a tuple to a deque; a writer thread packs them and appends them to the
+file in large batches.
+"""
+import collections
+import json
+import struct
+import threading
+import time
+
+MAGIC = b'SMRESLT1'
+HEADER_SIZE = 4096
+RECORD = struct.Struct('<qIIHHB3x')
+UNTIMED = 0xFFFFFFFF
+METHODS = ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS']
+FLUSH_INTERVAL = 1.0  # Seconds between batch writes
+FLUSH_BATCH = 100000  # Records that trigger a write before the interval is up
+
+# The same layout for NumPy: numpy.dtype(RECORD_DTYPE)
+RECORD_DTYPE = [('time_us', '<i8'), ('latency_us', '<u4'), ('bytes', '<u4'), ('status', '<u2'),
+                ('endpoint', '<u2'), ('method', 'u1'), ('pad', 'V3')]
+
+
+class ResultLog:
+    """
+    Appends every recorded request of a run to a binary results file.
+
+    Attach it to the RunStats of a run (`stats.results = log`); their shards pick it up.
+
+    Args:
+        path (str): The file to write. A results file that already exists is appended to,
+            so runs done one after the other (e.g. capacity-search levels) share one file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.endpoints = {}
+        self.methods = {method: index for index, method in enumerate(METHODS)}
+        self.pending = collections.deque()
+        self.written = 0
+        try:
+            header = read_header(path)
+        except (OSError, ValueError):
+            self.file = open(path, 'wb')
+            self._write_header()
+        else:
+            self.file = open(path, 'r+b')
+            self.file.seek(0, 2)
+            self.methods = {method: index for index, method in enumerate(header['methods'])}
+            self.endpoints = {endpoint: index for index, endpoint in enumerate(header['endpoints'])}
+            self.written = (self.file.tell() - HEADER_SIZE) // RECORD.size
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, method, endpoint, status_code, latency, size):
+        """
+        Queues one request for writing; called on the hot path by RunStats.record.
+        """
+        self.pending.append((time.time(), method, endpoint, status_code, latency, size))
+
+    def close(self):
+        """
+        Writes everything still queued and closes the file.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self._flush()
+        self._write_header()
+        self.file.close()
+
+    def _write_header(self):
+        header = {'record_size': RECORD.size, 'fields': [name for name, _ in RECORD_DTYPE[:-1]],
+                  'untimed': UNTIMED, 'methods': list(self.methods),
+                  'endpoints': sorted(self.endpoints, key=self.endpoints.get), 'records': self.written}
+        encoded = MAGIC + json.dumps(header).encode()
+        if len(encoded) > HEADER_SIZE:
+            raise ValueError(f"Too many endpoint names for the {HEADER_SIZE}-byte results header")
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(encoded.ljust(HEADER_SIZE, b' '))
+        self.file.seek(max(position, HEADER_SIZE))
+
+    def _flush(self):
+        count = len(self.pending)
+        if not count:
+            return
+        endpoints = self.endpoints
+        methods = self.methods
+        pack = RECORD.pack
+        new_names = False
+        chunk = bytearray()
+        popleft = self.pending.popleft
+        for _ in range(count):
+            stamp, method, endpoint, status_code, latency, size = popleft()
+            endpoint_id = endpoints.get(endpoint)
+            if endpoint_id is None:
+                endpoint_id = endpoints[endpoint] = len(endpoints)
+                new_names = True
+            method_id = methods.get(method)
+            if method_id is None:
+                method_id = methods[method] = len(methods)
+                new_names = True
+            latency_us = UNTIMED if latency is None else min(int(latency * 1000000), UNTIMED - 1)
+            chunk += pack(int(stamp * 1000000), latency_us, min(size, 0xFFFFFFFF), status_code or 0,
+                          endpoint_id, method_id)
+        if new_names:
+            self._write_header()
+        self.file.write(chunk)
+        self.file.flush()
+        self.written += count
+
+    def _run(self):
+        next_flush = time.monotonic() + FLUSH_INTERVAL
+        while not self.stopped.wait(0.1):
+            if len(self.pending) >= FLUSH_BATCH or time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + FLUSH_INTERVAL
+
+
+def read_header(path):
+    """
+    Returns the JSON header of a results file.
+
+    Raises:
+        ValueError: If the file is not a results file.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_SIZE)
+    if not head.startswith(MAGIC):
+        raise ValueError(f"{path} is not a results file")
+    return json.loads(head[len(MAGIC):].rstrip(b' '))
+
+
+def load_records(path):
+    """
+    Memory-maps the records of a results file with NumPy.
+
+    Args:
+        path (str): The results file.
+
+    Returns:
+        tuple: (header dict, numpy record array backed by the file)
+    """
+    import numpy  # Only the analysis side needs NumPy
+
+    header = read_header(path)
+    dtype = numpy.dtype(RECORD_DTYPE)
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        count = (f.tell() - HEADER_SIZE) // dtype.itemsize
+    if not count:
+        return header, numpy.zeros(0, dtype=dtype)
+    return header, numpy.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
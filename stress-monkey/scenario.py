@@ -0,0 +1,130 @@
+"""
+ID-tracking scenario support for simulate_traffic.py.
+
+Instead of listing every task with GET /todos after each POST, created task IDs
+are read from the POST response and kept in a bounded in-memory pool. Endpoints
+containing ID_PLACEHOLDER (e.g. '/todos/<id>') draw an ID from that pool, so
+the cost of an iteration does not grow with the size of the todos table.
+"""
+import random
+import threading
+
+ID_PLACEHOLDER = '<id>'
+LOOKUP_EVERY = 20  # Without IDs in POST responses, only every Nth POST pays for a GET /todos
+LOOKUP_SAMPLE = 50  # IDs to keep from one GET /todos lookup
+
+
+class TaskIdPool:
+    """
+    A bounded, thread-safe pool of task IDs known to exist.
+
+    Once full, new IDs overwrite the oldest slots, so memory stays fixed however long
+    the run is.
+
+    Args:
+        capacity (int, optional): The most IDs to keep (default is 10000).
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.ids = []
+        self.next_slot = 0
+        self.posts_without_id = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, task_id):
+        """
+        Adds a created task ID to the pool.
+
+        Args:
+            task_id (int): The ID to add.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            if len(self.ids) < self.capacity:
+                self.ids.append(task_id)
+            else:
+                self.ids[self.next_slot % len(self.ids)] = task_id
+                self.next_slot += 1
+
+    def take(self, remove=False):
+        """
+        Returns a random ID from the pool.
+
+        Args:
+            remove (bool, optional): Also remove it, e.g. before deleting the task (default is False).
+
+        Returns:
+            int: The ID, or None if the pool is empty.
+        """
+        with self.lock:
+            if not self.ids:
+                return None
+            index = random.randrange(len(self.ids))
+            task_id = self.ids[index]
+            if remove:
+                # Swap with the last entry so removal stays O(1)
+                self.ids[index] = self.ids[-1]
+                self.ids.pop()
+            return task_id
+
+    def should_lookup(self):
+        """
+        Returns True for every LOOKUP_EVERY-th POST whose response carried no task ID.
+        """
+        with self.lock:
+            self.posts_without_id += 1
+            return self.posts_without_id % LOOKUP_EVERY == 1
+
+    def add_from_listing(self, payload):
+        """
+        Adds a sample of the task IDs in a GET /todos response body.
+
+        Args:
+            payload (dict): The decoded response, with a 'tasks' list.
+
+        Returns:
+            int: How many IDs were added.
+        """
+        task_ids = [task.get('task_id') for task in payload.get('tasks', []) if task.get('task_id') is not None]
+        if len(task_ids) > LOOKUP_SAMPLE:
+            # Favour the newest tasks; they are the least likely to have been deleted already
+            task_ids = task_ids[-LOOKUP_SAMPLE:]
+        for task_id in task_ids:
+            self.add(task_id)
+        return len(task_ids)
+
+
+def created_task_id(payload):
+    """
+    Returns the task ID from a POST /todos response, if it carries one.
+
+    The todo API wraps the new task in a single-key object (e.g. {'newly added task': {...}}),
+    so one level of nesting is searched as well.
+
+    Args:
+        payload (dict): The decoded response body.
+
+    Returns:
+        int: The task ID, or None if the response has none.
+    """
+    if not isinstance(payload, dict):
+        return None
+    if payload.get('task_id') is not None:
+        return payload['task_id']
+    for value in payload.values():
+        if isinstance(value, dict) and value.get('task_id') is not None:
+            return value['task_id']
+    return None
+
+
+def collection_endpoint(endpoint):
+    """
+    Returns the listing endpoint for an ID endpoint, e.g. '/todos' for '/todos/<id>'.
+    """
+    return endpoint.split(ID_PLACEHOLDER)[0].rstrip('/')
@@ -0,0 +1,157 @@
+"""
+Server-side request stats for simulate_traffic.py --server-stats.
+
+The deployed gunicorn_config.py (ansible-project/roles/flask_backend/templates)
+counts every request in shared memory per gunicorn worker and serves the
+counts as JSON on 127.0.0.1:9102/stats, or dumps them to GUNICORN_STATS_FILE.
+ServerStatsScraper reads them at the start of the run and after every stage,
+and prints the server's view of the stage: how the requests spread over the
+workers, how long the app took for them, and the most connections waiting in
+the accept queue and requests in flight, polled every POLL_INTERVAL seconds.
+Latency the generator saw beyond the server's is time outside the workers:
+the network, connection setup and the accept queue.
+
+Run the load generator on the server to scrape the local endpoint, or tunnel
+it (`ssh -L 9102:127.0.0.1:9102 backend`).
+"""
+import json
+import math
+import threading
+import urllib.request
+
+from load_stats import format_ms
+
+POLL_INTERVAL = 1.0  # Seconds between scrapes for the accept queue and in-flight peaks
+SCRAPE_TIMEOUT = 5.0
+
+
+def fetch(source):
+    """
+    Returns the stats snapshot at `source`, an http:// URL or the path of a stats file.
+
+    Raises:
+        OSError, ValueError: If the stats cannot be read.
+    """
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source, timeout=SCRAPE_TIMEOUT) as response:
+            return json.load(response)
+    with open(source) as f:
+        return json.load(f)
+
+
+def _counts(summary):
+    # requests, 4xx, 5xx, total ms and the histogram (upper bound in ms -> count) of a snapshot entry
+    if summary is None:
+        return 0, 0, 0, 0.0, {}
+    requests = summary['requests']
+    return (requests, summary['client_errors'], summary['server_errors'], (summary['mean_ms'] or 0) * requests,
+            {upper: count for upper, count in summary['histogram']})
+
+
+def _difference(after, before):
+    requests, client_errors, server_errors, total_ms, histogram = _counts(after)
+    earlier = _counts(before)
+    histogram = {upper: count - earlier[4].get(upper, 0) for upper, count in histogram.items()}
+    return [requests - earlier[0], client_errors - earlier[1], server_errors - earlier[2],
+            total_ms - earlier[3], histogram]
+
+
+def _percentile(histogram, requests, pct):
+    wanted, seen = math.ceil(requests * pct / 100), 0
+    for upper in sorted(histogram):
+        seen += histogram[upper]
+        if seen >= wanted and seen:
+            return upper / 1000
+    return None
+
+
+class ServerStatsScraper:
+    """
+    Scrapes the gunicorn request stats around each stage of a run.
+
+    Args:
+        source (str): The stats URL (e.g. http://127.0.0.1:9102/stats) or stats file.
+        interval (float, optional): Seconds between peak polls (default is POLL_INTERVAL).
+    """
+
+    def __init__(self, source, interval=POLL_INTERVAL):
+        self.source = source
+        self.interval = interval
+        self.baseline = None
+        self.error = None
+        self.peak_queued = None
+        self.peak_active = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._poll, daemon=True)
+
+    def start(self):
+        self.baseline = self._scrape()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _scrape(self):
+        try:
+            snapshot = fetch(self.source)
+        except (OSError, ValueError) as e:
+            self.error = e
+            return None
+        self.error = None
+        queued = snapshot.get('listen_queue')
+        if queued is not None and (self.peak_queued is None or queued > self.peak_queued):
+            self.peak_queued = queued
+        self.peak_active = max(self.peak_active, sum(worker['active'] for worker in snapshot['workers']))
+        return snapshot
+
+    def _poll(self):
+        while not self.stopped.wait(self.interval):
+            self._scrape()
+
+    def stage_end(self, label):
+        """
+        Prints the server's stats since the last call (or the start), titled with `label`.
+        """
+        after = self._scrape()
+        before = self.baseline
+        if after is None:
+            print(f"\nServer stats for {label}: cannot read {self.source}: {self.error!r}")
+            return
+        if before is not None and before['master_pid'] != after['master_pid']:
+            print(f"\nServer stats for {label}: gunicorn restarted (master {before['master_pid']} -> "
+                  f"{after['master_pid']}); counts are since it started")
+            before = None
+        self.print_stage(label, after, before)
+        self.baseline = after
+        self.peak_queued = after.get('listen_queue')
+        self.peak_active = sum(worker['active'] for worker in after['workers'])
+
+    def print_stage(self, label, after, before):
+        earlier = {worker['pid']: worker for worker in before['workers']} if before is not None else {}
+        rows = [(str(worker['pid']), _difference(worker, earlier.get(worker['pid'])))
+                for worker in sorted(after['workers'], key=lambda worker: worker['pid'])]
+        # Workers that exited since `before` moved into the retired totals with all their requests
+        exited = _difference(after['retired'], before['retired'] if before is not None else None)
+        pids = {worker['pid'] for worker in after['workers']}
+        for pid, worker in earlier.items():
+            if pid not in pids:
+                gone = _counts(worker)
+                for index in range(4):
+                    exited[index] -= gone[index]
+                for upper, count in gone[4].items():
+                    exited[4][upper] = exited[4].get(upper, 0) - count
+        if exited[0]:
+            rows.append(('exited', exited))
+        total = _difference(after['total'], before['total'] if before is not None else None)
+        rows.append(('total', total))
+        print(f"\nServer stats for {label} (gunicorn workers, latencies in ms)")
+        print(f"{'worker':<10}{'requests':>10}{'share':>8}{'4xx':>8}{'5xx':>8}{'mean':>9}{'p50':>9}{'p99':>9}")
+        for name, (requests, client_errors, server_errors, total_ms, histogram) in rows:
+            share = f"{100.0 * requests / total[0]:.1f}%" if total[0] else '-'
+            mean = f"{total_ms / requests:.1f}" if requests else '-'
+            print(f"{name:<10}{requests:>10}{share:>8}{client_errors:>8}{server_errors:>8}{mean:>9}"
+                  f"{format_ms(_percentile(histogram, requests, 50)):>9}"
+                  f"{format_ms(_percentile(histogram, requests, 99)):>9}")
+        queued = '-' if self.peak_queued is None else self.peak_queued
+        print(f"Peak accept queue: {queued} connections waiting (backlog {after.get('backlog', '-')}); "
+              f"peak in flight in the workers: {self.peak_active}")
@@ -0,0 +1,345 @@
+"""
+Probabilistic user sessions for simulate_traffic.py.
+
+Instead of pinning each worker to one endpoint, a SessionModel describes how a
+user moves through the todo app: every action (e.g. list, create, toggle,
+delete) is one request, followed by a think time drawn from a distribution
+and a weighted random choice of the next action, until the session reaches
+END and a new user takes its place. The default model is read-heavy, the way
+real users are: most sessions list their todos, a few create or toggle
+tasks, and fewer still delete one.
+
+Actions on '<id>' paths work on tasks the session has seen: the ones it
+created and a few picked from its GET /todos listings. DELETE only removes
+tasks the session created itself, so users do not delete each other's tasks
+out from under one another. An action that needs an ID the session does not
+have is skipped, without a request. Sessions are coroutines on one event
+loop (the async engine), and a thinking session costs a timer and no thread,
+so 10,000+ concurrent sessions fit on one load box.
+
+A model can also be loaded from JSON:
+
+    {"start": "list", "think": "lognormal:3:0.8",
+     "actions": {
+        "list":   {"method": "GET", "path": "/todos", "next": {"create": 30, "toggle": 40, "end": 30}},
+        "create": {"method": "POST", "path": "/todos", "body": {"title": "Buy milk"},
+                   "think": "exp:8", "next": {"list": 70, "end": 30}},
+        "toggle": {"method": "PUT", "path": "/todos/<id>", "body": {"is_done": true},
+                   "next": {"list": 50, "toggle": 20, "end": 30}}}}
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import itertools
+import json
+import math
+import random
+import time
+
+from async_engine import REQUEST_ERRORS, AsyncHTTPConnection, _target
+from payloads import Choice, Sequence
+from scenario import ID_PLACEHOLDER, created_task_id
+from stages import CONTROL_INTERVAL, SHUTDOWN_GRACE, with_start_levels
+
+END = 'end'
+SESSION_IDS = 5  # Task IDs a session remembers from listings (besides the ones it created)
+THINK_KINDS = ('const', 'uniform', 'exp', 'lognormal')
+
+
+class ThinkTime(collections.namedtuple('ThinkTime', 'kind a b')):
+    """
+    A think-time distribution, in seconds.
+
+    'const' waits `a`; 'uniform' between `a` and `b`; 'exp' has mean `a`;
+    'lognormal' has median `a` and shape `b` (the sigma of the underlying normal).
+    """
+    __slots__ = ()
+
+    def sample(self):
+        if self.kind == 'const':
+            return self.a
+        if self.kind == 'uniform':
+            return random.uniform(self.a, self.b)
+        if self.kind == 'exp':
+            return random.expovariate(1.0 / self.a) if self.a > 0 else 0.0
+        return random.lognormvariate(math.log(self.a), self.b) if self.a > 0 else 0.0
+
+    def describe(self):
+        return ':'.join([self.kind, f"{self.a:g}"] + ([f"{self.b:g}"] if self.kind in ('uniform', 'lognormal') else []))
+
+
+def parse_think(spec):
+    """
+    Parses a think time such as '2', 'const:2', 'uniform:1:5', 'exp:3' or 'lognormal:3:0.8'.
+
+    Raises:
+        argparse.ArgumentTypeError: If the spec is not one of those forms.
+    """
+    parts = str(spec).split(':')
+    if len(parts) == 1:
+        parts = ['const'] + parts
+    kind = parts[0]
+    if kind not in THINK_KINDS:
+        raise argparse.ArgumentTypeError(f"unknown think time distribution {kind!r} in {spec!r} "
+                                         f"(use one of {', '.join(THINK_KINDS)})")
+    try:
+        values = [float(part) for part in parts[1:]]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid think time {spec!r}: {e}")
+    if kind == 'lognormal' and len(values) == 1:
+        values.append(1.0)
+    expected = 2 if kind in ('uniform', 'lognormal') else 1
+    if len(values) != expected or any(value < 0 for value in values):
+        raise argparse.ArgumentTypeError(f"invalid think time {spec!r}, expected e.g. const:2, uniform:1:5, "
+                                         f"exp:3 or lognormal:3:0.8")
+    return ThinkTime(kind, values[0], values[1] if len(values) > 1 else None)
+
+
+class Action(collections.namedtuple('Action', 'name method path data think next')):
+    """
+    One step of a session: a request, how long the user thinks afterwards, and where they go next.
+
+    Args:
+        name (str): The action's name, used in transitions.
+        method (str): The HTTP method.
+        path (str): The endpoint, possibly containing '<id>'.
+        data (dict): The request body, possibly holding payloads slots (None for no body).
+        think (ThinkTime): The think time after this action (None for the model's default).
+        next (dict): Next action name (or END) -> relative weight.
+    """
+    __slots__ = ()
+
+
+class SessionModel:
+    """
+    Weighted state transitions over a set of actions.
+
+    Args:
+        actions (list): The Action list.
+        start (str): The name of every session's first action.
+        think (ThinkTime): The think time of actions that do not set one.
+        name (str, optional): Shown in summaries (default is 'custom').
+
+    Raises:
+        ValueError: If a transition points at an unknown action or an action has no way on.
+    """
+
+    def __init__(self, actions, start, think, name='custom'):
+        self.actions = {action.name: action for action in actions}
+        self.start = start
+        self.think = think
+        self.name = name
+        self.source = None  # The JSON form the model was built from, if any
+        if start not in self.actions:
+            raise ValueError(f"Unknown start action {start!r}")
+        self.choices = {}
+        for action in actions:
+            targets = [(target, weight) for target, weight in action.next.items() if weight > 0]
+            unknown = [target for target, _ in targets if target != END and target not in self.actions]
+            if unknown or not targets:
+                raise ValueError(f"Action {action.name!r} needs transitions to known actions or {END!r}"
+                                 + (f", not {', '.join(unknown)}" if unknown else ''))
+            names = [target for target, _ in targets]
+            self.choices[action.name] = (names, list(itertools.accumulate(weight for _, weight in targets)))
+
+    def next_action(self, name):
+        """
+        Returns the name of a random next action after `name`, by weight (END to end the session).
+        """
+        names, cumulative = self.choices[name]
+        return names[bisect.bisect(cumulative, random.random() * cumulative[-1])]
+
+    def endpoints(self):
+        """
+        Returns the (endpoint, method) pairs the model sends to.
+        """
+        return sorted({(action.path, action.method) for action in self.actions.values()})
+
+    def describe(self):
+        return f"{self.name} sessions, think {self.think.describe()}"
+
+    @classmethod
+    def from_dict(cls, data, name='custom'):
+        """
+        Builds a model from its JSON form (see the module docstring).
+        """
+        think = parse_think(data.get('think', 'lognormal:3:0.8'))
+        actions = [Action(action_name, spec['method'].upper(), spec['path'], spec.get('body'),
+                          parse_think(spec['think']) if 'think' in spec else None, spec['next'])
+                   for action_name, spec in data['actions'].items()]
+        model = cls(actions, data['start'], think, name=name)
+        model.source = data
+        return model
+
+
+def load_model(path):
+    """
+    Loads a SessionModel from a JSON file.
+    """
+    with open(path) as f:
+        return SessionModel.from_dict(json.load(f), name=path)
+
+
+# Read-heavy: most sessions look at their list, some add or complete a task, few delete one
+todo_session_model = SessionModel([
+    Action('list', 'GET', '/todos', None, None,
+           {'create': 20, 'toggle': 25, 'list': 10, 'delete': 5, END: 40}),
+    Action('create', 'POST', '/todos',
+           {'title': Sequence('Send in the Storm Troopers #'), 'description': 'Resistance is futile'},
+           parse_think('lognormal:8:0.6'),  # Typing the task takes longer than a click
+           {'list': 50, 'create': 15, 'toggle': 10, 'delete': 5, END: 20}),
+    Action('toggle', 'PUT', '/todos/<id>', {'is_done': Choice(True, False)}, None,
+           {'toggle': 25, 'list': 30, 'delete': 10, END: 35}),
+    Action('delete', 'DELETE', '/todos/<id>', None, None,
+           {'list': 50, 'delete': 10, END: 40}),
+], start='list', think=parse_think('lognormal:3:0.8'), name='todo')
+
+
+class _Session:
+    """
+    One simulated user, running sessions back to back until stopped.
+    """
+
+    def __init__(self, model, targets, host, port, stats, log, keep_alive, max_keepalive):
+        self.model = model
+        self.targets = targets  # Action name -> (path, RequestBody)
+        self.stats = stats
+        self.log = log
+        self.conn = AsyncHTTPConnection(host, port, keep_alive=keep_alive, stats=stats, max_keepalive=max_keepalive)
+        self.stopped = False
+        self.thinking = False
+        self.task = asyncio.ensure_future(self._run())
+
+    def retarget(self, stats):
+        self.stats = stats
+        self.conn.stats = stats
+
+    def stop(self):
+        self.stopped = True
+        if self.thinking:
+            self.task.cancel()  # Nothing in flight to finish
+
+    async def _run(self):
+        model = self.model
+        try:
+            while not self.stopped:
+                seen = []  # Task IDs from this user's listings
+                created = []
+                name = model.start
+                while name != END and not self.stopped:
+                    action = model.actions[name]
+                    await self._perform(action, seen, created)
+                    self.thinking = True
+                    await asyncio.sleep((action.think or model.think).sample())
+                    self.thinking = False
+                    name = model.next_action(name)
+        finally:
+            self.conn.close()
+
+    async def _perform(self, action, seen, created):
+        path, body = self.targets[action.name]
+        endpoint = action.path
+        task_id = None
+        if ID_PLACEHOLDER in endpoint:
+            if action.method == 'DELETE':
+                if not created:
+                    return  # Nothing of its own to delete
+                task_id = created.pop(random.randrange(len(created)))
+                if task_id in seen:
+                    seen.remove(task_id)
+            else:
+                if not seen and not created:
+                    return  # Nothing to work on yet
+                index = random.randrange(len(seen) + len(created))
+                task_id = seen[index] if index < len(seen) else created[index - len(seen)]
+            path = path.replace(ID_PLACEHOLDER, str(task_id))
+        say = self.log is not None and self.log.sampled()
+        stats = self.stats
+        try:
+            started = time.perf_counter()
+            status, payload = await self.conn.request(action.method, path, body.render())
+            stats.record(action.method, endpoint, status, time.perf_counter() - started, len(payload))
+            # Listings get big, so they are only parsed while the session still needs IDs
+            learn = action.method == 'POST' or len(seen) < SESSION_IDS
+            if status < 300 and payload and task_id is None and learn:
+                self._learn(json.loads(payload), seen, created)
+            if say:
+                self.log.write(f"Session {action.name}: {action.method} {path} {status}. May the Force be with you.")
+        except REQUEST_ERRORS as e:
+            stats.record(action.method, endpoint, None)
+            if say:
+                self.log.write(f"Session {action.name}: {action.method} {path} failed: {e!r}. "
+                               f"I've got a bad feeling about this.")
+
+    @staticmethod
+    def _learn(payload, seen, created):
+        task_id = created_task_id(payload)
+        if task_id is not None:
+            created.append(task_id)
+        elif isinstance(payload, dict):
+            task_ids = [task.get('task_id') for task in payload.get('tasks', [])
+                        if isinstance(task, dict) and task.get('task_id') is not None]
+            seen.extend(random.sample(task_ids, min(SESSION_IDS - len(seen), len(task_ids))))
+
+
+async def run_sessions_async(base_url, model, stages, stage_stats, log=None, keep_alive=False, max_keepalive=0,
+                             stage_done=None):
+    """
+    Runs a staged profile of concurrent user sessions on the async engine.
+
+    Each stage's worker count is the number of concurrent sessions; sessions are added
+    and stopped live to follow the ramp.
+
+    Args:
+        base_url (str): The base URL of the API.
+        model (SessionModel): What the users do.
+        stages (list): The Stage list of the profile (session counts, not rates).
+        stage_stats (list): One RunStats per stage to record into.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        keep_alive (bool, optional): Keep each session's connection open between requests (default is False).
+        max_keepalive (int, optional): Reconnect after this many requests on one connection (0 for no limit).
+        stage_done (callable, optional): Called with the stage index as each stage ends.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If a stage is an open-loop rate stage.
+    """
+    if any(stage.open_loop for stage in stages):
+        raise ValueError("Session stages take a number of concurrent sessions, not a rate")
+    targets = {}
+    host = port = None
+    for action in model.actions.values():
+        host, port, path, body = _target(base_url, action.path, action.data)
+        targets[action.name] = (path, body)
+    sessions = []
+    try:
+        for index, (stage, start_level) in enumerate(with_start_levels(stages)):
+            # All sessions run on this one thread, so they share one shard per stage: a shard per
+            # session would hold a set of histograms per user and make every merge walk them all
+            shard = stage_stats[index].shard()
+            for session in sessions:
+                session.retarget(shard)
+            started = time.perf_counter()
+            ends = started + stage.duration
+            now = started
+            while now < ends:
+                count = round(stage.level(start_level, now - started))
+                while len(sessions) < count:
+                    sessions.append(_Session(model, targets, host, port, shard, log, keep_alive, max_keepalive))
+                while len(sessions) > count:
+                    sessions.pop().stop()
+                await asyncio.sleep(max(min(now + CONTROL_INTERVAL, ends) - time.perf_counter(), 0))
+                now = time.perf_counter()
+            if stage_done is not None:
+                stage_done(index)
+    finally:
+        for session in sessions:
+            session.stop()
+        tasks = [session.task for session in sessions]
+        if tasks:
+            _, unfinished = await asyncio.wait(tasks, timeout=SHUTDOWN_GRACE)
+            for task in unfinished:
+                task.cancel()
@@ -1,74 +1,802 @@
+import argparse
+import asyncio
+import atexit
+import math
+import multiprocessing
+import os
+import queue
 import requests
+import signal
 import threading
-import json
 import time
 
+from requests.adapters import HTTPAdapter
+
+from async_engine import run_stages_async
+from capacity import parse_slo, print_capacity_header, print_level, search_capacity
+from load_stats import RunStats, RunTimer, print_phase_growth, print_summary
+from metrics import MetricsRecorder
+import payloads
+from payloads import PUT_DONE_BODY, Choice, Sequence, compile_body
+from raw_client import RawHTTPClient, send_pipelined
+from replay import AccessLogReplay, run_replay_async
+from recovery import RecoveryMonitor
+from reporter import STATUS_INTERVAL, RequestLog, StatusReporter
+from resilience import DEFAULT_BACKOFF, CircuitBreaker, FailureGuard, parse_backoff, parse_breaker
+from results_log import ResultLog
+from server_stats import ServerStatsScraper
+from scenario import ID_PLACEHOLDER, TaskIdPool, collection_endpoint, created_task_id
+from sessions import load_model, parse_think, run_sessions_async, todo_session_model
+from stages import (CONTROL_INTERVAL, DEFAULT_MAX_IN_FLIGHT, SHUTDOWN_GRACE, Stage, next_arrival, parse_duration,
+                    parse_stage, shard_stage, with_start_levels)
+from todo_server import TodoServer
+
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+EMPTY_POOL_BACKOFF = 0.1  # Seconds an ID-tracking worker waits when there is no task to work on
+DEFAULT_DURATION = 60  # Seconds of the single stage given by --threads or --rate
+
+
+class OneShotClient:
+    """
+    Sends every request with the module-level `requests` functions, so each one
+    opens (and tears down) its own TCP connection.
 
-def send_request(base_url, endpoint, method='GET', data=None):
-    url = f"{base_url}{endpoint}"
-    headers = {'Content-Type': 'application/json'}
-    while True:  # Continuously send requests
+    Args:
+        stats (RunStats): Where to count connections.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def request(self, method, url, **kwargs):
+        self.stats.record_connection(reused=False)
+        return requests.request(method, url, **kwargs)
+
+    def close(self):
+        pass
+
+
+class PooledClient:
+    """
+    Sends every request through one reusable keep-alive `requests.Session`.
+
+    Args:
+        stats (RunStats): Where to count new vs. reused connections.
+        pool_size (int, optional): Maximum connections the session keeps per host (default is 1).
+        max_keepalive (int, optional): Drop the pooled connections after this many
+            requests and reconnect (default is 0, no limit).
+    """
+
+    def __init__(self, stats, pool_size=1, max_keepalive=0):
+        self.stats = stats
+        self.max_keepalive = max_keepalive
+        self.served = 0
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self._connections_seen = {}
+
+    def request(self, method, url, **kwargs):
+        if self.max_keepalive and self.served >= self.max_keepalive:
+            self.adapter.close()  # Closes the pooled connections; the next request reconnects
+            self._connections_seen.clear()
+            self.served = 0
         try:
-            if method == 'GET':
-                response = requests.get(url)
-            elif method == 'POST':
-                response = requests.post(url, headers=headers, data=json.dumps(data))
-                if response.status_code == 201:  # If the POST request was successful
-                    # Make a GET request to retrieve the 'task_id'
-                    get_response = requests.get(url)
-                    if get_response.status_code == 200:  # If the GET request was successful
-                        tasks = get_response.json().get('tasks', [])
-                        if tasks:
-                            # Get the 'task_id' of the last task
-                            task_id = tasks[-1].get('task_id')
-                            print(f"Created task with ID: {task_id}. The Force is strong with this one.")
-                            # Make a PUT request to update the 'is_done' status of the task
-                            put_url = f"{url}/{task_id}"
-                            put_data = {'is_done': True}
-                            put_response = requests.put(put_url, headers=headers, data=json.dumps(put_data))
+            return self.session.request(method, url, **kwargs)
+        finally:
+            self.served += 1
+            # urllib3 counts the connections each pool has opened, so any request
+            # that did not bump the counter went out on a kept-alive connection
+            pool = self.adapter.poolmanager.connection_from_url(url)
+            opened = pool.num_connections - self._connections_seen.get(id(pool), 0)
+            self._connections_seen[id(pool)] = pool.num_connections
+            self.stats.record_connection(reused=opened == 0)
+
+    def close(self):
+        self.session.close()
+
+
+def send_once(client, url, endpoint, method, body, stats, log=None, intended=None, ids=None):
+    """
+    Sends one iteration of the workload for an endpoint (POST also looks up and completes the new task).
+
+    Args:
+        client (OneShotClient or PooledClient): How requests are sent.
+        url (str): The full URL of the endpoint.
+        endpoint (str): The endpoint label used in stats and output.
+        method (str): The HTTP method to use.
+        body (RequestBody): The pre-encoded request body, see `compile_body`.
+        stats (RunStats): Where to record each request.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        intended (float, optional): The `time.perf_counter()` time this request was scheduled
+            for; latency is measured from here instead of the actual send time (default is None).
+        ids (TaskIdPool, optional): Run the ID-tracking scenario with this pool (default is None).
+
+    Returns:
+        bool: False if the method is not supported, True otherwise.
+    """
+    if ids is not None:
+        return send_tracked_once(client, url, endpoint, method, body, stats, ids, log, intended)
+    headers = JSON_HEADERS
+    say = log is not None and log.sampled()
+    try:
+        started = time.perf_counter() if intended is None else intended
+        if method == 'GET':
+            response = client.request('GET', url)
+        elif method == 'POST':
+            response = client.request('POST', url, headers=headers, data=body.render())
+            latency = time.perf_counter() - started
+            phase_times = stats.phase_times  # Recorded last, after the follow-up requests
+            if response.status_code == 201:  # If the POST request was successful
+                # Make a GET request to retrieve the 'task_id'
+                get_started = time.perf_counter()
+                get_response = client.request('GET', url)
+                stats.record('GET', endpoint, get_response.status_code, time.perf_counter() - get_started,
+                             len(get_response.content))
+                if get_response.status_code == 200:  # If the GET request was successful
+                    tasks = get_response.json().get('tasks', [])
+                    if tasks:
+                        # Get the 'task_id' of the last task
+                        task_id = tasks[-1].get('task_id')
+                        if say:
+                            log.write(f"Created task with ID: {task_id}. The Force is strong with this one.")
+                        # Make a PUT request to update the 'is_done' status of the task
+                        put_url = f"{url}/{task_id}"
+                        put_started = time.perf_counter()
+                        put_response = client.request('PUT', put_url, headers=headers, data=PUT_DONE_BODY)
+                        stats.record('PUT', f"{endpoint}/<id>", put_response.status_code,
+                                     time.perf_counter() - put_started, len(put_response.content))
+                        if say:
                             if put_response.status_code == 200:  # If the PUT request was successful
-                                print(f"Updated task with ID: {task_id} to complete. The task has been completed, young Jedi.")
+                                log.write(f"Updated task with ID: {task_id} to complete. The task has been completed, young Jedi.")
                             else:
-                                print(f"PUT request failed with status code: {put_response.status_code}. The Dark Side I sense in you.")
-                        else:
-                            print(f"No tasks found. These are not the tasks you're looking for.")
+                                log.write(f"PUT request failed with status code: {put_response.status_code}. The Dark Side I sense in you.")
+                    elif say:
+                        log.write("No tasks found. These are not the tasks you're looking for.")
+                elif say:
+                    log.write(f"GET request failed with status code: {get_response.status_code}. The disturbance in the Force I feel.")
+        elif method == 'PUT':
+            response = client.request('PUT', url, headers=headers, data=body.render())
+        elif method == 'DELETE':
+            response = client.request('DELETE', url)
+        else:
+            print(f"Unsupported method: {method}. Do or do not. There is no try.")
+            return False
+        if method != 'POST':
+            latency = time.perf_counter() - started
+        else:
+            stats.phase_times = phase_times
+
+        stats.record(method, endpoint, response.status_code, latency, len(response.content))
+        if say:
+            log.write(f"Response from {method} {endpoint}: {response.status_code}. May the Force be with you.")
+    except Exception as e:
+        stats.record(method, endpoint, None)
+        if say:
+            log.write(f"Request to {method} {endpoint} failed: {e}. I've got a bad feeling about this.")
+    return True
+
+
+def _lookup_ids(client, url, endpoint, stats, ids):
+    started = time.perf_counter()
+    response = client.request('GET', url)
+    stats.record('GET', endpoint, response.status_code, time.perf_counter() - started, len(response.content))
+    if response.status_code == 200:
+        return ids.add_from_listing(response.json())
+    return 0
+
+
+def send_tracked_once(client, url, endpoint, method, body, stats, ids, log=None, intended=None):
+    """
+    ID-tracking variant of `send_once`, with a cost per iteration that does not grow with the table.
+
+    POST takes the new task's ID from its own response and adds it to `ids`. Endpoints with
+    an '<id>' placeholder send to an ID drawn from `ids` (DELETE removes it from the pool).
+    GET /todos is only used as a sampled fallback: when POST responses carry no ID, or when
+    the pool is empty.
+
+    Args:
+        client (OneShotClient or PooledClient): How requests are sent.
+        url (str): The full URL of the endpoint, possibly containing '<id>'.
+        endpoint (str): The endpoint label used in stats and output.
+        method (str): The HTTP method to use.
+        body (RequestBody): The pre-encoded request body, see `compile_body`.
+        stats (RunStats): Where to record each request.
+        ids (TaskIdPool): The pool of created task IDs.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        intended (float, optional): The scheduled send time for open-loop latency (default is None).
+
+    Returns:
+        bool: False if the method is not supported, True otherwise.
+    """
+    say = log is not None and log.sampled()
+    try:
+        started = time.perf_counter() if intended is None else intended
+        target = url
+        if ID_PLACEHOLDER in endpoint:
+            task_id = ids.take(remove=method == 'DELETE')
+            if task_id is None:
+                # Nothing to work on yet: refill the pool from a listing, and back off if the table is empty
+                collection = collection_endpoint(endpoint)
+                if not _lookup_ids(client, url[:len(url) - len(endpoint)] + collection, collection, stats, ids):
+                    time.sleep(EMPTY_POOL_BACKOFF)
+                return True
+            target = url.replace(ID_PLACEHOLDER, str(task_id))
+        if method in ('POST', 'PUT'):
+            response = client.request(method, target, headers=JSON_HEADERS, data=body.render())
+        elif method in ('GET', 'DELETE'):
+            response = client.request(method, target)
+        else:
+            print(f"Unsupported method: {method}. Do or do not. There is no try.")
+            return False
+        stats.record(method, endpoint, response.status_code, time.perf_counter() - started, len(response.content))
+        if method == 'POST' and response.status_code == 201:
+            task_id = created_task_id(response.json())
+            if task_id is not None:
+                ids.add(task_id)
+                if say:
+                    log.write(f"Created task with ID: {task_id}. The Force is strong with this one.")
+            elif ids.should_lookup():
+                _lookup_ids(client, url, endpoint, stats, ids)
+        if say:
+            log.write(f"Response from {method} {target[len(url) - len(endpoint):]}: {response.status_code}. May the Force be with you.")
+    except Exception as e:
+        stats.record(method, endpoint, None)
+        if say:
+            log.write(f"Request to {method} {endpoint} failed: {e}. I've got a bad feeling about this.")
+    return True
+
+
+def send_pipelined_once(client, url, endpoint, method, body, stats, log=None, intended=None, ids=None):
+    """
+    `send_once` for the raw engine with --pipeline: one pipelined batch for the fixed GET, PUT
+    and DELETE requests of closed-loop workers, `send_once` for everything else.
+    """
+    if intended is None and ids is None and method in ('GET', 'PUT', 'DELETE'):
+        send_pipelined(client, url, endpoint, method, body, stats, log)
+        return True
+    return send_once(client, url, endpoint, method, body, stats, log, intended, ids)
+
+
+def send_request(base_url, endpoint, method='GET', data=None, stats=None, stop_event=None, verbose=True,
+                 client=None):
+    """
+    Continuously sends HTTP requests to the specified endpoint.
+
+    Args:
+        base_url (str): The base URL of the API.
+        endpoint (str): The endpoint to send the request to.
+        method (str, optional): The HTTP method to use (default is 'GET').
+        data (dict, optional): The data to send with the request (default is None).
+        stats (RunStats, optional): Where to record each request (default is None).
+        stop_event (threading.Event, optional): Stop sending once this is set (default is None, run forever).
+        verbose (bool, optional): Print the lines of every request (default is True).
+        client (OneShotClient or PooledClient, optional): How requests are sent
+            (default is None, a new connection per request).
+
+    Returns:
+        None
+    """
+    url = f"{base_url}{endpoint}"
+    body = compile_body(data)
+    log = RequestLog(buffered=False) if verbose else None
+    if stats is None:
+        stats = RunStats()
+    if client is None:
+        client = OneShotClient(stats)
+    while stop_event is None or not stop_event.is_set():  # Continuously send requests
+        if not send_once(client, url, endpoint, method, body, stats, log):
+            break
+    client.close()
+
+
+class _Worker:
+    """
+    One load worker thread that can be stopped, or pointed at a new stats shard, between stages.
+
+    Closed-loop workers send back to back, waiting out the `guard`'s backoff after a failure.
+    Open-loop workers (given `jobs`) send once for every scheduled send time they take from
+    the queue. A request the guard's circuit breaker short-circuits is counted, not sent.
+    """
+
+    def __init__(self, url, endpoint, method, body, stats, client, log, jobs=None, ids=None, guard=None,
+                 send=send_once):
+        self.url = url
+        self.endpoint = endpoint
+        self.method = method
+        self.body = body
+        self.stats = stats
+        self.client = client
+        self.log = log
+        self.jobs = jobs
+        self.ids = ids
+        self.guard = guard
+        self.send = send
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def retarget(self, stats):
+        self.stats = stats
+        self.client.stats = stats
+
+    def _run(self):
+        guard = self.guard
+        try:
+            while not self.stopped.is_set():
+                intended = None
+                if self.jobs is not None:
+                    try:
+                        intended = self.jobs.get(timeout=CONTROL_INTERVAL)
+                    except queue.Empty:
+                        continue
+                stats = self.stats
+                if guard is None:
+                    if not self.send(self.client, self.url, self.endpoint, self.method, self.body, stats,
+                                     self.log, intended, self.ids):
+                        break
+                    continue
+                if not guard.allow():
+                    stats.record_short_circuit(self.method, self.endpoint)
+                    pause = guard.short_circuited()
+                else:
+                    failed = stats.failed
+                    if not self.send(self.client, self.url, self.endpoint, self.method, self.body, stats,
+                                     self.log, intended, self.ids):
+                        break
+                    pause = guard.done(stats.failed != failed)
+                if pause and self.jobs is None:
+                    self.stopped.wait(pause)  # Returns early if the worker is stopped meanwhile
+        finally:
+            self.client.close()
+
+
+class _EndpointWorkers:
+    """
+    The worker threads sending to one endpoint, resized by `run_stages_threads`.
+    """
+
+    def __init__(self, base_url, endpoint, method, data, make_client, log, ids=None, backoff=None, breaker=None,
+                 send=send_once):
+        self.url = f"{base_url}{endpoint}"
+        self.endpoint = endpoint
+        self.method = method
+        self.body = compile_body(data)  # Encoded once for every worker of the endpoint
+        self.make_client = make_client
+        self.log = log
+        self.ids = ids
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(breaker) if breaker is not None else None
+        self.send = send
+        self.closed_loop = []
+        self.open_loop = []
+        self.jobs = queue.SimpleQueue()
+        self.next_due = math.inf
+        self.stats = None
+
+    def retarget(self, stats):
+        self.stats = stats
+        for worker in self.closed_loop + self.open_loop:
+            worker.retarget(stats.shard())
+
+    def _resize(self, workers, count, jobs):
+        while len(workers) < count:
+            shard = self.stats.shard()
+            guard = None
+            if self.backoff is not None or self.breaker is not None:
+                guard = FailureGuard(self.backoff, self.breaker)
+            workers.append(_Worker(self.url, self.endpoint, self.method, self.body, shard,
+                                   self.make_client(shard), self.log, jobs, self.ids, guard, self.send))
+        while len(workers) > count:
+            workers.pop().stopped.set()  # Finishes its current request, then exits
+
+    def resize(self, closed_loop, open_loop):
+        self._resize(self.closed_loop, closed_loop, None)
+        self._resize(self.open_loop, open_loop, self.jobs)
+
+    def schedule(self, now, rate_at, until):
+        while self.next_due <= now:
+            self.jobs.put(self.next_due)  # Never blocks, so a slow backend cannot slow the schedule down
+            self.next_due = next_arrival(self.next_due, rate_at, until)
+        return self.next_due
+
+    def stop(self, deadline):
+        workers = self.closed_loop + self.open_loop
+        for worker in workers:
+            worker.stopped.set()
+        # Requests that were due but never sent are failures, not missing data
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            self.stats.record(self.method, self.endpoint, None)
+        for worker in workers:
+            worker.thread.join(max(deadline - time.monotonic(), 0))
+
+
+def run_stages_threads(base_url, endpoints, stages, stage_stats, make_client, log=None, stage_done=None,
+                       ids=None, backoff=None, breaker=None, send=send_once):
+    """
+    Runs a staged load profile with worker threads.
+
+    Closed-loop stages add or remove worker threads live to follow the stage's ramp.
+    Rate stages queue requests at their due times for a pool of workers, and latency is
+    measured from the due time, so time spent waiting behind a slow backend is counted
+    instead of silently lowering the offered load (coordinated omission). Every worker
+    is stopped when the last stage ends.
+
+    Args:
+        base_url (str): The base URL of the API.
+        endpoints (list): A list of tuples containing the endpoint, HTTP method, and data for each request.
+        stages (list): The Stage list of the profile.
+        stage_stats (list): One RunStats per stage to record into.
+        make_client (callable): Returns a new client for a worker, given its stats shard.
+        log (RequestLog, optional): Where sampled request lines go (default is None, no lines).
+        stage_done (callable, optional): Called with the stage index as each stage ends.
+        ids (TaskIdPool, optional): Run the ID-tracking scenario with this pool (default is None).
+        backoff (Backoff, optional): How long closed-loop workers wait after a failed request
+            (default is None, not at all).
+        breaker (BreakerPolicy, optional): Give every endpoint a circuit breaker with this
+            policy (default is None, no breakers).
+        send (callable, optional): Sends one iteration for a worker, with the arguments of
+            `send_once` (default is send_once).
+
+    Returns:
+        None
+    """
+    groups = [_EndpointWorkers(base_url, endpoint, method, data, make_client, log, ids, backoff, breaker, send)
+              for endpoint, method, data in endpoints]
+    try:
+        for index, (stage, start_level) in enumerate(with_start_levels(stages)):
+            started = time.perf_counter()
+            ends = started + stage.duration
+
+            def rate_at(t, stage=stage, start_level=start_level, started=started):
+                return stage.level(start_level, t - started)
+
+            for group in groups:
+                group.retarget(stage_stats[index])
+                if stage.open_loop:
+                    group.resize(0, stage.max_in_flight)
+                    if group.next_due == math.inf:
+                        group.next_due = next_arrival(started, rate_at, ends)
+                else:
+                    group.next_due = math.inf
+
+            now = started
+            while now < ends:
+                wake = min(now + CONTROL_INTERVAL, ends)
+                for group in groups:
+                    if stage.open_loop:
+                        wake = min(wake, group.schedule(now, rate_at, ends))
                     else:
-                        print(f"GET request failed with status code: {get_response.status_code}. The disturbance in the Force I feel.")
-            elif method == 'PUT':
-                response = requests.put(url, headers=headers, data=json.dumps(data))
-            elif method == 'DELETE':
-                response = requests.delete(url)
-            else:
-                print(f"Unsupported method: {method}. Do or do not. There is no try.")
+                        group.resize(round(stage.level(start_level, now - started)), 0)
+                time.sleep(max(wake - time.perf_counter(), 0))
+                now = time.perf_counter()
+            if stage_done is not None:
+                stage_done(index)
+    finally:
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        for group in groups:
+            group.stop(deadline)
+
+
+def run_stages(base_url, endpoints, stages, stage_stats, engine='threads', report=True, verbose=0,
+               pooled=False, pool_size=1, max_keepalive=0, track_ids=False, id_pool_size=10000,
+               status_interval=STATUS_INTERVAL, metrics_file=None, metrics_port=None, process=None,
+               results_file=None, on_stage_end=None, replay=None, sessions=None, backoff=DEFAULT_BACKOFF,
+               breaker=None, recovery=None, pipeline=1, phases=False):
+    """
+    Runs a staged load profile and prints a summary at the end of every stage.
 
-            print(f"Response from {method} {endpoint}: {response.status_code}. May the Force be with you.")
-        except Exception as e:
-            print(f"Request to {method} {endpoint} failed: {e}. I've got a bad feeling about this.")
+    While it runs, one reporter thread prints a status line per interval and any sampled
+    request lines; the workers themselves never write to the console.
 
+    Args:
+        base_url (str): The base URL of the API.
+        endpoints (list): A list of tuples containing the endpoint, HTTP method, and data for each request.
+        stages (list): The Stage list of the profile.
+        stage_stats (list): One RunStats per stage to record into.
+        engine (str, optional): 'threads' for one OS thread per worker, 'async' for one
+            coroutine per worker on a single event loop, 'raw' for worker threads on the lean
+            raw-socket client of raw_client.py (default is 'threads').
+        report (bool, optional): Print a summary as each stage ends (default is True).
+        verbose (int, optional): Print the lines of one request in this many (default is 0, none;
+            True prints every request).
+        pooled (bool, optional): Give each worker one keep-alive connection pool instead of
+            a new connection per request (default is False).
+        pool_size (int, optional): Connections per worker pool in pooled mode (default is 1).
+        max_keepalive (int, optional): Reconnect after this many requests in pooled mode (default is 0, no limit).
+        track_ids (bool, optional): Run the ID-tracking scenario: POST feeds created IDs into a pool
+            that '<id>' endpoints draw from (default is False).
+        id_pool_size (int, optional): The most task IDs kept in the pool (default is 10000).
+        status_interval (float, optional): Seconds between status lines, 0 for none (default is STATUS_INTERVAL).
+        metrics_file (str, optional): Append a per-second JSON line per endpoint to this file (default is None).
+        metrics_port (int, optional): Serve Prometheus metrics on this local port (default is None).
+        process (int, optional): This worker process's index under --processes, added to the
+            metrics (default is None).
+        results_file (str, optional): Write every request to this binary results file, see
+            results_log.py (default is None).
+        on_stage_end (callable, optional): Called with the stage index after each stage (and its
+            summary); an exception it raises ends the profile early and propagates (default is None).
+        replay (AccessLogReplay, optional): Send the requests of access logs instead of `endpoints`,
+            on the async engine, as one stage whose users are the in-flight limit and whose duration
+            (math.inf for the whole log) cuts the replay short (default is None).
+        sessions (SessionModel, optional): Run user sessions of this model instead of `endpoints`,
+            on the async engine; each stage's workers are concurrent sessions (default is None).
+        backoff (Backoff, optional): How long a closed-loop worker waits after a request without a
+            response, None for not at all (default is DEFAULT_BACKOFF).
+        breaker (BreakerPolicy, optional): Give every endpoint a circuit breaker with this policy,
+            short-circuiting its requests while it is open (default is None, no breakers).
+        recovery (RecoveryMonitor, optional): Feed every request to this outage monitor; it is
+            closed when the profile ends, ready for its report (default is None).
+        pipeline (int, optional): On the raw engine in pooled mode, closed-loop workers of fixed
+            GET/PUT/DELETE endpoints send this many requests per pipelined batch (default is 1).
+        phases (bool, optional): Time the connect, send, ttfb and body phases of every request
+            into per-endpoint histograms, shown in the summaries; needs the raw or async engine's
+            clients (default is False).
 
-def simulate_load(base_url, endpoints, num_threads, duration):
+    Returns:
+        None
+    """
+    ids = TaskIdPool(id_pool_size) if track_ids else None
+    log = RequestLog(verbose) if verbose else None
+    metrics = None
+    if metrics_file or metrics_port is not None:
+        metrics = MetricsRecorder(metrics_file, metrics_port, process=process)
+    reporter = StatusReporter(status_interval, log, metrics)
+    results = ResultLog(results_file) if results_file else None
+    sink = results
+    if recovery is not None:
+        recovery.results = results  # Passes every request on to the results file
+        sink = recovery
+    for stats in stage_stats:
+        stats.results = sink
+        stats.time_phases = phases
+    reporter.watch(stage_stats[0])
+    reporter.start()
+    timer = [RunTimer()]
+    current = [0]
+
+    def describe(index):
+        if replay is not None:
+            return replay.describe()
+        if sessions is not None:
+            return f"{sessions.describe()}, {stages[index].describe()}"
+        return stages[index].describe()
+
+    def stage_done(index):
+        if index + 1 < len(stages):
+            reporter.watch(stage_stats[index + 1], index + 1)
+            reporter.flush()
+        else:
+            reporter.stop()  # Lines of requests still finishing would only trail the summary
+        if report:
+            print_summary(stage_stats[index].merged(), timer[0].elapsed(), timer[0].cpu_seconds(),
+                          title=f"Stage {index + 1} summary ({describe(index)})")
+        timer[0] = RunTimer()
+        current[0] = index + 1
+        if on_stage_end is not None:
+            on_stage_end(index)
+
+    async def run_replay():
+        duration = stages[0].duration
+        await run_replay_async(base_url, replay, stage_stats[0], log=log, keep_alive=pooled,
+                               max_keepalive=max_keepalive, max_in_flight=stages[0].max_in_flight,
+                               duration=None if math.isinf(duration) else duration, ids=ids)
+        stage_done(0)
+
+    try:
+        if replay is not None:
+            asyncio.run(run_replay())
+        elif sessions is not None:
+            asyncio.run(run_sessions_async(base_url, sessions, stages, stage_stats, log=log, keep_alive=pooled,
+                                           max_keepalive=max_keepalive, stage_done=stage_done))
+        elif engine == 'async':
+            asyncio.run(run_stages_async(base_url, endpoints, stages, stage_stats, log=log,
+                                         keep_alive=pooled, max_keepalive=max_keepalive, stage_done=stage_done,
+                                         ids=ids, backoff=backoff, breaker=breaker))
+        elif engine == 'threads':
+            def make_client(shard):
+                if pooled:
+                    return PooledClient(shard, pool_size=pool_size, max_keepalive=max_keepalive)
+                return OneShotClient(shard)
+
+            run_stages_threads(base_url, endpoints, stages, stage_stats, make_client, log=log,
+                               stage_done=stage_done, ids=ids, backoff=backoff, breaker=breaker)
+        elif engine == 'raw':
+            def make_client(shard):
+                return RawHTTPClient(shard, keep_alive=pooled, max_keepalive=max_keepalive, pipeline=pipeline)
+
+            run_stages_threads(base_url, endpoints, stages, stage_stats, make_client, log=log,
+                               stage_done=stage_done, ids=ids, backoff=backoff, breaker=breaker,
+                               send=send_pipelined_once if pipeline > 1 else send_once)
+        else:
+            raise ValueError(f"Unknown engine: {engine}")
+    except KeyboardInterrupt:
+        reporter.stop()
+        if report and current[0] < len(stages):
+            index = current[0]
+            print_summary(stage_stats[index].merged(), timer[0].elapsed(), timer[0].cpu_seconds(),
+                          title=f"Stage {index + 1} summary ({describe(index)}, interrupted)")
+        raise
+    finally:
+        reporter.stop()
+        if recovery is not None:
+            recovery.close()
+        if results is not None:
+            results.close()
+
+
+def simulate_load(base_url, endpoints, num_threads, duration, engine='threads', stats=None, verbose=0,
+                  pooled=False, pool_size=1, max_keepalive=0, rate=None, status_interval=STATUS_INTERVAL):
     """
     Simulates load by sending multiple requests to the specified endpoints concurrently.
 
+    The workers are started one by one, spread out over the duration, and all of them
+    are stopped when the duration is up.
+
     Args:
         base_url (str): The base URL of the API.
         endpoints (list): A list of tuples containing the endpoint, HTTP method, and data for each request.
-        num_threads (int): The number of threads to use for sending requests.
+        num_threads (int): The number of threads (or virtual users for the async engine) per endpoint.
         duration (int): The duration to run the stress test for in seconds.
+        engine (str, optional): 'threads' for one OS thread per worker, 'async' for one
+            coroutine per worker on a single event loop (default is 'threads').
+        stats (RunStats, optional): Where to record requests (default is None).
+        verbose (int, optional): Print the lines of one request in this many (default is 0, none).
+        pooled (bool, optional): Give each worker one keep-alive connection pool instead of
+            a new connection per request (default is False).
+        pool_size (int, optional): Connections per worker pool in pooled mode (default is 1).
+        max_keepalive (int, optional): Reconnect after this many requests in pooled mode (default is 0, no limit).
+        rate (float, optional): Open-loop mode: send this many requests per second to each endpoint
+            for `duration` seconds, with at most `num_threads` in flight per endpoint (default is None,
+            closed-loop workers).
+        status_interval (float, optional): Seconds between status lines, 0 for none (default is STATUS_INTERVAL).
 
     Returns:
         None
     """
-    threads = []
-    for endpoint, method, data in endpoints:
-        for _ in range(num_threads):
-            thread = threading.Thread(target=lambda: send_request(base_url, endpoint, method, data))
-            threads.append(thread)
-            thread.start()
-            time.sleep(duration / num_threads)  # Spread out the start times of the threads over the duration
+    if stats is None:
+        stats = RunStats()
+    if rate:
+        stage = Stage(duration, users=num_threads, rate=rate)
+    else:
+        stage = Stage(duration, users=num_threads, ramp='linear')
+    run_stages(base_url, endpoints, [stage], [stats], engine=engine, report=False, verbose=verbose,
+               pooled=pooled, pool_size=pool_size, max_keepalive=max_keepalive, status_interval=status_interval)
+
+
+def _stop_on_sigterm(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)  # Only interrupt once, so the report still gets sent
+    raise KeyboardInterrupt
+
+
+def _load_process(base_url, endpoints, stages, options, results, index):
+    # Ctrl-C goes to the whole process group; let the parent decide when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _stop_on_sigterm)
+    payloads.process_tag = f"{index}-"
+    stage_stats = [RunStats() for _ in stages]
+    cpu_started = time.process_time()
+    options = dict(options, status_interval=0, process=index)
+    if options.get('metrics_port') is not None:
+        options['metrics_port'] += index  # One metrics endpoint per process, all scraped side by side
+    if options.get('results_file'):
+        options['results_file'] = f"{options['results_file']}.{index}"
+    try:
+        # The parent only sees stats at the end; per-process status lines would just interleave
+        run_stages(base_url, endpoints, stages, stage_stats, report=False, **options)
+    except KeyboardInterrupt:
+        pass
+    results.put((stage_stats, time.process_time() - cpu_started))
+
+
+def simulate_load_sharded(base_url, endpoints, stages, processes, **options):
+    """
+    Spreads the workers (or rate) of every stage across several processes and merges their stats.
+
+    Each process runs its share of the profile with its own engine and stats, so the
+    generator is no longer limited to one core. Press Ctrl-C to stop all of them.
+
+    Args:
+        base_url (str): The base URL of the API.
+        endpoints (list): A list of tuples containing the endpoint, HTTP method, and data for each request.
+        stages (list): The Stage list of the profile, with totals across all processes.
+        processes (int): The number of worker processes.
+        **options: Passed through to `run_stages` in each process.
+
+    Returns:
+        tuple: (list of merged RunStats per stage, CPU seconds used by all worker processes)
+    """
+    results = multiprocessing.Queue()
+    workers = []
+    for index in range(processes):
+        shard_stages = [shard_stage(stage, processes, index) for stage in stages]
+        worker = multiprocessing.Process(target=_load_process,
+                                         args=(base_url, endpoints, shard_stages, options, results, index),
+                                         daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    stage_stats = [RunStats() for _ in stages]
+    cpu_seconds = 0.0
+    pending = len(workers)
+    while pending:
+        try:
+            shard, shard_cpu = results.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                try:
+                    shard, shard_cpu = results.get(timeout=1)  # A report may still be in the pipe
+                except queue.Empty:
+                    print(f"{pending} worker process(es) exited without a report. Lost in hyperspace.")
+                    break
+            else:
+                continue
+        except KeyboardInterrupt:
+            print("\nStopping worker processes. The Empire retreats.")
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            continue
+        for merged, stats in zip(stage_stats, shard):
+            merged.merge(stats)
+        cpu_seconds += shard_cpu
+        pending -= 1
+
+    for worker in workers:
+        worker.join()
+    return stage_stats, cpu_seconds
+
+
+def capacity_search(base_url, endpoints, slo, start_rate, max_rate, precision=0.05, window=5.0, hold=60.0,
+                    in_flight=DEFAULT_MAX_IN_FLIGHT, **options):
+    """
+    Finds the highest open-loop rate per endpoint that meets an SLO, printing each level as it is judged.
+
+    Args:
+        base_url (str): The base URL of the API.
+        endpoints (list): A list of tuples containing the endpoint, HTTP method, and data for each request.
+        slo (SLO): The objective, e.g. p99 under 200ms and under 0.1% errors.
+        start_rate (float): The first rate to try, in requests per second per endpoint.
+        max_rate (float): Never offer more than this.
+        precision (float, optional): Stop once the search brackets the limit this closely (default is 0.05).
+        window (float, optional): Seconds per measurement window (default is 5).
+        hold (float, optional): The longest time to hold one level in seconds (default is 60).
+        in_flight (int, optional): The most requests in flight per endpoint (default is DEFAULT_MAX_IN_FLIGHT).
+        **options: Passed through to `run_stages` for every level.
+
+    Returns:
+        Level: The highest passing level, or None if even the lowest rate tried failed.
+    """
+    def run(stages, stage_stats, on_stage_end):
+        run_stages(base_url, endpoints, stages, stage_stats, report=False, on_stage_end=on_stage_end, **options)
+
+    passed = []
+
+    def level_done(level):
+        print_level(level, endpoints)
+        if not level.failures and (not passed or level.rate > passed[-1].rate):
+            passed.append(level)
+
+    print_capacity_header(slo)
+    try:
+        search_capacity(run, slo, start_rate, max_rate, precision=precision, window=window, hold=hold,
+                        in_flight=in_flight, level_done=level_done)
+    except KeyboardInterrupt:
+        print("\nCapacity search stopped. The Empire retreats.")
+    best = passed[-1] if passed else None
+    if best is None:
+        print(f"\nNo rate tried met the SLO ({slo.describe()}).")
+    else:
+        print(f"\nHighest rate meeting the SLO: {best.rate:.1f} req/s per endpoint, "
+              f"{best.rate * len(endpoints):.1f} req/s offered in total")
+    return best
 
-    for thread in threads:
-        thread.join()
 
 # Base URL of your Flask application
 base_url = 'http://18.133.233.130'  # Replace with your actual base URL of the backend EC2 server
@@ -76,20 +804,341 @@ base_url = 'http://18.133.233.130'  # Replace with your actual base URL of the b
 # -------------------------
 # Stress Test Section (Crashing the Server)
 # -------------------------
-print("Starting Stress Test (Crashing the Server)")
 stress_endpoints = [
     ('/todos', 'POST', {'title': 'Send in the Storm Troopers', 'description': 'Resistance is futile'}),
     ('/todos/1', 'PUT', {'is_done': True}),  # Update the task with ID 1 to complete
     ('/todos/2', 'DELETE', None),  # Delete the task with ID 2
 ]
 
+# With --track-ids, '<id>' is replaced by the ID of a task created earlier in the run
+scenario_endpoints = [
+    ('/todos', 'POST', {'title': Sequence('Send in the Storm Troopers #'), 'description': 'Resistance is futile'}),
+    ('/todos/<id>', 'PUT', {'is_done': Choice(True, False)}),  # Complete (or reopen) a task created by a POST
+    ('/todos/<id>', 'DELETE', None),  # Delete a task created by a POST
+]
+
+stress_stages = [
+    Stage(5*60, users=3, ramp='linear'),  # Start with 3 threads over 5 minutes
+    Stage(10*60, users=20, ramp='linear'),  # Ramp up to 20 threads over the next 10 minutes
+]
+
 
-# Start with 3 threads for 5 minutes
-simulate_load(base_url, stress_endpoints, num_threads=3, duration=5*60)
+def build_parser():
+    """
+    Returns the command-line parser, for tools that add options of their own (see distributed.py).
+    """
+    parser = argparse.ArgumentParser(description="Stress test the todo API (Crashing the Server).")
+    parser.add_argument('--base-url', default=base_url, help="base URL of the backend (default: %(default)s)")
+    parser.add_argument('--engine', choices=('threads', 'async', 'raw'), default='threads',
+                        help="'threads' runs one OS thread per worker, 'async' runs every worker as a "
+                             "coroutine on one event loop, 'raw' runs worker threads on a lean raw-socket "
+                             "HTTP/1.1 client instead of requests (default: %(default)s)")
+    parser.add_argument('--stage', type=parse_stage, action='append', dest='stages', metavar='DURATION:TARGET[:RAMP]',
+                        help="add a stage to the load profile instead of the default ramp; TARGET is workers per "
+                             "endpoint (20) or an open-loop rate per endpoint (50/s, or 50/s@20 to allow at most 20 "
+                             "in flight), RAMP is step, linear or exponential, e.g. --stage 1m:5:linear "
+                             "--stage 5m:20 --stage 2m:100/s:exp (repeatable)")
+    parser.add_argument('--threads', type=int,
+                        help="run a single stage with this many workers per endpoint instead of the default ramp")
+    parser.add_argument('--duration', type=float,
+                        help="length of the single stage given by --threads or --rate in seconds; closed-loop "
+                             "workers are started spread out over it (default: 60; with --replay, the whole log)")
+    parser.add_argument('--pooled', action='store_true',
+                        help="give each worker one reusable keep-alive connection pool instead of a new "
+                             "TCP connection per request")
+    parser.add_argument('--pool-size', type=int, default=1,
+                        help="connections per worker pool in --pooled mode (default: %(default)s)")
+    parser.add_argument('--pipeline', type=int, default=1, metavar='N',
+                        help="raw engine with --pooled: closed-loop workers send the fixed GET, PUT and DELETE "
+                             "requests N at a time on their connection before reading the responses "
+                             "(default: %(default)s)")
+    parser.add_argument('--phases', action='store_true',
+                        help="time every request in connect, send, time-to-first-byte and body phases, with "
+                             "per-endpoint p50/p99 in each summary and the phase p99s of every stage at the "
+                             "end (raw and async engines)")
+    parser.add_argument('--max-keepalive', type=int, default=0,
+                        help="reconnect after this many requests on a pooled connection, 0 for no limit "
+                             "(default: %(default)s)")
+    parser.add_argument('--rate', type=float,
+                        help="open-loop mode: run a single stage sending this many requests per second to each "
+                             "endpoint on a fixed schedule, measuring latency from the scheduled send time; "
+                             "--threads becomes the in-flight limit per endpoint")
+    parser.add_argument('--max-in-flight', type=int, metavar='N',
+                        help="most requests in flight per endpoint for rate stages that do not set their own "
+                             "(default: --threads, or 100)")
+    parser.add_argument('--backoff', type=parse_backoff, default=DEFAULT_BACKOFF, metavar='BASE[:CAP[:JITTER]]',
+                        help="after a request without a response, a closed-loop worker waits BASE seconds, "
+                             "doubling with every failure in a row up to CAP; JITTER is full (a random wait up to "
+                             "that), equal or none; 0 retries at once (default: 0.05:2:full)")
+    parser.add_argument('--circuit-breaker', type=parse_breaker, dest='breaker',
+                        metavar='FAILURES[:COOLDOWN[:PROBES]]',
+                        help="give every endpoint a circuit breaker that opens after FAILURES requests in a row "
+                             "without a response, short-circuits the endpoint's requests (counted apart, not "
+                             "sent) for COOLDOWN (default 5s), then lets PROBES half-open requests (default 1) "
+                             "test the backend, e.g. 5:10s:1")
+    parser.add_argument('--processes', type=int, nargs='?', const=os.cpu_count(), default=0,
+                        help="spread the workers of each stage across this many processes and merge their stats "
+                             "(default with no value: CPU count)")
+    parser.add_argument('--track-ids', action='store_true',
+                        help="run the ID-tracking scenario: POST takes the created task ID from its response "
+                             "and PUT/DELETE draw IDs from a bounded pool instead of using fixed IDs, with no "
+                             "GET /todos after every POST")
+    parser.add_argument('--id-pool-size', type=int, default=10000,
+                        help="most task IDs kept for --track-ids (default: %(default)s)")
+    parser.add_argument('--status-interval', type=float, default=STATUS_INTERVAL,
+                        help="seconds between live status lines (req/s, errors, p50/p99 per endpoint over the "
+                             "interval), 0 for none (default: %(default)s)")
+    parser.add_argument('--verbose', type=int, nargs='?', const=100, default=0, metavar='N',
+                        help="also print the lines of one request in N (default with no value: 100; 1 prints "
+                             "every request)")
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help="append a per-second time series to this JSONL file: one line per endpoint with "
+                             "requests, errors, responses by status class, bytes and latency percentiles")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve the run's metrics in Prometheus text format on http://127.0.0.1:PORT/metrics; "
+                             "with --processes, process N serves on PORT+N")
+    parser.add_argument('--results-file', metavar='PATH',
+                        help="write every request to this compact binary file (24 bytes per request) for "
+                             "analyze_results.py; with --processes, process N writes PATH.N")
+    parser.add_argument('--capacity-search', action='store_true',
+                        help="find the highest open-loop rate per endpoint that meets the SLO: double the rate "
+                             "until a level fails, then binary-search; --threads sets the in-flight limit")
+    parser.add_argument('--slo-p99', type=float, default=200, metavar='MS',
+                        help="capacity search: highest acceptable p99 latency of any endpoint in ms "
+                             "(default: %(default)s)")
+    parser.add_argument('--slo-errors', type=float, default=0.1, metavar='PERCENT',
+                        help="capacity search: highest acceptable percentage of requests without a response or with a 5xx (default: %(default)s)")
+    parser.add_argument('--search-start', type=float, default=10, metavar='RATE',
+                        help="capacity search: first rate per endpoint to try (default: %(default)s)")
+    parser.add_argument('--search-max', type=float, default=10000, metavar='RATE',
+                        help="capacity search: highest rate per endpoint to try (default: %(default)s)")
+    parser.add_argument('--search-precision', type=float, default=0.05,
+                        help="capacity search: stop when the limit is bracketed within this fraction "
+                             "(default: %(default)s)")
+    parser.add_argument('--steady-window', type=parse_duration, default=5.0, metavar='DURATION',
+                        help="capacity search: measurement window; a level is judged once 3 windows in a row "
+                             "agree (default: %(default)ss)")
+    parser.add_argument('--hold', type=parse_duration, default=60.0, metavar='DURATION',
+                        help="capacity search: longest time to hold one level (default: %(default)ss)")
+    parser.add_argument('--stand-in', type=int, nargs='?', const=1, metavar='WORKERS',
+                        help="run against a local stand-in todo API (todo_server.py) instead of --base-url, "
+                             "served by WORKERS processes, 0 for a thread of this process (default with no "
+                             "value: 1)")
+    parser.add_argument('--stand-in-latency', type=float, default=0.0, metavar='MS',
+                        help="stand-in: milliseconds before every answer (default: %(default)s)")
+    parser.add_argument('--stand-in-errors', type=float, default=0.0, metavar='PERCENT',
+                        help="stand-in: percentage of requests answered with a 500 (default: %(default)s)")
+    parser.add_argument('--stand-in-db', metavar='PATH',
+                        help="stand-in: serve the todos table of this SQLite file (see seed_todos.py) instead of "
+                             "in-memory tasks")
+    parser.add_argument('--replay', nargs='+', metavar='LOG',
+                        help="replay the requests of gunicorn/nginx access logs (oldest first, .gz allowed) with "
+                             "their original timing instead of the synthetic endpoints, open-loop on the async "
+                             "engine; --threads is the in-flight limit and --duration cuts the replay short")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay this many times faster than logged, e.g. 10 (default: %(default)s)")
+    parser.add_argument('--loop', action='store_true',
+                        help="start the replay over when the logs end; stop it with --duration or Ctrl-C")
+    parser.add_argument('--sessions', nargs='?', const='todo', metavar='MODEL.json',
+                        help="run probabilistic user sessions instead of the fixed endpoints: each worker is "
+                             "one user moving between actions by weighted transitions, with a think time "
+                             "after every request, on the async engine (default with no value: the built-in "
+                             "read-heavy todo model; see sessions.py for the JSON format)")
+    parser.add_argument('--think', type=parse_think, metavar='DIST',
+                        help="sessions: think time of actions that do not set their own, e.g. 2, uniform:1:5, "
+                             "exp:3 or lognormal:3:0.8 (median 3s; default: the model's)")
+    parser.add_argument('--recovery', action='store_true',
+                        help="measure recovery from outages (e.g. service_stop_restart.sh during the run): find "
+                             "them in the request stream and report time to first success, time to "
+                             "--recovery-target throughput and how long the p99 stays elevated")
+    parser.add_argument('--recovery-baseline', type=parse_duration, default=10.0, metavar='DURATION',
+                        help="recovery: seconds before an outage whose throughput and p99 are the ones to "
+                             "recover to (default: %(default)ss)")
+    parser.add_argument('--recovery-target', type=float, default=0.95, metavar='SHARE',
+                        help="recovery: share of the pre-outage throughput that counts as recovered "
+                             "(default: %(default)s)")
+    parser.add_argument('--recovery-tolerance', type=float, default=1.5, metavar='FACTOR',
+                        help="recovery: the tail is elevated while the p99 is above FACTOR times the "
+                             "pre-outage p99 (default: %(default)s)")
+    parser.add_argument('--recovery-file', metavar='PATH',
+                        help="recovery: append the outages of the run as a JSON line to this file, to compare "
+                             "releases")
+    parser.add_argument('--server-stats', metavar='URL|PATH',
+                        help="after every stage, print the server's own per-worker request counts and latency "
+                             "from the request stats of the deployed gunicorn_config.py, e.g. "
+                             "http://127.0.0.1:9102/stats or its GUNICORN_STATS_FILE")
+    parser.add_argument('--quiet', action='store_true', help="print only the summaries, no live status lines")
+    return parser
+
+
+def parse_args(parser=None):
+    """
+    Parses and checks the command line, with `parser` if given (default is None, build_parser()).
+    """
+    parser = parser or build_parser()
+    args = parser.parse_args()
+    if args.capacity_search and args.processes:
+        parser.error("--capacity-search runs in one process; drop --processes or use --engine async")
+    if args.replay and (args.processes or args.capacity_search or args.stages or args.rate):
+        parser.error("--replay takes its timing from the logs; it cannot be combined with --processes, "
+                     "--capacity-search, --stage or --rate")
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    if args.sessions and (args.rate or args.capacity_search or args.replay
+                          or any(stage.open_loop for stage in args.stages or [])):
+        parser.error("--sessions takes a number of concurrent sessions; it cannot be combined with rates, "
+                     "--capacity-search or --replay")
+    if args.breaker and (args.sessions or args.replay):
+        parser.error("--circuit-breaker works on the fixed endpoints; it cannot be combined with --sessions "
+                     "or --replay")
+    if args.recovery and (args.processes or args.capacity_search):
+        parser.error("--recovery watches the requests of one process; drop --processes or --capacity-search "
+                     "(--engine async reaches high rates in one process)")
+    if args.server_stats and args.capacity_search:
+        parser.error("--server-stats reports per stage; it cannot be combined with --capacity-search")
+    if args.recovery_file and not args.recovery:
+        parser.error("--recovery-file needs --recovery")
+    if args.pipeline < 1 or (args.pipeline > 1 and (args.engine != 'raw' or not args.pooled)):
+        parser.error("--pipeline needs --engine raw and --pooled, and must be positive")
+    if args.phases and args.engine == 'threads' and not (args.sessions or args.replay):
+        parser.error("--phases needs a client that times its own socket reads: use --engine raw or async")
+    if args.max_in_flight is not None and args.max_in_flight < 1:
+        parser.error("--max-in-flight must be positive")
+    args.session_model = None
+    if args.sessions:
+        try:
+            args.session_model = todo_session_model if args.sessions == 'todo' else load_model(args.sessions)
+        except (OSError, ValueError, KeyError, TypeError, argparse.ArgumentTypeError) as e:
+            parser.error(f"--sessions: cannot load {args.sessions}: {e!r}")
+        if args.think is not None:
+            args.session_model.think = args.think
+    return args
 
-# Ramp up to 20 threads
-simulate_load(base_url, stress_endpoints, num_threads=20, duration=10*60)
 
+def profile_from_args(args):
+    """
+    Returns the Stage list selected on the command line.
+    """
+    if args.stages:
+        return [stage._replace(users=args.max_in_flight) if stage.open_loop and stage.users is None else stage
+                for stage in args.stages]
+    if args.replay:
+        return [Stage(args.duration or math.inf, users=args.max_in_flight or args.threads or DEFAULT_MAX_IN_FLIGHT)]
+    duration = args.duration or DEFAULT_DURATION
+    if args.rate:
+        return [Stage(duration, users=args.max_in_flight or args.threads, rate=args.rate)]
+    if args.threads:
+        return [Stage(duration, users=args.threads, ramp='linear')]
+    return stress_stages
+
+
+def options_from_args(args):
+    """
+    Returns the run_stages options selected on the command line.
+    """
+    options = {'engine': args.engine, 'verbose': args.verbose,
+               'status_interval': 0 if args.quiet else args.status_interval, 'pooled': args.pooled,
+               'pool_size': args.pool_size, 'max_keepalive': args.max_keepalive,
+               'track_ids': args.track_ids, 'id_pool_size': args.id_pool_size,
+               'metrics_file': args.metrics_file, 'metrics_port': args.metrics_port,
+               'results_file': args.results_file, 'backoff': args.backoff, 'breaker': args.breaker,
+               'pipeline': args.pipeline, 'phases': args.phases}
+    if args.sessions:
+        options['sessions'] = args.session_model
+    return options
+
+
+def start_stand_in(args):
+    """
+    Starts the --stand-in server, if one was asked for, and points args.base_url at it until exit.
+    """
+    if args.stand_in is None:
+        return
+    stand_in = TodoServer(workers=args.stand_in, latency=args.stand_in_latency / 1000.0,
+                          error_rate=args.stand_in_errors / 100.0, db=args.stand_in_db).start()
+    atexit.register(stand_in.stop)
+    args.base_url = stand_in.base_url
+    print(f"Stand-in todo API on {args.base_url} ({args.stand_in or 'no'} worker processes, "
+          f"{args.stand_in_latency:g}ms latency, {args.stand_in_errors:g}% errors"
+          + (f", tasks in {args.stand_in_db})" if args.stand_in_db else ")"))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    stages = profile_from_args(args)
+    options = options_from_args(args)
+    endpoints = scenario_endpoints if args.track_ids else stress_endpoints
+    start_stand_in(args)
+    if args.capacity_search:
+        slo = parse_slo(args.slo_p99, args.slo_errors)
+        print(f"Starting capacity search with the {args.engine} engine ({slo.describe()})")
+        capacity_search(args.base_url, endpoints, slo, args.search_start, args.search_max,
+                        precision=args.search_precision, window=args.steady_window, hold=args.hold,
+                        in_flight=args.max_in_flight or args.threads or DEFAULT_MAX_IN_FLIGHT, **options)
+        raise SystemExit
+    timer = RunTimer()
+    scraper = None
+    if args.server_stats:
+        scraper = ServerStatsScraper(args.server_stats)
+        scraper.start()
+        if not args.processes:
+            options['on_stage_end'] = lambda index: scraper.stage_end(f"stage {index + 1}")
+    if args.recovery:
+        options['recovery'] = RecoveryMonitor(args.recovery_baseline, args.recovery_target,
+                                              args.recovery_tolerance)
+    if args.processes:
+        print(f"Starting Stress Test (Crashing the Server) with the {args.engine} engine "
+              f"across {args.processes} processes")
+        stage_stats, cpu_seconds = simulate_load_sharded(args.base_url, endpoints, stages, args.processes,
+                                                         **options)
+        # Worker processes run the stages back to back; split the wall time the same way
+        remaining = timer.elapsed()
+        for index, (stage, stats) in enumerate(zip(stages, stage_stats)):
+            spent = min(stage.duration, remaining)
+            remaining -= spent
+            if len(stages) > 1 and stats.total_requests():
+                print_summary(stats, spent, 0, title=f"Stage {index + 1} summary ({stage.describe()})")
+        title = f"Stress test summary ({args.engine} engine, {args.processes} processes)"
+        if scraper is not None:
+            scraper.stage_end("the run")
+    elif args.replay:
+        replay = AccessLogReplay(args.replay, speed=args.speed, loop=args.loop)
+        print(f"Starting Stress Test (Crashing the Server): {replay.describe()} on the async engine")
+        stage_stats = [RunStats()]
+        try:
+            run_stages(args.base_url, endpoints, stages, stage_stats, replay=replay, **options)
+        except KeyboardInterrupt:
+            print("\nReplay stopped. The Empire retreats.")
+        if replay.skipped:
+            print(f"{replay.skipped} log lines were not requests in a known format and were skipped.")
+        cpu_seconds = timer.cpu_seconds()
+        title = "Replay summary"
+    else:
+        running = f"{args.session_model.describe()}, async engine" if args.sessions else f"{args.engine} engine"
+        print(f"Starting Stress Test (Crashing the Server) ({running})")
+        stage_stats = [RunStats() for _ in stages]
+        try:
+            run_stages(args.base_url, endpoints, stages, stage_stats, **options)
+        except KeyboardInterrupt:
+            print("\nStress test stopped. The Empire retreats.")
+        cpu_seconds = timer.cpu_seconds()
+        title = f"Stress test summary ({running})"
+    if len(stages) > 1 or args.processes:  # A single stage already printed its own summary
+        stats = RunStats()
+        for shard in stage_stats:
+            stats.merge(shard)
+        print_summary(stats, timer.elapsed(), cpu_seconds, title=title)
+    if scraper is not None:
+        scraper.stop()
+    if args.phases and len(stages) > 1:
+        print_phase_growth([stats.merged() for stats in stage_stats],
+                           [f"stage {index + 1}" for index in range(len(stages))])
+    if args.recovery:
+        recovery = options['recovery']
+        recovery.close()  # Already closed unless the run was interrupted
+        recovery.print_report()
+        if args.recovery_file:
+            recovery.save(args.recovery_file, base_url=args.base_url, stages=[stage.describe() for stage in stages])
 
 
 
@@ -0,0 +1,187 @@
+"""
+Declarative load profiles for simulate_traffic.py.
+
+A profile is a list of stages. Each stage moves the load from where the previous
+stage left it to its own target, either at once ('step') or gradually over the
+stage ('linear' or 'exponential'), and ends after its duration. The target is a
+number of closed-loop workers per endpoint, or an open-loop request rate per
+endpoint.
+"""
+import argparse
+import collections
+import math
+
+RAMP_SHAPES = ('step', 'linear', 'exponential')
+DEFAULT_MAX_IN_FLIGHT = 100  # In-flight limit per endpoint for rate stages that do not set one
+SCHEDULE_STEP = 0.1  # Seconds; resolution used to integrate a changing rate
+CONTROL_INTERVAL = 0.1  # Seconds between worker count adjustments
+SHUTDOWN_GRACE = 10  # Seconds to wait for in-flight requests when a profile ends
+
+
+class Stage(collections.namedtuple('Stage', 'duration users rate ramp')):
+    """
+    One stage of a load profile.
+
+    Args:
+        duration (float): How long the stage lasts in seconds.
+        users (int, optional): Closed-loop workers per endpoint at the end of the stage, or
+            the most requests in flight per endpoint for a rate stage.
+        rate (float, optional): Open-loop requests per second per endpoint at the end of the stage.
+        ramp (str, optional): How the load gets from the previous stage's level to this one:
+            'step' (at once), 'linear' or 'exponential' (default is 'step').
+    """
+    __slots__ = ()
+
+    def __new__(cls, duration, users=None, rate=None, ramp='step'):
+        if ramp == 'exp':
+            ramp = 'exponential'
+        if ramp not in RAMP_SHAPES:
+            raise ValueError(f"Unknown ramp shape: {ramp} (use one of {', '.join(RAMP_SHAPES)})")
+        if duration <= 0:
+            raise ValueError(f"Stage duration must be positive, got {duration}")
+        if users is None and rate is None:
+            raise ValueError("A stage needs a worker count or a rate")
+        return super().__new__(cls, duration, users, rate, ramp)
+
+    @property
+    def open_loop(self):
+        return self.rate is not None
+
+    @property
+    def target(self):
+        return self.rate if self.open_loop else self.users
+
+    @property
+    def max_in_flight(self):
+        return self.users or DEFAULT_MAX_IN_FLIGHT
+
+    def level(self, start_level, elapsed):
+        """
+        Returns the load level (workers or requests/sec) `elapsed` seconds into the stage.
+
+        Args:
+            start_level (float): The level the stage starts from.
+            elapsed (float): Seconds since the stage started.
+
+        Returns:
+            float: The level to run at.
+        """
+        if self.ramp == 'step' or elapsed >= self.duration:
+            return self.target
+        progress = max(elapsed, 0.0) / self.duration
+        if self.ramp == 'linear':
+            return start_level + (self.target - start_level) * progress
+        # Exponential: equal ratios per unit of time, offset by one so ramps can start at zero
+        return (start_level + 1) * ((self.target + 1) / (start_level + 1)) ** progress - 1
+
+    def describe(self):
+        target = f"{self.rate:g} req/s" if self.open_loop else f"{self.users} workers"
+        return f"{self.ramp} to {target} over {self.duration:g}s"
+
+
+def with_start_levels(stages):
+    """
+    Pairs every stage with the level it ramps from.
+
+    A stage ramps from the previous stage's target when both are the same kind
+    (workers or rate), and from zero otherwise.
+
+    Args:
+        stages (list): The Stage list of the profile.
+
+    Returns:
+        list: (Stage, start level) tuples.
+    """
+    paired = []
+    previous = None
+    for stage in stages:
+        if previous is not None and previous.open_loop == stage.open_loop:
+            paired.append((stage, previous.target))
+        else:
+            paired.append((stage, 0))
+        previous = stage
+    return paired
+
+
+def next_arrival(t, rate_at, until):
+    """
+    Returns when the next open-loop request is due, for a rate that may change over time.
+
+    Args:
+        t (float): The time of the previous request.
+        rate_at (callable): Returns the rate in requests/sec at a given time.
+        until (float): Give up looking past this time.
+
+    Returns:
+        float: The due time, or math.inf if nothing is due before `until`.
+    """
+    need = 1.0
+    while t < until:
+        rate = rate_at(t)
+        if rate * SCHEDULE_STEP >= need:
+            return t + need / rate
+        need -= rate * SCHEDULE_STEP
+        t += SCHEDULE_STEP
+    return math.inf
+
+
+def shard_stage(stage, processes, index):
+    """
+    Returns the share of a stage run by one of several worker processes.
+
+    Args:
+        stage (Stage): The whole stage.
+        processes (int): The number of worker processes.
+        index (int): Which process this share is for.
+
+    Returns:
+        Stage: The same stage with its workers (and rate) divided between the processes.
+    """
+    def split(count):
+        return count // processes + (1 if index < count % processes else 0)
+
+    if stage.open_loop:
+        return stage._replace(rate=stage.rate / processes, users=max(split(stage.max_in_flight), 1))
+    return stage._replace(users=split(stage.users))
+
+
+def parse_duration(text):
+    """
+    Parses a duration such as '90', '90s', '5m' or '1h' into seconds.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def parse_stage(text):
+    """
+    Parses a '--stage' argument of the form DURATION:TARGET[:RAMP].
+
+    TARGET is a worker count per endpoint ('20') or a rate per endpoint ('50/s'). A rate
+    may carry an in-flight limit as '50/s@20'. RAMP is step, linear or exponential.
+
+    Args:
+        text (str): The argument, e.g. '5m:20:linear' or '2m:200/s@50:exp'.
+
+    Returns:
+        Stage: The parsed stage.
+
+    Raises:
+        argparse.ArgumentTypeError: If the text is not a valid stage.
+    """
+    parts = text.split(':')
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(f"expected DURATION:TARGET[:RAMP], got {text!r}")
+    try:
+        duration = parse_duration(parts[0])
+        target = parts[1]
+        ramp = parts[2] if len(parts) == 3 else 'step'
+        if '/s' in target:
+            rate, _, in_flight = target.partition('/s')
+            users = int(in_flight.lstrip('@')) if in_flight else None
+            return Stage(duration, users=users, rate=float(rate), ramp=ramp)
+        return Stage(duration, users=int(target), ramp=ramp)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid stage {text!r}: {e}")
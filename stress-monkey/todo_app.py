@@ -0,0 +1,353 @@
+"""
+Stand-in for the todolist-flask backend, for benchmarking without the real app or MySQL.
+
+A stdlib-only WSGI app with the same /todos contract and response shapes:
+
+    GET    /todos            200 {"tasks": [task, ...]}
+    GET    /todos/<id>       200 {"task": task}
+    POST   /todos            201 {"newly added task": task}
+    PUT    /todos/<id>       200 {"updated task": task}
+    DELETE /todos/<id>       200 {"result": true}
+
+where a task is {"task_id", "title", "description", "is_done"}; unknown IDs get
+404 {"error": "Not found"} and bodies that are not JSON objects 400 {"error": "Bad request"}.
+Tasks live in memory. To keep responses the same size however long a run
+goes, only the newest TODO_APP_CAPACITY tasks are kept; the TODO_APP_SEED
+tasks created at startup are never evicted, so /todos/1 always exists unless
+it is deleted. TODO_APP_LATENCY (milliseconds) is slept in every request,
+standing in for the MySQL round trip, and TODO_APP_ERROR_RATE answers that
+fraction of requests with a 500 instead. With TODO_APP_DB set to an SQLite
+file (e.g. one filled by seed_todos.py), tasks live in its todos table instead,
+with nothing evicted, so latency can be measured against production-sized
+tables. Under gunicorn with preload_app, the workers' copies of the store share
+their task IDs in shared memory, so a task created through one worker can be
+updated or deleted through another. todo_server.py serves the same app without
+gunicorn.
+
+    gunicorn -c gunicorn_config.py todo_app:app
+"""
+import collections
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from todo_db import SCHEMA, TABLE
+
+DEFAULT_SEED = 20  # Tasks created at startup
+DEFAULT_CAPACITY = 1000  # Most tasks kept
+SHARED_ID_SLOTS = 1 << 20  # Newest task IDs the stores of forked processes can see of each other's
+
+_TASK_PATH = re.compile(r'^/todos/(\d+)/?$')
+_JSON_HEADERS = [('Content-Type', 'application/json')]
+
+
+class SharedTaskIds:
+    """
+    The task IDs handed out by the stores of several forked processes, in shared memory.
+
+    Created before the fork, it hands every store new IDs from one counter and keeps
+    each live ID in slot ID % `slots`, so a store can tell whether an ID it does not
+    hold was handed out by another store and still exists. A slot is reused after
+    `slots` newer IDs, so only the newest IDs are known across stores.
+
+    Args:
+        first_id (int): The first ID to hand out.
+        slots (int, optional): The newest IDs kept (default is SHARED_ID_SLOTS).
+    """
+
+    def __init__(self, first_id, slots=SHARED_ID_SLOTS):
+        self.slots = slots
+        self.memory = mmap.mmap(-1, slots * 8)  # Pages are only allocated once written
+        self.live = memoryview(self.memory).cast('q')
+        self.counter = multiprocessing.Value('q', first_id)
+
+    def issue(self):
+        with self.counter.get_lock():
+            task_id = self.counter.value
+            self.counter.value = task_id + 1
+        self.live[task_id % self.slots] = task_id
+        return task_id
+
+    def exists(self, task_id):
+        return self.live[task_id % self.slots] == task_id
+
+    def deleted(self, task_id):
+        """
+        Returns True if some store retired `task_id` and no newer ID took its slot.
+        """
+        return self.live[task_id % self.slots] == 0
+
+    def retire(self, task_id):
+        if self.live[task_id % self.slots] == task_id:
+            self.live[task_id % self.slots] = 0
+
+
+class TodoStore:
+    """
+    Thread-safe in-memory tasks.
+
+    Args:
+        seed (int, optional): Tasks to create up front; they are never evicted (default is DEFAULT_SEED).
+        capacity (int, optional): The most tasks kept; the oldest task created later is dropped
+            first (default is DEFAULT_CAPACITY).
+        shared (SharedTaskIds, optional): Take new IDs from here, for stores in several forked
+            processes (gunicorn's preload_app, todo_server.py workers). An update or delete of
+            an ID another store handed out succeeds while that ID is live, since only that
+            store holds the task, and a delete here retires it for every store (default is
+            None, IDs of this store alone).
+    """
+
+    def __init__(self, seed=DEFAULT_SEED, capacity=DEFAULT_CAPACITY, shared=None):
+        self.capacity = max(capacity, seed)
+        self.tasks = {}
+        self.created = collections.deque()  # IDs that may be evicted, oldest first
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.shared = shared
+        for number in range(seed):
+            self._insert(f"Seeded task #{number + 1}", 'Resistance is futile', evictable=False)
+        self.seed = seed
+
+    def _insert(self, title, description, evictable=True):
+        if evictable and self.shared is not None:
+            task_id = self.shared.issue()
+        else:
+            task_id = self.next_id
+            self.next_id += 1
+        task = {'task_id': task_id, 'title': title, 'description': description, 'is_done': False}
+        self.tasks[task_id] = task
+        if evictable:
+            self.created.append(task_id)
+        while len(self.tasks) > self.capacity and self.created:
+            evicted = self.created.popleft()
+            if self.tasks.pop(evicted, None) is not None and self.shared is not None:  # Gone if it was deleted
+                self.shared.retire(evicted)
+        return task
+
+    def _task(self, task_id):
+        # With the lock held: the task if this store holds it and no other store deleted it
+        task = self.tasks.get(task_id)
+        if task is not None and self.shared is not None and task_id > self.seed and self.shared.deleted(task_id):
+            del self.tasks[task_id]
+            return None
+        return task
+
+    def list(self):
+        with self.lock:
+            return list(self.tasks.values())
+
+    def get(self, task_id):
+        if self.shared is None:
+            return self.tasks.get(task_id)
+        with self.lock:
+            return self._task(task_id)
+
+    def add(self, title, description):
+        with self.lock:
+            return dict(self._insert(title, description))
+
+    def foreign(self, task_id):
+        """
+        Returns True if another store handed out `task_id`.
+        """
+        return (self.shared is not None and task_id > self.seed and task_id not in self.tasks
+                and self.shared.exists(task_id))
+
+    def update(self, task_id, changes):
+        with self.lock:
+            task = self._task(task_id)
+            if task is None:
+                if not self.foreign(task_id):
+                    return None
+                task = {'task_id': task_id, 'title': '', 'description': '', 'is_done': False}
+                task.update((field, changes[field]) for field in ('title', 'description', 'is_done')
+                            if field in changes)
+                return task
+            for field in ('title', 'description', 'is_done'):
+                if field in changes:
+                    task[field] = changes[field]
+            return dict(task)
+
+    def delete(self, task_id):
+        with self.lock:
+            if self._task(task_id) is None and not self.foreign(task_id):
+                return False
+            self.tasks.pop(task_id, None)
+            if self.shared is not None and task_id > self.seed:
+                self.shared.retire(task_id)
+            return True
+
+
+class SQLiteTodoStore:
+    """
+    Tasks in the todos table of an SQLite file, with the TodoStore interface.
+
+    Every thread (and forked process) opens its own connection on first use, so
+    several server processes can share one file.
+
+    Args:
+        path (str): The SQLite file; the table is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute(SCHEMA['sqlite'])
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        return conn
+
+    @staticmethod
+    def _task(row):
+        return {'task_id': row[0], 'title': row[1], 'description': row[2], 'is_done': bool(row[3])}
+
+    def list(self):
+        return [self._task(row) for row in
+                self._conn().execute(f"SELECT task_id, title, description, is_done FROM {TABLE}")]
+
+    def get(self, task_id):
+        row = self._conn().execute(f"SELECT task_id, title, description, is_done FROM {TABLE} WHERE task_id = ?",
+                                   (task_id,)).fetchone()
+        return None if row is None else self._task(row)
+
+    def add(self, title, description):
+        cursor = self._conn().execute(f"INSERT INTO {TABLE} (title, description) VALUES (?, ?)",
+                                      (title, description))
+        return {'task_id': cursor.lastrowid, 'title': title, 'description': description, 'is_done': False}
+
+    def foreign(self, task_id):
+        return False  # Every process sees the same table
+
+    def update(self, task_id, changes):
+        fields = [field for field in ('title', 'description', 'is_done') if field in changes]
+        if fields:
+            cursor = self._conn().execute(
+                f"UPDATE {TABLE} SET {', '.join(f'{field} = ?' for field in fields)} WHERE task_id = ?",
+                [changes[field] for field in fields] + [task_id])
+            if not cursor.rowcount:
+                return None
+        return self.get(task_id)
+
+    def delete(self, task_id):
+        return self._conn().execute(f"DELETE FROM {TABLE} WHERE task_id = ?", (task_id,)).rowcount > 0
+
+
+STATUS_LINES = {200: '200 OK', 201: '201 CREATED', 400: '400 BAD REQUEST', 404: '404 NOT FOUND',
+                405: '405 METHOD NOT ALLOWED', 500: '500 INTERNAL SERVER ERROR'}
+
+_BAD_REQUEST = (400, {'error': 'Bad request'})
+_NOT_FOUND = (404, {'error': 'Not found'})
+_NOT_ALLOWED = (405, {'error': 'Method not allowed'})
+_INJECTED_ERROR = (500, {'error': 'Internal server error'})
+
+
+def _decode(body):
+    try:
+        data = json.loads(body or b'null')
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+class TodoApp:
+    """
+    The WSGI application.
+
+    Args:
+        store (TodoStore, optional): The tasks to serve (default is None, a new TodoStore).
+        latency (float, optional): Seconds to sleep in every request (default is 0).
+        error_rate (float, optional): Fraction of requests answered with a 500 instead (default is 0).
+    """
+
+    def __init__(self, store=None, latency=0.0, error_rate=0.0):
+        self.store = store if store is not None else TodoStore()
+        self.latency = latency
+        self.error_rate = error_rate
+
+    def handle(self, method, path, body):
+        """
+        Answers one request, without the injected latency.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The request path, without the query string.
+            body (bytes): The request body (may be empty).
+
+        Returns:
+            tuple: (status code, JSON-serializable payload)
+        """
+        if self.error_rate and random.random() < self.error_rate:
+            return _INJECTED_ERROR
+        store = self.store
+        if path.rstrip('/') == '/todos':
+            if method == 'GET':
+                return 200, {'tasks': store.list()}
+            if method == 'POST':
+                data = _decode(body)
+                if data is None or not data.get('title'):
+                    return _BAD_REQUEST
+                return 201, {'newly added task': store.add(data['title'], data.get('description', ''))}
+            return _NOT_ALLOWED
+        match = _TASK_PATH.match(path)
+        if match is None:
+            return _NOT_FOUND
+        task_id = int(match.group(1))
+        if method == 'GET':
+            task = store.get(task_id)
+        elif method == 'PUT':
+            data = _decode(body)
+            if data is None:
+                return _BAD_REQUEST
+            task = store.update(task_id, data)
+        elif method == 'DELETE':
+            return (200, {'result': True}) if store.delete(task_id) else _NOT_FOUND
+        else:
+            return _NOT_ALLOWED
+        if task is None:
+            return _NOT_FOUND
+        return 200, {'task' if method == 'GET' else 'updated task': task}
+
+    def __call__(self, environ, start_response):
+        if self.latency:
+            time.sleep(self.latency)  # Cooperative under gevent, which patches time.sleep
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length) if length else b''
+        status, payload = self.handle(environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''), body)
+        encoded = json.dumps(payload).encode()
+        start_response(STATUS_LINES[status], _JSON_HEADERS + [('Content-Length', str(len(encoded)))])
+        return [encoded]
+
+
+def _env_number(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, '') else float(value)
+
+
+def _store_from_env():
+    if os.environ.get('TODO_APP_DB'):
+        return SQLiteTodoStore(os.environ['TODO_APP_DB'])
+    seed = int(_env_number('TODO_APP_SEED', DEFAULT_SEED))
+    # With preload_app this runs in the master, and the workers it forks share the task IDs
+    return TodoStore(seed=seed, capacity=int(_env_number('TODO_APP_CAPACITY', DEFAULT_CAPACITY)),
+                     shared=SharedTaskIds(seed + 1))
+
+
+# Read by gunicorn workers; gunicorn_matrix.py sets these for every variant
+app = TodoApp(_store_from_env(),
+              latency=_env_number('TODO_APP_LATENCY', 0.0) / 1000.0,
+              error_rate=_env_number('TODO_APP_ERROR_RATE', 0.0))
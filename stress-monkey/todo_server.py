@@ -0,0 +1,282 @@
+"""
+Local stand-in for the todo API, for load testing with no network or backend.
+
+Serves todo_app.TodoApp (the /todos contract with in-memory tasks) over
+HTTP/1.1 on asyncio, stdlib only. Connections are kept alive and pipelined
+requests are answered in order. The injected latency is a timer rather than a
+sleep, so a 50ms "database" costs no throughput; the injected error rate
+answers that fraction of requests with a 500.
+
+With workers=0 the server runs on a thread of the calling process; with N
+workers, N forked processes share one listening socket. Each worker process
+keeps its own tasks, and the workers take task IDs from one counter in shared
+memory; seeded tasks such as /todos/1 exist in all of them, and a PUT or
+DELETE of an ID another worker created is answered as a success while that
+task exists (and with a 404 once it was deleted or for an ID nobody created),
+so ID-tracking runs see the same responses as against one shared database.
+GET /todos lists only the answering worker's tasks. With a database file (db=, --db), every worker
+serves the todos table of that SQLite file instead, e.g. one filled by
+seed_todos.py.
+
+    python todo_server.py --port 8000 --workers 4 --latency 5 --error-rate 1
+
+or from Python:
+
+    with TodoServer(workers=2, latency=0.005) as server:
+        run_stages(server.base_url, endpoints, stages, stage_stats)
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import signal
+import socket
+import threading
+
+from todo_app import (DEFAULT_CAPACITY, DEFAULT_SEED, STATUS_LINES, SharedTaskIds, SQLiteTodoStore, TodoApp,
+                      TodoStore)
+
+MAX_HEAD = 65536  # Bytes of request line and headers before the request is refused
+LISTEN_BACKLOG = 1024
+
+_RESPONSE_HEAD = {status: f"HTTP/1.1 {line}\r\nContent-Type: application/json\r\nContent-Length: ".encode()
+                  for status, line in STATUS_LINES.items()}
+_BAD_REQUEST = b'HTTP/1.1 400 BAD REQUEST\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+class _HTTPProtocol(asyncio.Protocol):
+    """
+    One client connection: parses requests as they arrive and writes the app's answers.
+    """
+
+    def __init__(self, app, latency):
+        self.app = app
+        self.latency = latency
+        self.buffer = bytearray()
+        self.transport = None
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def data_received(self, data):
+        if self.closing:
+            return
+        buffer = self.buffer
+        buffer += data
+        while True:
+            end = buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(buffer) > MAX_HEAD:
+                    self._refuse()
+                return
+            request = self._parse_head(bytes(buffer[:end]))
+            if request is None:
+                self._refuse()
+                return
+            method, path, length, close = request
+            total = end + 4 + length
+            if len(buffer) < total:
+                return  # The body is still on its way
+            body = bytes(buffer[end + 4:total])
+            del buffer[:total]
+            status, payload = self.app.handle(method, path, body)
+            encoded = json.dumps(payload).encode()
+            response = (_RESPONSE_HEAD[status] + str(len(encoded)).encode()
+                        + (b'\r\nConnection: close\r\n\r\n' if close else b'\r\n\r\n') + encoded)
+            if self.latency:
+                # A fixed delay keeps pipelined answers in order
+                asyncio.get_running_loop().call_later(self.latency, self._send, response, close)
+            else:
+                self._send(response, close)
+            if close:
+                self.closing = True
+                return
+
+    @staticmethod
+    def _parse_head(head):
+        lines = head.split(b'\r\n')
+        try:
+            method, target, version = lines[0].split(b' ')
+        except ValueError:
+            return None
+        length = 0
+        close = version == b'HTTP/1.0'
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name == b'content-length':
+                try:
+                    length = int(value)
+                except ValueError:
+                    return None
+            elif name == b'connection':
+                value = value.strip().lower()
+                if value == b'close':
+                    close = True
+                elif value == b'keep-alive':
+                    close = False
+            elif name == b'transfer-encoding':
+                return None  # Chunked bodies are not supported; the load generators send Content-Length
+        return method.decode('ascii', 'replace'), target.split(b'?', 1)[0].decode('latin-1'), length, close
+
+    def _send(self, response, close):
+        if self.transport.is_closing():
+            return
+        self.transport.write(response)
+        if close:
+            self.transport.close()
+
+    def _refuse(self):
+        self.closing = True
+        self.transport.write(_BAD_REQUEST)
+        self.transport.close()
+
+
+async def _serve(sock, app, latency, stopped):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: _HTTPProtocol(app, latency), sock=sock,
+                                      backlog=LISTEN_BACKLOG)  # It listens again, with 100 by default
+    async with server:
+        await stopped.wait()
+
+
+def _make_app(settings, shared=None):
+    if settings['db']:
+        store = SQLiteTodoStore(settings['db'])
+    else:
+        store = TodoStore(seed=settings['seed'], capacity=settings['capacity'], shared=shared)
+    return TodoApp(store, error_rate=settings['error_rate'])
+
+
+def _worker_process(sock, settings, shared):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent stops the workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    async def main():
+        stopped = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+        await _serve(sock, _make_app(settings, shared), settings['latency'], stopped)
+
+    asyncio.run(main())
+
+
+class TodoServer:
+    """
+    A local todo API, for use in a `with` block or with start() and stop().
+
+    Args:
+        host (str, optional): The address to listen on (default is '127.0.0.1').
+        port (int, optional): The port to listen on (default is 0, any free port).
+        workers (int, optional): Serving processes, 0 to serve from a thread of this
+            process (default is 0).
+        latency (float, optional): Seconds before every answer (default is 0).
+        error_rate (float, optional): Fraction of requests answered with a 500 (default is 0).
+        seed (int, optional): Tasks that exist from the start (default is DEFAULT_SEED).
+        capacity (int, optional): The most tasks kept per worker (default is DEFAULT_CAPACITY).
+        db (str, optional): Serve the todos table of this SQLite file instead of in-memory
+            tasks; `seed` and `capacity` do not apply (default is None).
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, workers=0, latency=0.0, error_rate=0.0, seed=DEFAULT_SEED,
+                 capacity=DEFAULT_CAPACITY, db=None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.settings = {'latency': latency, 'error_rate': error_rate, 'seed': seed, 'capacity': capacity, 'db': db}
+        self.sock = None
+        self.processes = []
+        self.thread = None
+        self.loop = None
+        self.stopped = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(LISTEN_BACKLOG)
+        self.port = self.sock.getsockname()[1]
+        if self.workers:
+            # Forked, so every worker inherits the listening socket and the shared task IDs
+            context = multiprocessing.get_context('fork')
+            shared = None if self.settings['db'] else SharedTaskIds(self.settings['seed'] + 1)
+            for _ in range(self.workers):
+                process = context.Process(target=_worker_process, args=(self.sock, self.settings, shared),
+                                          daemon=True)
+                process.start()
+                self.processes.append(process)
+        else:
+            ready = threading.Event()
+            self.thread = threading.Thread(target=self._run_thread, args=(ready,), daemon=True)
+            self.thread.start()
+            ready.wait()
+        return self
+
+    def _run_thread(self, ready):
+        async def main():
+            self.loop = asyncio.get_running_loop()
+            self.stopped = asyncio.Event()
+            ready.set()
+            await _serve(self.sock, _make_app(self.settings), self.settings['latency'], self.stopped)
+
+        asyncio.run(main())
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.thread.join()
+            self.thread = None
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the todo API.")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=8000, help="port to listen on (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="serving processes, 0 for a thread of this process (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.0, metavar='MS',
+                        help="milliseconds before every answer (default: %(default)s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='PERCENT',
+                        help="percentage of requests answered with a 500 (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help="tasks that exist from the start, IDs 1 and up (default: %(default)s)")
+    parser.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY,
+                        help="most tasks kept per worker; older created tasks are dropped (default: %(default)s)")
+    parser.add_argument('--db', metavar='PATH',
+                        help="serve the todos table of this SQLite file (e.g. from seed_todos.py) instead of "
+                             "in-memory tasks")
+    args = parser.parse_args()
+    server = TodoServer(args.host, args.port, args.workers, latency=args.latency / 1000.0,
+                        error_rate=args.error_rate / 100.0, seed=args.seed, capacity=args.capacity, db=args.db)
+    with server:
+        print(f"Stand-in todo API on {server.base_url} with {args.workers or 'no'} worker processes. "
+              f"Press Ctrl-C to stop.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            print("\nStand-in stopped.")
+
+
+if __name__ == '__main__':
+    main()